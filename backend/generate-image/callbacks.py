@@ -0,0 +1,258 @@
+'''
+NanoBanana completion callbacks (task_results table).
+When CALLBACK_URL (the public URL of this function) and CALLBACK_SECRET are
+set and a database is configured, every submitted task carries a callBackUrl
+and gets a 'pending' row. The callback, or a fallback record-info poll,
+stores the final status in that row and sends a NOTIFY on CHANNEL; a
+LISTEN thread per warm instance wakes the requests waiting for that task.
+checked_at is the last time anyone learned something about the task, so the
+fallback polls stay CALLBACK_FALLBACK_INTERVAL apart across all instances.
+Rows are kept for RESULT_TTL.
+'''
+
+import hmac
+import os
+import random
+import select
+import threading
+import time
+from typing import Dict, Any, List, Optional, Set
+
+import db
+
+CALLBACK_URL = os.environ.get('CALLBACK_URL', '')
+CALLBACK_SECRET = os.environ.get('CALLBACK_SECRET', '')
+FALLBACK_INTERVAL = float(os.environ.get('CALLBACK_FALLBACK_INTERVAL', 30))
+RESULT_TTL = 24 * 60 * 60
+PURGE_PROBABILITY = 0.01
+CHANNEL = 'task_results'
+
+# Seconds a LISTEN connection blocks before checking that it is still alive
+LISTEN_IDLE = 30
+
+# Counters of this warm instance
+stats = {'received': 0, 'rejected': 0, 'wakeups': 0}
+
+EXPECT_SQL = '''
+    INSERT INTO task_results (task_id) VALUES (%s) ON CONFLICT (task_id) DO NOTHING
+'''
+
+FINISH_SQL = '''
+    INSERT INTO task_results AS r (task_id, status, image_url, error_code, message, source, finished_at)
+    VALUES (%(task_id)s, %(status)s, %(image_url)s, %(error_code)s, %(message)s, %(source)s, CURRENT_TIMESTAMP)
+    ON CONFLICT (task_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        image_url = EXCLUDED.image_url,
+        error_code = EXCLUDED.error_code,
+        message = EXCLUDED.message,
+        source = EXCLUDED.source,
+        checked_at = CURRENT_TIMESTAMP,
+        finished_at = CURRENT_TIMESTAMP
+    WHERE r.status = 'pending'
+    RETURNING task_id
+'''
+
+TOUCH_SQL = '''
+    UPDATE task_results SET checked_at = CURRENT_TIMESTAMP WHERE task_id = %s AND status = 'pending'
+'''
+
+LOOKUP_SQL = '''
+    SELECT task_id, status, image_url, error_code, message, CURRENT_TIMESTAMP - checked_at
+    FROM task_results WHERE task_id = ANY(%s)
+'''
+
+PURGE_SQL = '''
+    DELETE FROM task_results WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+'''
+
+
+def enabled() -> bool:
+    return bool(CALLBACK_URL and CALLBACK_SECRET and db.is_configured())
+
+
+def callback_url() -> Optional[str]:
+    '''
+    The callBackUrl for a new task, or None when callbacks are off.
+    '''
+    if not enabled():
+        return None
+    separator = '&' if '?' in CALLBACK_URL else '?'
+    return f'{CALLBACK_URL}{separator}callback={CALLBACK_SECRET}'
+
+
+def verify(secret: str) -> bool:
+    return bool(CALLBACK_SECRET) and hmac.compare_digest(secret.encode('utf-8'), CALLBACK_SECRET.encode('utf-8'))
+
+
+def parse(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Normalized status from a callback body
+    ({"code": 200, "msg": ..., "data": {"taskId": ..., "info": {"resultImageUrl": ...}}}),
+    or None if it names no task or carries no result.
+    '''
+    data = payload.get('data') if isinstance(payload, dict) else None
+    if not isinstance(data, dict) or not data.get('taskId'):
+        return None
+    task_id = str(data['taskId'])
+
+    if payload.get('code') == 200:
+        info = data.get('info') or data.get('response') or {}
+        image_url = info.get('resultImageUrl') if isinstance(info, dict) else None
+        if not image_url:
+            return None
+        return {'status': 'success', 'taskId': task_id, 'imageUrl': image_url}
+
+    return {
+        'status': 'failed',
+        'taskId': task_id,
+        'message': payload.get('msg') or 'Unknown error',
+        'errorCode': payload.get('code') or 500
+    }
+
+
+def expect(task_id: str) -> None:
+    '''
+    Creates the 'pending' row for a task that was just submitted.
+    '''
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(EXPECT_SQL, (task_id,))
+            if random.random() < PURGE_PROBABILITY:
+                cur.execute(PURGE_SQL, (RESULT_TTL,))
+    except Exception as e:
+        print(f"Task result write error: {e}")
+
+
+def record(status: Dict[str, Any], source: str) -> bool:
+    '''
+    Stores a final status and wakes its waiters on every instance.
+    Returns False if the task had already been recorded as finished.
+    '''
+    params = {
+        'task_id': status['taskId'],
+        'status': status['status'],
+        'image_url': status.get('imageUrl'),
+        'error_code': status.get('errorCode'),
+        'message': status.get('message'),
+        'source': source
+    }
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(FINISH_SQL, params)
+            if cur.fetchone() is None:
+                return False
+            cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, status['taskId']))
+        return True
+    except Exception as e:
+        print(f"Task result write error: {e}")
+        return False
+
+
+def touch(task_id: str) -> None:
+    '''
+    Marks a pending task as just polled, pushing back the next fallback poll.
+    '''
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(TOUCH_SQL, (task_id,))
+    except Exception as e:
+        print(f"Task result write error: {e}")
+
+
+def lookup(task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    '''
+    Recorded statuses by taskId. Pending tasks carry 'checkedAgo', seconds
+    since the task was submitted or last polled; unknown tasks are missing.
+    '''
+    if not task_ids:
+        return {}
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(LOOKUP_SQL, (list(task_ids),))
+            rows = cur.fetchall()
+    except Exception as e:
+        print(f"Task result read error: {e}")
+        return {}
+
+    found = {}
+    for task_id, status, image_url, error_code, message, checked_ago in rows:
+        if status == 'success':
+            found[task_id] = {'status': 'success', 'taskId': task_id, 'imageUrl': image_url}
+        elif status == 'failed':
+            found[task_id] = {'status': 'failed', 'taskId': task_id, 'message': message, 'errorCode': error_code}
+        else:
+            found[task_id] = {'status': 'pending', 'taskId': task_id, 'checkedAgo': checked_ago.total_seconds()}
+    return found
+
+
+class Listener:
+    '''
+    LISTENs on CHANNEL over its own connection (on a daemon thread started by
+    the first subscribe) and sets the events subscribed to a notified taskId.
+    After every (re)connect all subscribers are woken, so they look up what
+    they may have missed in between.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters: Dict[str, Set[threading.Event]] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    def subscribe(self, task_ids: List[str]) -> threading.Event:
+        event = threading.Event()
+        with self.lock:
+            for task_id in task_ids:
+                self.waiters.setdefault(task_id, set()).add(event)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='task-results-listener', daemon=True)
+                self.thread.start()
+        return event
+
+    def unsubscribe(self, task_ids: List[str], event: threading.Event) -> None:
+        with self.lock:
+            for task_id in task_ids:
+                events = self.waiters.get(task_id)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self.waiters[task_id]
+
+    def wake(self, task_id: Optional[str] = None) -> None:
+        with self.lock:
+            if task_id is None:
+                events = set().union(*self.waiters.values())
+            else:
+                events = set(self.waiters.get(task_id, ()))
+        if events:
+            stats['wakeups'] += 1
+        for event in events:
+            event.set()
+
+    def run(self) -> None:
+        import psycopg2
+
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.environ['DATABASE_URL'])
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {CHANNEL}')
+                self.wake()
+                while True:
+                    if select.select([conn], [], [], LISTEN_IDLE) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.wake(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Task result listener error: {e}")
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+LISTENER = Listener()
@@ -0,0 +1,52 @@
+'''
+Postgres connection shared by everything in this function instance.
+Opened lazily from DATABASE_URL and reused across warm invocations; after
+VALIDATE_AFTER_IDLE seconds unused it is pinged first and reopened if the
+server or a load balancer dropped it in the meantime.
+Every statement is timed as a tracing span (db.<verb>.<table>).
+'''
+
+import os
+import time
+
+from tracing import span, sql_stage
+
+# Seconds the connection may sit unused before it is pinged on the next use
+VALIDATE_AFTER_IDLE = float(os.environ.get('DB_VALIDATE_AFTER_IDLE', 10))
+
+_conn = None
+_last_used = 0.0
+
+
+def is_configured() -> bool:
+    return bool(os.environ.get('DATABASE_URL'))
+
+
+def get_connection():
+    global _conn, _last_used
+    import psycopg2
+
+    now = time.monotonic()
+    if _conn is not None and not _conn.closed and now - _last_used >= VALIDATE_AFTER_IDLE:
+        try:
+            with _conn.cursor() as cur:
+                cur.execute('SELECT 1')
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            print(f"Reopening stale DB connection: {e}")
+            _conn.close()
+    if _conn is None or _conn.closed:
+        _conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=_tracing_cursor())
+        _conn.autocommit = True
+    _last_used = now
+    return _conn
+
+
+def _tracing_cursor():
+    from psycopg2.extensions import cursor
+
+    class TracingCursor(cursor):
+        def execute(self, query, vars=None):
+            with span(sql_stage(query)):
+                return super().execute(query, vars)
+
+    return TracingCursor
@@ -0,0 +1,16 @@
+'''
+Reading the platform's HTTP event. Header names are matched
+case-insensitively: the gateway passes them on as the client sent them.
+'''
+
+from typing import Dict, Any
+
+
+def header(event: Dict[str, Any], name: str) -> str:
+    '''
+    The value of request header `name`; '' when it is absent.
+    '''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value or ''
+    return ''
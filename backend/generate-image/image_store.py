@@ -0,0 +1,480 @@
+'''
+Input photos for NanoBanana, which fetches them by URL.
+IMAGE_STORE_BACKEND picks where a photo is kept:
+  postgres  input_images table (the default with DATABASE_URL and IMAGE_STORE_SECRET)
+  file      IMAGE_STORE_PATH on local disk (one instance, or a shared mount)
+  s3        an S3-compatible bucket (IMAGE_STORE_S3_ENDPOINT, _BUCKET, _REGION,
+            _ACCESS_KEY, _SECRET_KEY); old photos are left to the bucket's
+            lifecycle rules
+  imgbb     published on api.imgbb.com (the default otherwise)
+Photos are keyed by their sha256, so one photo is stored once. postgres and
+file photos are served by this function: signed_url() points at
+IMAGE_STORE_URL (default CALLBACK_URL, the function's public URL) with
+?image=<sha256>&expires=<unix time>&sig=<hmac over both with
+IMAGE_STORE_SECRET>, valid for IMAGE_URL_TTL seconds. s3 photos get a
+presigned bucket URL for the same time; fresh_url() hands out a new one
+for a photo stored earlier (a generation that waited in the queue). When a
+self-hosted store fails and IMGBB_API_KEY is set, the photo goes to ImgBB
+instead.
+'''
+
+import base64
+import hashlib
+import hmac
+import os
+import random
+import re
+import time
+from typing import Optional, Tuple
+from urllib.parse import quote, urlparse
+
+import db
+import deadline
+from http_client import get_session
+from tracing import span
+from upstream import Upstream
+
+IMGBB = Upstream.from_env('imgbb', 'IMGBB', 'https://api.imgbb.com', rate=2, burst=4, max_concurrency=2)
+
+IMAGE_STORE_URL = os.environ.get('IMAGE_STORE_URL') or os.environ.get('CALLBACK_URL', '')
+IMAGE_STORE_SECRET = os.environ.get('IMAGE_STORE_SECRET', '')
+
+# How long a handed-out photo URL works; NanoBanana fetches it right after the submit
+IMAGE_URL_TTL = int(os.environ.get('IMAGE_URL_TTL', 15 * 60))
+# How long a stored photo is kept (a retried generation reuses it)
+DEFAULT_TTL = 24 * 60 * 60
+PURGE_PROBABILITY = 0.01
+
+# ImgBB keeps uploads forever unless IMGBB_EXPIRATION (seconds) is set; a
+# remembered upload is reused only while it has at least this long to live
+UPLOAD_REUSE_MARGIN = 15 * 60
+
+IMAGE_HASH = re.compile(r'^[0-9a-f]{64}$')
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+FIND_UPLOAD_SQL = '''
+    SELECT url FROM image_uploads WHERE content_hash = %s
+        AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP + make_interval(secs => %s))
+'''
+
+RECORD_UPLOAD_SQL = '''
+    INSERT INTO image_uploads (content_hash, url, expires_at)
+    VALUES (%s, %s, CASE WHEN %s > 0 THEN CURRENT_TIMESTAMP + make_interval(secs => %s) END)
+    ON CONFLICT (content_hash) DO UPDATE SET url = EXCLUDED.url,
+        expires_at = EXCLUDED.expires_at, created_at = CURRENT_TIMESTAMP
+'''
+
+# Keeps an already stored photo; no row comes back when it has to be inserted
+KEEP_IMAGE_SQL = '''
+    UPDATE input_images SET expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+    WHERE content_hash = %s
+    RETURNING content_hash
+'''
+
+STORE_IMAGE_SQL = '''
+    INSERT INTO input_images (content_hash, data, expires_at)
+    VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+    ON CONFLICT (content_hash) DO UPDATE SET expires_at = EXCLUDED.expires_at
+'''
+
+LOAD_IMAGE_SQL = '''
+    SELECT data FROM input_images WHERE content_hash = %s AND expires_at > CURRENT_TIMESTAMP
+'''
+
+PURGE_IMAGES_SQL = '''
+    DELETE FROM input_images WHERE expires_at <= CURRENT_TIMESTAMP
+'''
+
+
+class ImageStore:
+    name = 'none'
+
+    def config_error(self) -> Optional[str]:
+        '''
+        Why the store can't take photos, or None when it is ready.
+        '''
+        return None
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        '''
+        Stores the photo and returns a URL NanoBanana can fetch it from,
+        or None when it could not be stored.
+        '''
+        return None
+
+    def get(self, image_hash: str) -> Optional[bytes]:
+        '''
+        The photo for this function's ?image= mode; None if it isn't here.
+        '''
+        return None
+
+    def fresh_url(self, image_hash: str, image_url: str) -> str:
+        '''
+        A URL of a photo put() earlier that works for IMAGE_URL_TTL from now;
+        image_url is what put() returned. URLs of other stores come back as they are.
+        '''
+        return image_url
+
+
+class PostgresImageStore(ImageStore):
+    '''
+    input_images table (see db_migrations); shared by all instances.
+    '''
+
+    name = 'postgres'
+
+    def __init__(self, ttl: int = DEFAULT_TTL):
+        self.ttl = ttl
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        with span('image_store.put'), db.get_connection().cursor() as cur:
+            cur.execute(KEEP_IMAGE_SQL, (self.ttl, image_hash))
+            if cur.fetchone() is None:
+                cur.execute(STORE_IMAGE_SQL, (image_hash, data, self.ttl))
+            if random.random() < PURGE_PROBABILITY:
+                cur.execute(PURGE_IMAGES_SQL)
+        return signed_url(image_hash)
+
+    def get(self, image_hash: str) -> Optional[bytes]:
+        with db.get_connection().cursor() as cur:
+            cur.execute(LOAD_IMAGE_SQL, (image_hash,))
+            row = cur.fetchone()
+        return bytes(row[0]) if row else None
+
+    def fresh_url(self, image_hash: str, image_url: str) -> str:
+        return signed_url(image_hash) if is_signed_url(image_url) else image_url
+
+
+class FileImageStore(ImageStore):
+    '''
+    One file per photo under `path`; a photo lives `ttl` seconds after its
+    last put (the file's mtime).
+    '''
+
+    name = 'file'
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def file_path(self, image_hash: str) -> str:
+        return os.path.join(self.path, image_hash)
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        path = self.file_path(image_hash)
+        with span('image_store.put'):
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                os.makedirs(self.path, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            if random.random() < PURGE_PROBABILITY:
+                self.purge()
+        return signed_url(image_hash)
+
+    def get(self, image_hash: str) -> Optional[bytes]:
+        path = self.file_path(image_hash)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fresh_url(self, image_hash: str, image_url: str) -> str:
+        return signed_url(image_hash) if is_signed_url(image_url) else image_url
+
+    def purge(self) -> None:
+        expired_before = time.time() - self.ttl
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < expired_before:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class S3ImageStore(ImageStore):
+    '''
+    Objects <prefix><sha256> in an S3-compatible bucket, written and handed
+    out through SigV4 presigned URLs (path-style, so any endpoint works).
+    '''
+
+    name = 's3'
+
+    def __init__(self, endpoint: str, bucket: str, region: str, access_key: str, secret_key: str,
+                 prefix: str = 'input-images/'):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        key = f'{self.prefix}{image_hash}'
+        with span('image_store.put') as attrs:
+            response = get_session().put(
+                self.presign('PUT', key, IMAGE_URL_TTL),
+                data=data,
+                headers={'Content-Type': content_type(data)},
+                timeout=deadline.timeout(30)
+            )
+            attrs['httpStatus'] = response.status_code
+        if response.status_code != 200:
+            print(f"S3 upload error: {response.status_code} - {response.text[:200]}")
+            return None
+        return self.presign('GET', key, IMAGE_URL_TTL)
+
+    def fresh_url(self, image_hash: str, image_url: str) -> str:
+        if not image_url.startswith(f'{self.endpoint}/{quote(self.bucket)}/'):
+            return image_url
+        return self.presign('GET', f'{self.prefix}{image_hash}', IMAGE_URL_TTL)
+
+    def presign(self, method: str, key: str, expires_in: int) -> str:
+        now = time.gmtime()
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', now)
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        path = quote(f'/{self.bucket}/{key}', safe='/-_.~')
+        params = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{scope}',
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires_in),
+            'X-Amz-SignedHeaders': 'host'
+        }
+        query = '&'.join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(params.items()))
+        host = urlparse(self.endpoint).netloc
+        canonical_request = '\n'.join([method, path, query, f'host:{host}', '', 'host', 'UNSIGNED-PAYLOAD'])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        ])
+        signing_key = f'AWS4{self.secret_key}'.encode('utf-8')
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return f'{self.endpoint}{path}?{query}&X-Amz-Signature={signature}'
+
+
+class ImgbbImageStore(ImageStore):
+    '''
+    Publishes the photo on ImgBB. Uploads are remembered in image_uploads
+    (with a database), so the same photo is uploaded once while it lives.
+    '''
+
+    name = 'imgbb'
+
+    def __init__(self, api_key: str, expiration: Optional[str] = None):
+        self.api_key = api_key
+        self.expiration = expiration
+
+    def config_error(self) -> Optional[str]:
+        return None if self.api_key else 'ImgBB API key not configured'
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        image_url = self.find_upload(image_hash)
+        if image_url:
+            print(f"Reusing earlier upload: {image_url}")
+            return image_url
+
+        print("Uploading image to ImgBB...")
+        form = {'image': base64.b64encode(data).decode('ascii')}
+        if self.expiration:
+            form['expiration'] = self.expiration
+
+        with span('imgbb.upload') as attrs:
+            imgbb_response = IMGBB.request(
+                'POST',
+                '/1/upload',
+                params={'key': self.api_key},
+                data=form,
+                timeout=deadline.timeout(30)
+            )
+            attrs['httpStatus'] = imgbb_response.status_code
+
+        if imgbb_response.status_code == 200:
+            imgbb_result = imgbb_response.json()
+            if imgbb_result.get('success'):
+                image_url = imgbb_result['data']['url']
+                print(f"Image uploaded successfully: {image_url}")
+                self.record_upload(image_hash, image_url, int(imgbb_result['data'].get('expiration') or 0))
+                return image_url
+            print(f"ImgBB upload failed: {imgbb_result}")
+        else:
+            print(f"ImgBB upload error: {imgbb_response.status_code} - {imgbb_response.text}")
+
+        return None
+
+    def find_upload(self, image_hash: str) -> Optional[str]:
+        '''
+        Hosted URL of an earlier upload of the same bytes, if it is not about to expire.
+        '''
+        if not db.is_configured():
+            return None
+        try:
+            with db.get_connection().cursor() as cur:
+                cur.execute(FIND_UPLOAD_SQL, (image_hash, UPLOAD_REUSE_MARGIN))
+                row = cur.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Upload index read error: {e}")
+            return None
+
+    def record_upload(self, image_hash: str, url: str, expiration: int) -> None:
+        if not db.is_configured():
+            return
+        try:
+            with db.get_connection().cursor() as cur:
+                cur.execute(RECORD_UPLOAD_SQL, (image_hash, url, expiration, expiration))
+                cur.execute("DELETE FROM image_uploads WHERE expires_at <= CURRENT_TIMESTAMP")
+        except Exception as e:
+            print(f"Upload index write error: {e}")
+
+
+class FallbackImageStore(ImageStore):
+    '''
+    `primary`, and `fallback` for the photos the primary store could not take.
+    '''
+
+    def __init__(self, primary: ImageStore, fallback: ImageStore):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name
+
+    def config_error(self) -> Optional[str]:
+        return self.primary.config_error()
+
+    def put(self, image_hash: str, data: bytes) -> Optional[str]:
+        try:
+            image_url = self.primary.put(image_hash, data)
+        except Exception as e:
+            print(f"Image store {self.primary.name} error: {e}")
+            image_url = None
+        if image_url:
+            return image_url
+        print(f"Image store {self.primary.name} failed, falling back to {self.fallback.name}")
+        return self.fallback.put(image_hash, data)
+
+    def get(self, image_hash: str) -> Optional[bytes]:
+        return self.primary.get(image_hash)
+
+    def fresh_url(self, image_hash: str, image_url: str) -> str:
+        return self.primary.fresh_url(image_hash, image_url)
+
+
+class MisconfiguredImageStore(ImageStore):
+    '''
+    Stands in for a store whose settings are wrong; config_error() reports why.
+    '''
+
+    name = 'misconfigured'
+
+    def __init__(self, error: str):
+        self.error = error
+
+    def config_error(self) -> Optional[str]:
+        return self.error
+
+
+def signature(image_hash: str, expires: int) -> str:
+    return hmac.new(IMAGE_STORE_SECRET.encode('utf-8'), f'{image_hash}:{expires}'.encode('ascii'), hashlib.sha256).hexdigest()
+
+
+def signed_url(image_hash: str) -> str:
+    expires = int(time.time()) + IMAGE_URL_TTL
+    separator = '&' if '?' in IMAGE_STORE_URL else '?'
+    return f'{IMAGE_STORE_URL}{separator}image={image_hash}&expires={expires}&sig={signature(image_hash, expires)}'
+
+
+def is_signed_url(image_url: str) -> bool:
+    return bool(IMAGE_STORE_URL) and image_url.startswith(IMAGE_STORE_URL) and 'sig=' in image_url
+
+
+def verify(image_hash: str, expires: str, sig: str) -> bool:
+    '''
+    True for a well-formed, unexpired URL signed with IMAGE_STORE_SECRET.
+    '''
+    if not IMAGE_STORE_SECRET or not IMAGE_HASH.match(image_hash or '') or not (expires or '').isdigit():
+        return False
+    if int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature(image_hash, int(expires)), sig or '')
+
+
+def content_type(data: bytes) -> str:
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    '''
+    (first, last) byte of a single "bytes=" Range header, last clamped to
+    the size; first > last when the range is unsatisfiable. None for a
+    header that isn't understood (the whole photo is served then).
+    '''
+    match = BYTE_RANGE.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # bytes=-N: the last N bytes
+        length = int(match.group(2))
+        return (max(0, size - length), size - 1) if length else (size, size - 1)
+    first = int(match.group(1))
+    if match.group(2) and int(match.group(2)) < first:
+        # a syntactically invalid range is ignored
+        return None
+    last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    return first, last
+
+
+def make_image_store() -> ImageStore:
+    '''
+    The IMAGE_STORE_BACKEND store. A misconfigured one (unknown backend,
+    missing secret, URL or S3 settings) becomes a MisconfiguredImageStore, so
+    only requests that store photos fail, through config_error().
+    '''
+    try:
+        return _build_image_store()
+    except KeyError as e:
+        error = f'Image store not configured: {e.args[0]} is not set'
+    except ValueError as e:
+        error = f'Image store not configured: {e}'
+    print(error)
+    return MisconfiguredImageStore(error)
+
+
+def _build_image_store() -> ImageStore:
+    self_hosted = bool(IMAGE_STORE_SECRET and IMAGE_STORE_URL)
+    backend = os.environ.get('IMAGE_STORE_BACKEND', 'postgres' if self_hosted and db.is_configured() else 'imgbb')
+    ttl = int(os.environ.get('IMAGE_STORE_TTL', DEFAULT_TTL))
+    imgbb = ImgbbImageStore(os.environ.get('IMGBB_API_KEY', ''), os.environ.get('IMGBB_EXPIRATION'))
+
+    if backend == 'imgbb':
+        return imgbb
+    if backend in ('postgres', 'file') and not self_hosted:
+        raise ValueError(f'IMAGE_STORE_BACKEND={backend} needs IMAGE_STORE_SECRET and IMAGE_STORE_URL')
+    if backend == 'postgres':
+        store: ImageStore = PostgresImageStore(ttl)
+    elif backend == 'file':
+        store = FileImageStore(os.environ.get('IMAGE_STORE_PATH', '/tmp/generate-image-images'), ttl)
+    elif backend == 's3':
+        store = S3ImageStore(
+            os.environ['IMAGE_STORE_S3_ENDPOINT'],
+            os.environ['IMAGE_STORE_S3_BUCKET'],
+            os.environ.get('IMAGE_STORE_S3_REGION', 'us-east-1'),
+            os.environ['IMAGE_STORE_S3_ACCESS_KEY'],
+            os.environ['IMAGE_STORE_S3_SECRET_KEY']
+        )
+    else:
+        raise ValueError(f'Unknown IMAGE_STORE_BACKEND: {backend}')
+    return FallbackImageStore(store, imgbb) if imgbb.api_key else store
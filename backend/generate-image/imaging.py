@@ -0,0 +1,52 @@
+'''
+Input photo normalization before it is published for NanoBanana.
+Decodes the photo, applies the EXIF orientation, downscales to the size the
+model needs (same 800 px cap as the web UI canvas), drops EXIF and other
+metadata and re-encodes as JPEG within a byte budget.
+Pillow is imported on the first call, not when the module loads.
+'''
+
+import io
+import os
+
+MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 800))
+TARGET_BYTES = int(os.environ.get('IMAGE_TARGET_BYTES', 200 * 1024))
+JPEG_QUALITIES = (90, 85, 80, 75, 70, 60, 50)
+
+
+def normalize_image(data: bytes, max_dimension: int = MAX_DIMENSION, target_bytes: int = TARGET_BYTES) -> bytes:
+    '''
+    Returns JPEG bytes no larger than max_dimension on either side and,
+    where the quality ladder allows, no larger than target_bytes.
+    Photos that are already small enough JPEGs without EXIF are returned as-is.
+    Raises OSError (PIL.UnidentifiedImageError) for data Pillow cannot decode.
+    '''
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+
+    if (
+        image.format == 'JPEG'
+        and max(image.size) <= max_dimension
+        and len(data) <= target_bytes
+        and 'exif' not in image.info
+    ):
+        return data
+
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode != 'RGB':
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel('A'))
+
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    encoded = b''
+    for quality in JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+        encoded = buffer.getvalue()
+        if len(encoded) <= target_bytes:
+            break
+    return encoded
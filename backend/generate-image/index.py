@@ -1,74 +1,110 @@
 '''
 Business: Generate AI greeting cards using NanoBanana API
-Args: event with POST body containing prompt; context with request_id
-Returns: HTTP response with generated image URL
-Force redeploy fix
+Args: event with POST body containing imageBase64 (or telegramFileId, which is
+      downloaded here with TELEGRAM_BOT_TOKEN), customText, optional style
+      (a prompts.styles() name, ?styles=1 lists them), optional mode
+      ('submit' returns the taskId right away, 'sync' blocks until the card is ready)
+      and optional noCache (skip the photo+prompt result cache);
+      batch mode: items (list of {imageBase64 | telegramFileId, customText, style}) or
+      variants (list of customText for the top-level photo), up to BATCH_MAX_ITEMS;
+      or GET with ?taskId=...&wait=<seconds> to fetch task status,
+      ?taskIds=a,b,c&wait=<seconds> to wait until any of several tasks finishes,
+      ?image=<sha256>&expires=...&sig=... for a stored input photo (signed
+      URLs from image_store, with ETag, If-None-Match and Range support)
+      (?pollStats=1 returns the poll scheduler parameters, ?upstreamStats=1 the
+      upstream limiter and circuit breaker state, ?metrics=1 per-stage timing
+      histograms, ?queueStats=1 the generation queue); POST ?callback=<CALLBACK_SECRET>
+      receives NanoBanana completion callbacks; the bot identifies its user with
+      client ({id, tier}) and X-Internal-Token; an optional X-Deadline header
+      (unix time) by which the caller needs the answer; context with request_id
+      and get_remaining_time_in_millis
+Returns: HTTP response with taskId and status (plus inputHash, the photo's
+         sha256, when a photo was given), or generated image URL
+         (batch: tasks list with index, status, taskId and imageUrl per item);
+         a generation still waiting in the queue has a queue ticket as taskId
+         and a queuePosition; a sync request that runs out of time answers
+         202 with the taskId and resumable: true, to be polled with ?taskId=
 '''
 
+import base64
+import binascii
+import hashlib
 import json
 import os
 import time
-import requests
-from typing import Dict, Any
-
-DEFAULT_PROMPT = """
-Create an absolutely insane, over-the-top, maximalist greeting card in the style of 'Russian grandmother WhatsApp cards' or 'Eastern European tacky greeting cards'.
-
-Your MAIN TASK: Carefully extract the main character from the provided photo (completely ignoring their background) and place them in the CENTER of this chaotic greeting card scene. The character must become an organic part of the scene, NOT just pasted in a frame. NO photo frames around the character! The effect should be eye-burning, humorous, and pushed to complete absurdity.
-
-Study the aesthetic of such cards: it's visual cacophony where incompatible elements collide in the most garish way possible.
-
-**MANDATORY STYLE REQUIREMENTS:**
-
-1. **Background:** NO simple backgrounds! Use screaming, clashing gradients (acid green with hot pink, neon purple with golden yellow) OR seamless patterns of roses, daisies, or other flowers. The background must be SATURATED and AGGRESSIVE.
-
-2. **Decorative Elements (ADD AS MANY AS POSSIBLE!):**
-   * **Flowers:** MUST include bouquets or branches of red roses with unnatural glossy shine and sparkle effects
-   * **Glitter and shine:** The ENTIRE image must be covered with glitter, sparkles, stars, and lens flare effects. Create the feeling that the card is glowing and shimmering from every angle
-   * **Luxury symbols (inappropriately placed):** Gold pocket watches, gift baskets with cognac and chocolates, scattered dollar bills, gold coins, champagne bottles, luxury cars in the background
-   * **Cute elements:** Doves, butterflies, cherubs/angels, hearts (all with excessive shine)
-   * **KITTENS AND PUPPIES (MANDATORY!):** Add adorable kittens and puppies with huge sparkling eyes, fluffy fur with glow effects. They should be scattered throughout the composition, looking overly cute and unrealistic
-   * **Religious symbols:** Crosses with golden glow, church domes, candles
-   * **Nature overkill:** Rainbows, sunbeams, falling petals, swans
-
-3. **Border:** NO frame around the character! Instead, add an ornate border around the ENTIRE card edges - elaborate floral patterns, golden baroque ornaments, or pearl strings.
-
-4. **Text (CRUCIAL ELEMENT):**
-   * **Font style:** Complex, handwritten, cursive, calligraphic fonts
-   * **Font decoration:** Text must be BRIGHT: gold, rainbow, or gradient. MANDATORY thick outer stroke (white or contrasting color) and heavy drop shadow. Text must look 3D, embossed, and shiny
-   * **LANGUAGE: ALL TEXT MUST BE IN RUSSIAN!**
-   * **Content:** Choose ONE phrase from this list OR create your own in similar style:
-     
-     - "Счастья, здоровья, всех благ!"
-     - "Благослови тебя Господь!"
-     - "Пусть ангел-хранитель всегда будет рядом!"
-     - "Мира и добра вашему дому!"
-     - "Доброго утра! Пусть день сложится удачно!"
-     - "Любви и тепла!"
-     - "Поздравляю от всей души!"
-     - "Пусть сбудутся все мечты!"
-     - "Здоровья крепкого и счастья!"
-     - "С Божьей помощью всё получится!"
-     - "Радости и благополучия!"
-     - "Пусть в душе всегда цветёт весна!"
-     
-   * Feel free to ADD MORE similar overly-sentimental phrases in Russian if it fits the composition!
-
-5. **Overall atmosphere:** MAXIMUM KITSCH. Combination of the incompatible. Complete visual overload. The goal is to create something SO tasteless that it becomes hilarious and endearing. Think: "My eyes are bleeding but I can't look away."
-
-**TECHNICAL DETAILS:**
-- Extremely high saturation
-- Multiple light sources creating chaos
-- Layering of transparent elements
-- Glossy, plastic-like finish on everything
-- Chromatic aberration and glow effects
-- More is MORE - if you think it's too much, add MORE
-
-Make it look like it was created by someone who just discovered Photoshop's every filter and effect and decided to use ALL of them at once.
-"""
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple
+
+import callbacks
+import deadline
+import image_store
+import prompts
+import scheduler
+import tracing
+from http_client import get_session, connection_stats
+from imaging import normalize_image
+from polling import PollScheduler
+from result_cache import TASKS, ResultCache, cache_key, make_result_cache
+from tracing import span
+from deadline import DeadlineExceeded
+from events import header
+from upstream import Upstream, UpstreamUnavailable
+
+if TYPE_CHECKING:
+    import requests
+
+NANOBANANA = Upstream.from_env('nanobanana', 'NANOBANANA', 'https://api.nanobananaapi.ai', rate=5, burst=10, max_concurrency=4)
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+
+SYNC_TIMEOUT = 360
+# How often a request waiting for queued generations tries to dispatch them
+QUEUE_POLL_INTERVAL = 1.0
+# How long a sync batch with queued items waits on its submitted tasks between dispatch tries
+BATCH_QUEUE_STEP = 5.0
+MAX_STATUS_WAIT = 25
+MAX_TRACKED_TASKS = 1000
+
+# Items of one batch are prepared, submitted and polled in parallel
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 4))
+EXECUTOR = ThreadPoolExecutor(max_workers=BATCH_MAX_ITEMS, thread_name_prefix='generate')
+
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+POLL_SCHEDULER = PollScheduler.from_env()
+RESULT_CACHE = make_result_cache()
+# taskId -> result cache key, for tasks submitted with one until they finish
+TASK_RESULT_KEYS = make_result_cache(TASKS)
+IMAGE_STORE = image_store.make_image_store()
+
+# taskId -> time.monotonic() at submit, for tasks submitted by this (warm) instance
+SUBMITTED_AT: 'OrderedDict[str, float]' = OrderedDict()
 
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    trace = tracing.start(context.request_id)
+    deadline.start(event, context)
+    try:
+        response = handle_request(event, context)
+    except UpstreamUnavailable as e:
+        print(f"Upstream unavailable: {e}")
+        response = unavailable_response(e)
+    except DeadlineExceeded as e:
+        print(f"Deadline exceeded before the generation was submitted: {e}")
+        response = json_response(504, {'error': 'Deadline exceeded', 'message': str(e)})
+    except Exception as e:
+        # a failure nothing below expected still gets a JSON answer, not a crashed invocation
+        print(f"Unhandled error: {type(e).__name__}: {e}")
+        traceback.print_exc()
+        response = json_response(500, {'error': 'Internal error', 'requestId': context.request_id})
+    tracing.finish(trace, method=event.get('httpMethod'), statusCode=response['statusCode'])
+    print(f"HTTP connections: {json.dumps(connection_stats())}")
+    return response
+
+
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -83,85 +119,685 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': ''
         }
     
+    query = event.get('queryStringParameters') or {}
+    
+    if method == 'GET' and query.get('pollStats'):
+        return json_response(200, dict(POLL_SCHEDULER.params(), callbacks=dict(callbacks.stats, enabled=callbacks.enabled())))
+    
+    if method == 'GET' and query.get('metrics'):
+        return json_response(200, tracing.snapshot())
+    
+    if method == 'GET' and query.get('upstreamStats'):
+        return json_response(200, {'nanobanana': NANOBANANA.stats(), 'imgbb': image_store.IMGBB.stats()})
+    
+    if method == 'GET' and query.get('queueStats'):
+        return json_response(200, scheduler.queue_stats())
+    
+    if method == 'GET' and query.get('styles'):
+        return json_response(200, {'styles': sorted(prompts.styles()), 'default': prompts.DEFAULT_STYLE})
+    
+    if method in ('GET', 'HEAD') and query.get('image'):
+        return handle_image(event, query)
+    
+    if method == 'GET' and query.get('taskId'):
+        api_key = os.environ.get('NANOBANANA_API_KEY')
+        if not api_key:
+            return json_response(500, {'error': 'API key not configured'})
+        return handle_status(api_key, query['taskId'], query.get('wait'), context)
+    
+    if method == 'GET' and query.get('taskIds'):
+        api_key = os.environ.get('NANOBANANA_API_KEY')
+        if not api_key:
+            return json_response(500, {'error': 'API key not configured'})
+        return handle_batch_status(api_key, query['taskIds'], query.get('wait'), context)
+    
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
-    api_key = os.environ.get('NANOBANANA_API_KEY')
-    print(f"API key present: {bool(api_key)}")
+    if 'callback' in query:
+        return handle_callback(query['callback'], event.get('body'))
     
+    api_key = os.environ.get('NANOBANANA_API_KEY')
     if not api_key:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'API key not configured'})
-        }
+        return json_response(500, {'error': 'API key not configured'})
     
-    imgbb_key = os.environ.get('IMGBB_API_KEY')
-    if not imgbb_key:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'ImgBB API key not configured'})
-        }
+    store_error = IMAGE_STORE.config_error()
+    if store_error:
+        return json_response(500, {'error': store_error})
+    
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return json_response(400, {'error': 'Request body is not valid JSON'})
+    if not isinstance(body_data, dict):
+        return json_response(400, {'error': 'Request body must be a JSON object'})
+    mode = body_data.get('mode', 'submit')
+    
+    if mode not in ('submit', 'sync'):
+        return json_response(400, {'error': f'Unknown mode: {mode}'})
+    
+    client = scheduler.client_of(event, body_data)
+    
+    if 'items' in body_data or 'variants' in body_data:
+        return handle_batch(api_key, body_data, mode, client, context)
     
-    body_data = json.loads(event.get('body', '{}'))
-    image_base64 = body_data.get('imageBase64')
     custom_text = body_data.get('customText', '')
+    try:
+        prompt = prompts.render(body_data.get('style', prompts.DEFAULT_STYLE), custom_text)
+    except ValueError as e:
+        return json_response(400, {'error': str(e)})
     
-    custom_prompt = DEFAULT_PROMPT
-    if custom_text:
-        custom_prompt = custom_prompt.replace(
-            '- "Счастья, здоровья, всех благ!"',
-            f'- "{custom_text}"'
-        )
-        custom_prompt += f'\n\nIMPORTANT: The main text on the card MUST be: "{custom_text}"'
+    image_bytes, error_response = load_image(body_data)
+    if error_response:
+        return error_response
+    
+    status, error_response = start_generation(
+        api_key, image_bytes, prompt, not body_data.get('noCache'), client
+    )
+    del image_bytes
+    if error_response:
+        return error_response
+    
+    if status['status'] == 'success':
+        return json_response(200, {
+            'success': True,
+            'status': 'success',
+            'imageUrl': status['imageUrl'],
+            'taskId': status.get('taskId'),
+            'cached': True,
+            'inputHash': status.get('inputHash'),
+            'requestId': context.request_id
+        })
     
-    print(f"Using custom text: {custom_text}")
-    print(f"Image provided: {bool(image_base64)}")
+    task_id = status['taskId']
+    
+    if mode == 'submit':
+        print(f"Got task ID: {task_id}, returning to client")
+        body = {
+            'success': True,
+            'status': 'pending',
+            'taskId': task_id,
+            'inputHash': status.get('inputHash'),
+            'requestId': context.request_id
+        }
+        if status.get('queued'):
+            body['queuePosition'] = status['queuePosition']
+        return json_response(202, body)
+    
+    print(f"Got task ID: {task_id}, polling for result...")
+    
+    budget = deadline.budget(SYNC_TIMEOUT)
+    try:
+        status = wait_for_task(api_key, task_id, budget)
+    except UpstreamUnavailable as e:
+        return unavailable_response(e, task_id)
+    
+    if status['status'] == 'success':
+        return task_response(status, context)
+    
+    if status['status'] == 'failed':
+        return task_response(status, context)
+    
+    if budget < SYNC_TIMEOUT:
+        # the invocation is about to end, not the generation: the client resumes it
+        print(f"Deadline reached while waiting for {task_id}, returning it as resumable")
+        return task_response(status, context, resumable=True)
+    
+    return json_response(408, {
+        'error': 'Generation timeout',
+        'message': 'Image generation took too long',
+        'taskId': task_id
+    })
+
+
+def handle_status(api_key: str, task_id: str, wait: Optional[str], context: Any) -> Dict[str, Any]:
+    '''
+    Status/result mode: one record-info check, or a long-poll of up to
+    MAX_STATUS_WAIT seconds when the client passes ?wait=<seconds>.
+    '''
+    wait_seconds = parse_wait(wait)
+    if wait_seconds is None:
+        return json_response(400, {'error': 'wait must be an integer number of seconds'})
+    
+    try:
+        status = wait_for_task(api_key, task_id, deadline.budget(wait_seconds))
+    except UpstreamUnavailable as e:
+        return unavailable_response(e, task_id)
+    return task_response(status, context)
+
+
+def handle_batch_status(api_key: str, task_ids_param: str, wait: Optional[str], context: Any) -> Dict[str, Any]:
+    '''
+    Batch status mode: returns as soon as any of the listed tasks finishes
+    (or after ?wait=<seconds>), so a client streams a batch by asking again
+    with the taskIds that are still pending.
+    '''
+    task_ids = [task_id.strip() for task_id in task_ids_param.split(',') if task_id.strip()]
+    if len(task_ids) > BATCH_MAX_ITEMS:
+        return json_response(400, {'error': f'At most {BATCH_MAX_ITEMS} taskIds per request'})
     
-    image_url = None
+    wait_seconds = parse_wait(wait)
+    if wait_seconds is None:
+        return json_response(400, {'error': 'wait must be an integer number of seconds'})
+    
+    statuses = wait_for_tasks(api_key, task_ids, deadline.budget(wait_seconds), first_completed=True)
+    return batch_response([statuses[task_id] for task_id in task_ids], context)
+
+
+def handle_callback(secret: str, body: Optional[str]) -> Dict[str, Any]:
+    '''
+    NanoBanana calls back here when a task finishes: the status is stored in
+    task_results, which wakes every request waiting for the task.
+    '''
+    if not callbacks.verify(secret or ''):
+        callbacks.stats['rejected'] += 1
+        return json_response(403, {'error': 'Forbidden'})
+    
+    try:
+        status = callbacks.parse(json.loads(body or '{}'))
+    except ValueError:
+        status = None
+    if not status:
+        callbacks.stats['rejected'] += 1
+        return json_response(400, {'error': 'Unrecognized callback'})
+    
+    callbacks.stats['received'] += 1
+    print(f"Callback for task {status['taskId']}: {status['status']}")
+    if callbacks.record(status, 'callback'):
+        if scheduler.enabled():
+            scheduler.release(status['taskId'])
+        if status['status'] == 'success':
+            remember_result(status)
+    return json_response(200, {'success': True})
+
+
+def handle_image(event: Dict[str, Any], query: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Serves a stored input photo to whoever holds its signed URL (NanoBanana).
+    The sha256 is a strong ETag: If-None-Match answers 304, and a single
+    Range (honoured only while If-Range, if sent, still matches) answers 206.
+    '''
+    image_hash = query.get('image', '')
+    if not image_store.verify(image_hash, query.get('expires'), query.get('sig')):
+        return json_response(403, {'error': 'Invalid or expired image URL'})
+    
+    etag = f'"{image_hash}"'
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f"private, max-age={max(0, int(query['expires']) - int(time.time()))}, immutable",
+        'Access-Control-Allow-Origin': '*'
+    }
+    if_none_match = header(event, 'If-None-Match')
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    
+    with span('image_store.get'):
+        data = IMAGE_STORE.get(image_hash)
+    if data is None:
+        return json_response(404, {'error': 'Image not found'})
+    
+    size = len(data)
+    headers['Content-Type'] = image_store.content_type(data)
+    status_code = 200
+    range_header = header(event, 'Range')
+    if_range = header(event, 'If-Range')
+    selected = image_store.byte_range(range_header, size) if range_header and if_range in ('', etag) else None
+    if selected is not None:
+        first, last = selected
+        if first > last:
+            headers['Content-Range'] = f'bytes */{size}'
+            return {'statusCode': 416, 'headers': headers, 'body': ''}
+        data = data[first:last + 1]
+        headers['Content-Range'] = f'bytes {first}-{last}/{size}'
+        status_code = 206
+    
+    headers['Content-Length'] = str(len(data))
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'isBase64Encoded': True,
+        'body': base64.b64encode(data).decode('ascii') if event.get('httpMethod') != 'HEAD' else ''
+    }
+
+
+def handle_batch(
+    api_key: str,
+    body_data: Dict[str, Any],
+    mode: str,
+    client: Dict[str, Any],
+    context: Any
+) -> Dict[str, Any]:
+    '''
+    Batch mode: every item becomes its own NanoBanana task. Items are prepared
+    and submitted in parallel; 'sync' then waits for all of them on one poll
+    schedule, 'submit' returns the taskIds for GET ?taskIds=...&wait=<seconds>.
+    Items without a photo of their own use the top-level one.
+    '''
+    items = body_data.get('items')
+    if items is None:
+        items = [{'customText': text} for text in body_data.get('variants') or []]
+    
+    if not isinstance(items, list) or not items:
+        return json_response(400, {'error': 'items must be a non-empty list'})
+    if len(items) > BATCH_MAX_ITEMS:
+        return json_response(400, {'error': f'At most {BATCH_MAX_ITEMS} items per batch'})
+    
+    shared_image, error_response = load_image(body_data)
+    if error_response:
+        return error_response
+    
+    default_text = body_data.get('customText', '')
+    default_style = body_data.get('style', prompts.DEFAULT_STYLE)
+    use_cache = not body_data.get('noCache')
+    print(f"Batch of {len(items)} items, mode {mode}")
+    
+    # variants of one photo share a single upload
+    shared_url = None
+    if shared_image and sum(1 for item in items if not has_own_image(item)) > 1:
+        shared_url = upload_image(shared_image, hashlib.sha256(shared_image).hexdigest())
+    
+    def start_item(item: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = prompts.render(item.get('style', default_style), item.get('customText', default_text))
+        image_bytes, image_url, error_response = shared_image, shared_url, None
+        if has_own_image(item):
+            image_url = None
+            image_bytes, error_response = load_image(item)
+        if not error_response:
+            status, error_response = start_generation(
+                api_key, image_bytes, prompt, use_cache, client, image_url
+            )
+        if error_response:
+            return {'status': 'failed', 'message': json.loads(error_response['body']).get('error')}
+        return status
+    
+    def start_item_safely(item: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return start_item(item)
+        except Exception as e:
+            print(f"Batch item error: {e}")
+            return {'status': 'failed', 'message': str(e)}
+    
+    statuses = list(EXECUTOR.map(tracing.bind(start_item_safely), items))
+    
+    if mode == 'sync':
+        pending = [status['taskId'] for status in statuses if status['status'] == 'pending']
+        try:
+            finished = wait_for_tasks(api_key, pending, deadline.budget(SYNC_TIMEOUT))
+        except UpstreamUnavailable as e:
+            # the tasks are submitted; the client can stream them with ?taskIds= later
+            print(f"Upstream unavailable while waiting for the batch: {e}")
+            finished = {task_id: {'status': 'pending', 'taskId': task_id} for task_id in pending}
+        statuses = [
+            finished[status['taskId']] if status['status'] == 'pending' else status
+            for status in statuses
+        ]
+    
+    return batch_response(statuses, context)
+
+
+def has_own_image(item: Dict[str, Any]) -> bool:
+    return bool(item.get('imageBase64') or item.get('telegramFileId'))
+
+
+def parse_wait(wait: Optional[str]) -> Optional[int]:
+    '''
+    ?wait=<seconds> clamped to 0..MAX_STATUS_WAIT; None if it is not a number.
+    '''
+    try:
+        return max(0, min(int(wait or 0), MAX_STATUS_WAIT))
+    except ValueError:
+        return None
+
+
+def json_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps(body)
+    }
+
+
+def unavailable_response(error: UpstreamUnavailable, task_id: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    503 with Retry-After; taskId is included when the task was already
+    submitted, so the client can keep polling it later.
+    '''
+    body = {'error': 'Upstream unavailable', 'message': str(error), 'retryAfter': error.retry_after}
+    if task_id:
+        body['taskId'] = task_id
+    response = json_response(503, body)
+    response['headers']['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def task_response(status: Dict[str, Any], context: Any, resumable: bool = False) -> Dict[str, Any]:
+    if status['status'] == 'success':
+        return json_response(200, {
+            'success': True,
+            'status': 'success',
+            'imageUrl': status['imageUrl'],
+            'taskId': status['taskId'],
+            'requestId': context.request_id
+        })
+    
+    if status['status'] == 'failed':
+        return json_response(500, {
+            'error': 'Generation failed',
+            'status': 'failed',
+            'message': status['message'],
+            'errorCode': status['errorCode'],
+            'taskId': status['taskId']
+        })
+    
+    body = {
+        'status': 'pending',
+        'taskId': status['taskId'],
+        'requestId': context.request_id
+    }
+    if status.get('queued'):
+        body['queuePosition'] = status['queuePosition']
+    if resumable:
+        body['resumable'] = True
+    return json_response(202, body)
+
+
+def batch_response(statuses: List[Dict[str, Any]], context: Any) -> Dict[str, Any]:
+    pending = sum(1 for status in statuses if status['status'] == 'pending')
+    return json_response(202 if pending else 200, {
+        'success': True,
+        'status': 'pending' if pending else 'done',
+        'pending': pending,
+        'tasks': [dict(status, index=index) for index, status in enumerate(statuses)],
+        'requestId': context.request_id
+    })
+
+
+def load_image(body_data: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[Dict[str, Any]]]:
+    '''
+    Photo bytes from telegramFileId or imageBase64 (popped from body_data so
+    the base64 string can be freed). Returns (bytes or None, None) or
+    (None, error HTTP response).
+    '''
+    image_base64 = body_data.pop('imageBase64', None)
+    telegram_file_id = body_data.get('telegramFileId')
+    
+    if telegram_file_id:
+        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+        if not bot_token:
+            return None, json_response(500, {'error': 'Telegram bot token not configured'})
+        image_bytes = download_telegram_file(bot_token, telegram_file_id)
+        if image_bytes is None:
+            return None, json_response(400, {'error': 'Could not download Telegram file'})
+        return image_bytes, None
     
     if image_base64:
-        print("Uploading image to ImgBB...")
-        
-        image_data = image_base64.split(',')[1] if ',' in image_base64 else image_base64
-        
-        imgbb_response = requests.post(
-            f'https://api.imgbb.com/1/upload?key={imgbb_key}',
-            data={'image': image_data},
-            timeout=30
-        )
-        
-        if imgbb_response.status_code == 200:
-            imgbb_result = imgbb_response.json()
-            if imgbb_result.get('success'):
-                image_url = imgbb_result['data']['url']
-                print(f"Image uploaded successfully: {image_url}")
-            else:
-                print(f"ImgBB upload failed: {imgbb_result}")
-        else:
-            print(f"ImgBB upload error: {imgbb_response.status_code} - {imgbb_response.text}")
+        try:
+            return base64.b64decode(image_base64[image_base64.find(',') + 1:], validate=True), None
+        except (binascii.Error, ValueError):
+            return None, json_response(400, {'error': 'imageBase64 is not valid base64'})
+    
+    return None, None
+
+
+def start_generation(
+    api_key: str,
+    image_bytes: Optional[bytes],
+    prompt: str,
+    use_cache: bool,
+    client: Dict[str, Any],
+    image_url: Optional[str] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    '''
+    Answers from the result cache or stores the photo (unless image_url is
+    the already stored photo) and submits a task, through the generation
+    queue when it is on.
+    Returns (status, None) with status 'success' (cached) or 'pending'
+    (submitted, or queued: then taskId is a queue ticket and queuePosition
+    is set) and the photo's sha256 as inputHash, or (None, error HTTP response).
+    '''
+    import requests
+    
+    image_hash = None
+    result_key = None
+    
+    if image_bytes:
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        if use_cache:
+            result_key = cache_key(image_hash, prompt)
+    
+    if result_key:
+        cached = cache_get(RESULT_CACHE, result_key)
+        if cached:
+            print(f"Result cache hit: {result_key}")
+            return {
+                'status': 'success',
+                'imageUrl': cached['imageUrl'],
+                'taskId': cached.get('taskId'),
+                'cached': True,
+                'inputHash': image_hash
+            }, None
+    
+    if image_bytes and not image_url:
+        image_url = upload_image(image_bytes, image_hash)
+        if not image_url:
+            # without its URL NanoBanana would draw a card without the photo
+            return None, json_response(502, {'error': 'Could not store the photo'})
+    
+    queue_id = scheduler.enqueue(client, prompt, image_url, result_key, image_hash) if scheduler.enabled() else None
+    if queue_id is not None:
+        dispatch_queued(api_key)
+        ticket = scheduler.ticket(queue_id)
+        queued = scheduler.resolve([ticket])[ticket]
+        if queued['status'] == 'failed':
+            return None, json_response(500, {'error': 'API error', 'message': queued['message']})
+        if queued['status'] == 'queued':
+            print(f"Generation queued as {ticket} at position {queued['position']}")
+            return {
+                'status': 'pending',
+                'taskId': ticket,
+                'queued': True,
+                'queuePosition': queued['position'],
+                'inputHash': image_hash
+            }, None
+        return {'status': 'pending', 'taskId': queued['taskId'], 'inputHash': image_hash}, None
+    
+    try:
+        task_id, error_response = submit_task(api_key, prompt, image_url)
+    except requests.RequestException as e:
+        print(f"NanoBanana submit could not be sent: {e}")
+        return None, json_response(502, {'error': 'Generation service unreachable', 'message': str(e)})
+    if error_response:
+        return None, error_response
+    
+    track_task(task_id, result_key)
+    return {'status': 'pending', 'taskId': task_id, 'inputHash': image_hash}, None
+
+
+def track_task(task_id: str, result_key: Optional[str]) -> None:
+    '''
+    Bookkeeping for a freshly submitted task: its result cache key, its
+    task_results row and its submit time for the poll schedule.
+    '''
+    if result_key:
+        cache_put(TASK_RESULT_KEYS, task_id, {'resultKey': result_key})
+    
+    if callbacks.enabled():
+        callbacks.expect(task_id)
+    
+    SUBMITTED_AT[task_id] = time.monotonic()
+    while len(SUBMITTED_AT) > MAX_TRACKED_TASKS:
+        SUBMITTED_AT.popitem(last=False)
+
+
+def dispatch_queued(api_key: str) -> None:
+    '''
+    Submits queued generations, in fair-queue order, while slots are free.
+    Any request may dispatch anyone's entry; an entry whose submit could not
+    be sent goes back to its place and dispatching stops until the next try.
+    The photo URL is signed again here, as the one made at enqueue may have
+    expired while the entry waited. When no entry can be claimed, tasks
+    that hold slots without anyone watching them are checked (sweep_slots)
+    and the claim is tried again if that freed any.
+    '''
+    swept = False
+    while True:
+        entry = scheduler.claim()
+        if entry is None and not swept:
+            swept = True
+            if sweep_slots(api_key):
+                continue
+        if entry is None:
+            return
+        image_url = entry['imageUrl']
+        try:
+            if image_url and entry['imageHash']:
+                image_url = IMAGE_STORE.fresh_url(entry['imageHash'], image_url)
+            task_id, error_response = submit_task(api_key, entry['prompt'], image_url)
+        except Exception as e:
+            print(f"Queued generation {entry['id']} could not be submitted: {e}")
+            scheduler.requeue(entry['id'])
+            return
+        if error_response:
+            error = json.loads(error_response['body'])
+            scheduler.fail(entry['id'], error.get('message') or error.get('error') or 'Generation failed')
+            continue
+        scheduler.started(entry['id'], task_id)
+        track_task(task_id, entry['resultKey'])
+
+
+def sweep_slots(api_key: str) -> bool:
+    '''
+    Checks the queue tasks scheduler.sweep_due() picks (their clients may
+    have left) and frees the slots of those that finished. Returns True if
+    any slot was freed.
+    '''
+    freed = False
+    for task_id in scheduler.sweep_due():
+        try:
+            status = safe_check_task(api_key, task_id)
+        except UpstreamUnavailable as e:
+            print(f"Sweep stopped, upstream unavailable: {e}")
+            break
+        if not status or status['status'] == 'pending':
+            continue
+        print(f"Sweep found task {task_id} {status['status']}, releasing its slot")
+        if callbacks.enabled():
+            callbacks.record(status, 'poll')
+        scheduler.release(task_id)
+        if status['status'] == 'success':
+            remember_result(status)
+        SUBMITTED_AT.pop(task_id, None)
+        freed = True
+    return freed
+
+
+def cache_get(cache: ResultCache, key: str) -> Optional[Dict[str, Any]]:
+    try:
+        return cache.get(key)
+    except Exception as e:
+        print(f"Result cache read error: {e}")
+        return None
+
+
+def cache_put(cache: ResultCache, key: str, value: Dict[str, Any]) -> None:
+    try:
+        cache.put(key, value)
+    except Exception as e:
+        print(f"Result cache write error: {e}")
+
+
+def remember_result(status: Dict[str, Any]) -> None:
+    '''
+    Stores a finished generation under the result key recorded at submit.
+    '''
+    pending = cache_get(TASK_RESULT_KEYS, status['taskId'])
+    if pending:
+        cache_put(RESULT_CACHE, pending['resultKey'], {'imageUrl': status['imageUrl'], 'taskId': status['taskId']})
+
+
+def upload_image(image_bytes: bytes, image_hash: str) -> Optional[str]:
+    '''
+    Puts the normalized photo into IMAGE_STORE; returns the URL NanoBanana
+    fetches it from, or None when no store took it.
+    '''
+    try:
+        return IMAGE_STORE.put(image_hash, normalized_image(image_bytes))
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        print(f"Image store {IMAGE_STORE.name} error: {e}")
+        return None
+
+
+def download_telegram_file(bot_token: str, file_id: str) -> Optional[bytes]:
+    '''
+    Resolves a Telegram file_id and streams the file into memory
+    (at most MAX_DOWNLOAD_BYTES, the Bot API getFile limit).
+    '''
+    import requests
     
+    try:
+        with span('telegram.getFile'):
+            file_response = get_session().get(
+                f'{TELEGRAM_API_BASE}/bot{bot_token}/getFile',
+                params={'file_id': file_id},
+                timeout=deadline.timeout(10)
+            )
+            file_data = file_response.json()
+        if not file_data.get('ok'):
+            print(f"Telegram getFile failed: {file_data.get('description')}")
+            return None
+        
+        file_path = file_data['result']['file_path']
+        content = bytearray()
+        with span('telegram.download') as attrs:
+            file_url = f'{TELEGRAM_API_BASE}/file/bot{bot_token}/{file_path}'
+            with get_session().get(file_url, stream=True, timeout=deadline.timeout(30)) as download:
+                if download.status_code != 200:
+                    print(f"Telegram file download error: {download.status_code}")
+                    return None
+                for chunk in download.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    content += chunk
+                    if len(content) > MAX_DOWNLOAD_BYTES:
+                        print("Telegram file is too large")
+                        return None
+            attrs['bytes'] = len(content)
+        return bytes(content)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Telegram file download error: {e}")
+        return None
+
+
+def normalized_image(image_bytes: bytes) -> bytes:
+    '''
+    The downscaled, EXIF-free JPEG; the original bytes if Pillow can't read them.
+    '''
+    try:
+        with span('image.normalize'):
+            normalized = normalize_image(image_bytes)
+    except Exception as e:
+        print(f"Image normalization failed, storing original: {e}")
+        return image_bytes
+    print(f"Normalized image: {len(image_bytes)} -> {len(normalized)} bytes")
+    return normalized
+
+
+def submit_task(api_key: str, prompt: str, image_url: Optional[str]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    '''
+    Returns (taskId, None) on success or (None, error HTTP response).
+    '''
     headers = {
         'Authorization': f'Bearer {api_key}',
         'Content-Type': 'application/json'
     }
     
     payload = {
-        'prompt': custom_prompt,
+        'prompt': prompt,
         'numImages': 1,
         'type': 'TEXTTOIAMGE',
         'image_size': '1:1'
@@ -169,142 +805,275 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     if image_url:
         payload['imageUrls'] = [image_url]
-        print(f"Added image URL to payload: {image_url}")
-    
-    print(f"Sending request to NanoBanana API...")
     
-    response = requests.post(
-        'https://api.nanobananaapi.ai/api/v1/nanobanana/generate',
-        headers=headers,
-        json=payload,
-        timeout=60
-    )
+    callback_url = callbacks.callback_url()
+    if callback_url:
+        payload['callBackUrl'] = callback_url
     
-    print(f"Response status: {response.status_code}")
-    print(f"Response body: {response.text[:500]}")
+    # the signed image URL is a credential: only whether there is one goes into the span
+    with span('nanobanana.submit', withImage=bool(image_url)) as attrs:
+        response = NANOBANANA.request(
+            'POST',
+            '/api/v1/nanobanana/generate',
+            headers=headers,
+            json=payload,
+            timeout=deadline.timeout(60)
+        )
+        attrs['httpStatus'] = response.status_code
     
     if response.status_code != 200:
-        return {
-            'statusCode': response.status_code,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': 'Generation failed',
-                'details': response.text
-            })
-        }
+        print(f"NanoBanana submit failed: {response.status_code}")
+        return None, json_response(response.status_code, {
+            'error': 'Generation failed',
+            'details': response.text
+        })
     
     result = response.json()
-    print(f"Parsed result: {json.dumps(result)[:500]}")
     
     if result.get('code') != 200:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': 'API error',
-                'message': result.get('msg', 'Unknown error'),
-                'details': result
-            })
-        }
+        print(f"NanoBanana API error: {result.get('code')} {result.get('msg')}")
+        return None, json_response(500, {
+            'error': 'API error',
+            'message': result.get('msg', 'Unknown error'),
+            'details': result
+        })
     
     data = result.get('data', {})
     task_id = data.get('taskId')
     
     if not task_id:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': 'No task ID in response',
-                'details': result
-            })
-        }
-    
-    print(f"Got task ID: {task_id}, polling for result...")
-    
-    max_attempts = 90
-    poll_interval = 4
+        return None, json_response(500, {
+            'error': 'No task ID in response',
+            'details': result
+        })
     
-    for attempt in range(max_attempts):
-        time.sleep(poll_interval)
-        
-        print(f"Polling attempt {attempt + 1}/{max_attempts}")
-        
-        status_response = requests.get(
-            f'https://api.nanobananaapi.ai/api/v1/nanobanana/record-info?taskId={task_id}',
+    return task_id, None
+
+
+def check_task(api_key: str, task_id: str) -> Optional[Dict[str, Any]]:
+    '''
+    One record-info call. Returns a normalized status dict
+    ({'status': 'pending' | 'success' | 'failed', ...}) or None when
+    the status endpoint itself could not be read.
+    '''
+    with span('nanobanana.poll', taskId=task_id) as attrs:
+        status_response = NANOBANANA.request(
+            'GET',
+            '/api/v1/nanobanana/record-info',
+            params={'taskId': task_id},
             headers={'Authorization': f'Bearer {api_key}'},
-            timeout=10
+            timeout=deadline.timeout(10)
         )
-        
-        if status_response.status_code != 200:
-            print(f"Status check failed: {status_response.status_code}")
-            continue
-        
-        status_result = status_response.json()
-        print(f"Status result: {json.dumps(status_result)[:500]}")
-        
-        if status_result.get('code') != 200:
+        attrs['httpStatus'] = status_response.status_code
+        status = parse_task_status(task_id, status_response)
+        attrs['status'] = status['status'] if status else None
+    return status
+
+
+def parse_task_status(task_id: str, status_response: 'requests.Response') -> Optional[Dict[str, Any]]:
+    if status_response.status_code != 200:
+        print(f"Status check failed: {status_response.status_code}")
+        return None
+    
+    status_result = status_response.json()
+    
+    if status_result.get('code') != 200:
+        print(f"Status check error: {status_result.get('code')} {status_result.get('msg')}")
+        return None
+    
+    status_data = status_result.get('data', {})
+    
+    if status_data.get('successFlag') == 1:
+        image_url = status_data.get('response', {}).get('resultImageUrl')
+        if image_url:
+            print(f"Generation successful! Image URL: {image_url}")
+            return {'status': 'success', 'taskId': task_id, 'imageUrl': image_url}
+    
+    error_code = status_data.get('errorCode')
+    if error_code and error_code != 0:
+        error_message = status_data.get('errorMessage', 'Unknown error')
+        print(f"Generation failed with error: {error_message}")
+        return {'status': 'failed', 'taskId': task_id, 'message': error_message, 'errorCode': error_code}
+    
+    return {'status': 'pending', 'taskId': task_id}
+
+
+def wait_for_task(api_key: str, task_id: str, budget: float) -> Dict[str, Any]:
+    '''
+    Polls record-info on the POLL_SCHEDULER schedule for up to `budget`
+    seconds (a zero budget means a single immediate check).
+    Returns the last normalized status; 'pending' if the task never finished.
+    '''
+    return wait_for_tasks(api_key, [task_id], budget)[task_id]
+
+
+def wait_for_tasks(api_key: str, task_ids: List[str], budget: float, first_completed: bool = False) -> Dict[str, Dict[str, Any]]:
+    '''
+    wait_for_submitted for taskIds and queue tickets. A ticket is dispatched
+    (by this or any other request) when a slot frees up and then waited on
+    as its task; while it is still queued it is 'pending' with queued and
+    queuePosition. With first_completed the wait for tickets gives up its
+    turn to the tasks as soon as any of the ids has a task. Otherwise (a
+    sync batch) it goes on until every ticket has its task, waiting on the
+    tasks already submitted meanwhile: their finishing is what frees the
+    client's slots (CLIENT_CONCURRENCY) for the rest of the batch.
+    '''
+    tickets = [task_id for task_id in task_ids if scheduler.is_ticket(task_id)]
+    if not tickets:
+        return wait_for_submitted(api_key, task_ids, budget, first_completed)
+    
+    wait_until = time.monotonic() + budget
+    results: Dict[str, Dict[str, Any]] = {}
+    while True:
+        dispatch_queued(api_key)
+        resolved = scheduler.resolve(tickets)
+        queued = [ticket for ticket in tickets if resolved[ticket]['status'] == 'queued']
+        if not queued or (first_completed and len(queued) < len(task_ids)):
+            break
+        if time.monotonic() + QUEUE_POLL_INTERVAL > wait_until:
+            break
+        running = [
+            resolved[task_id]['taskId'] if task_id in resolved else task_id for task_id in task_ids
+            if resolved.get(task_id, {'status': 'submitted'})['status'] == 'submitted'
+        ]
+        running = [task_id for task_id in dict.fromkeys(running) if task_id not in results]
+        if first_completed or not running:
+            time.sleep(QUEUE_POLL_INTERVAL)
             continue
-        
-        status_data = status_result.get('data', {})
-        success_flag = status_data.get('successFlag')
-        
-        if success_flag == 1:
-            response_data = status_data.get('response', {})
-            image_url = response_data.get('resultImageUrl')
+        step = min(BATCH_QUEUE_STEP, max(0.0, wait_until - time.monotonic()))
+        statuses = wait_for_submitted(api_key, running, step, first_completed=True)
+        results.update({task_id: status for task_id, status in statuses.items() if status['status'] != 'pending'})
+    
+    submitted: Dict[str, str] = {}
+    for task_id in task_ids:
+        state = resolved.get(task_id)
+        if state is None or state['status'] == 'submitted':
+            submitted[task_id] = state['taskId'] if state else task_id
+        elif state['status'] == 'queued':
+            results[task_id] = {'status': 'pending', 'taskId': task_id, 'queued': True, 'queuePosition': state['position']}
+        else:
+            results[task_id] = {'status': 'failed', 'taskId': task_id, 'message': state['message'], 'errorCode': 500}
+    
+    finished = {real_id: results[real_id] for real_id in submitted.values() if real_id in results}
+    waiting = [real_id for real_id in dict.fromkeys(submitted.values()) if real_id not in finished]
+    if waiting and not (first_completed and any(status['status'] == 'failed' for status in results.values())):
+        finished.update(wait_for_submitted(api_key, waiting, max(0.0, wait_until - time.monotonic()), first_completed))
+    results.update({task_id: finished[real_id] for task_id, real_id in submitted.items() if real_id in finished})
+    
+    return {task_id: results.get(task_id, {'status': 'pending', 'taskId': task_id}) for task_id in task_ids}
+
+
+def wait_for_submitted(api_key: str, task_ids: List[str], budget: float, first_completed: bool = False) -> Dict[str, Dict[str, Any]]:
+    '''
+    wait_for_task for several tasks at once: every task keeps its own place
+    on the POLL_SCHEDULER schedule, and the checks that fall due together run
+    in parallel. Returns a status per taskId once all tasks finished, the
+    budget is spent or, with first_completed, as soon as any task finished.
+    Every task is checked at least once.
+    With callbacks on, tasks that have a task_results row are looked up
+    there instead: a callback wakes the wait right away, and record-info is
+    only polled as a fallback, CALLBACK_FALLBACK_INTERVAL after the task was
+    last heard of.
+    '''
+    started = time.monotonic()
+    wait_until = started + budget
+    results: Dict[str, Dict[str, Any]] = {}
+    attempts = {task_id: 0 for task_id in task_ids}
+    last_pending: Dict[str, float] = {}
+    tracked = set()
+    
+    def elapsed(task_id: str, now: float) -> Optional[float]:
+        submitted_at = SUBMITTED_AT.get(task_id)
+        return now - submitted_at if submitted_at is not None else None
+    
+    def finish(task_id: str, status: Dict[str, Any], done: Optional[float]) -> None:
+        if scheduler.enabled():
+            scheduler.release(task_id)
+        if status['status'] == 'success':
+            remember_result(status)
+        if status['status'] == 'success' and done is not None:
+            # the task finished somewhere between the last pending poll and this one
+            previous = last_pending.get(task_id)
+            POLL_SCHEDULER.record((previous + done) / 2 if previous is not None else done)
+        SUBMITTED_AT.pop(task_id, None)
+        results[task_id] = status
+    
+    def collect(recorded: Dict[str, Dict[str, Any]], notified: bool) -> None:
+        now = time.monotonic()
+        for task_id, status in recorded.items():
+            if task_id in results:
+                continue
+            tracked.add(task_id)
+            attempts[task_id] = max(attempts[task_id], 1)
+            if status['status'] == 'pending':
+                due[task_id] = now + max(0.0, callbacks.FALLBACK_INTERVAL - status['checkedAgo'])
+            else:
+                # a notification arrives right after the callback, so it dates the finish
+                finish(task_id, status, elapsed(task_id, now) if notified else None)
+    
+    due = {task_id: started + POLL_SCHEDULER.next_delay(elapsed(task_id, started), 0) for task_id in task_ids}
+    
+    waiter = None
+    if callbacks.enabled():
+        waiter = callbacks.LISTENER.subscribe(task_ids)
+        collect(callbacks.lookup(task_ids), False)
+    
+    try:
+        while True:
+            pending = [task_id for task_id in task_ids if task_id not in results]
+            if not pending or (first_completed and results):
+                break
             
-            if image_url:
-                print(f"Generation successful! Image URL: {image_url}")
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'isBase64Encoded': False,
-                    'body': json.dumps({
-                        'success': True,
-                        'imageUrl': image_url,
-                        'taskId': task_id,
-                        'requestId': context.request_id
-                    })
-                }
-        
-        error_code = status_data.get('errorCode')
-        if error_code and error_code != 0:
-            error_message = status_data.get('errorMessage', 'Unknown error')
-            print(f"Generation failed with error: {error_message}")
-            return {
-                'statusCode': 500,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'Generation failed',
-                    'message': error_message,
-                    'errorCode': error_code
-                })
-            }
+            now = time.monotonic()
+            wake = min(due[task_id] for task_id in pending)
+            unchecked = any(attempts[task_id] == 0 for task_id in pending)
+            if wake > wait_until and not unchecked and (waiter is None or now >= wait_until):
+                break
+            
+            timeout = max(0.0, min(wake, wait_until) - now)
+            if waiter is None:
+                time.sleep(timeout)
+            elif waiter.wait(timeout):
+                waiter.clear()
+                collect(callbacks.lookup(pending), True)
+                continue
+            
+            now = time.monotonic()
+            batch = [
+                task_id for task_id in pending
+                if due[task_id] <= now or (attempts[task_id] == 0 and now >= wait_until)
+            ]
+            
+            checks = EXECUTOR.map(tracing.bind(lambda task_id: safe_check_task(api_key, task_id)), batch)
+            for task_id, status in zip(batch, checks):
+                attempts[task_id] += 1
+                done = elapsed(task_id, time.monotonic())
+                
+                if status and status['status'] != 'pending':
+                    if task_id in tracked:
+                        callbacks.record(status, 'poll')
+                    finish(task_id, status, done)
+                    continue
+                
+                if status and done is not None:
+                    last_pending[task_id] = done
+                if task_id in tracked:
+                    callbacks.touch(task_id)
+                    due[task_id] = time.monotonic() + callbacks.FALLBACK_INTERVAL
+                else:
+                    due[task_id] = time.monotonic() + POLL_SCHEDULER.next_delay(done, attempts[task_id])
+    finally:
+        if waiter is not None:
+            callbacks.LISTENER.unsubscribe(task_ids, waiter)
     
-    return {
-        'statusCode': 408,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'error': 'Generation timeout',
-            'message': 'Image generation took too long',
-            'taskId': task_id
-        })
-    }
\ No newline at end of file
+    return {task_id: results.get(task_id, {'status': 'pending', 'taskId': task_id}) for task_id in task_ids}
+
+
+def safe_check_task(api_key: str, task_id: str) -> Optional[Dict[str, Any]]:
+    import requests
+    
+    try:
+        return check_task(api_key, task_id)
+    except (requests.RequestException, DeadlineExceeded) as e:
+        print(f"Status check error: {e}")
+        return None
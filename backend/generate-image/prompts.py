@@ -0,0 +1,95 @@
+'''
+Card prompt templates.
+Every style is a template with {caption} (the user's text, or the style's
+default phrase) and {caption_rule} (the extra instruction added only for a
+user's text) placeholders; literal braces are written as {{ and }}.
+Templates are read from templates/<style>.txt (byte for byte: the default one
+starts with a newline and has none at the end) and parsed on first use;
+rendered prompts are cached, so the same style and caption always give the
+same prompt string (and result cache key). Extra styles are loaded from
+PROMPT_TEMPLATES_DIR/<style>.txt when it is set.
+'''
+
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from string import Formatter
+from typing import Dict, List, Tuple
+
+DEFAULT_STYLE = 'default'
+CAPTION_MAX_LENGTH = 200
+FIELDS = ('caption', 'caption_rule')
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+CAPTION_RULE = '\n\nIMPORTANT: The main text on the card MUST be: "{caption}"'
+
+QUOTE_PAIR = re.compile(r'["“”„]([^"“”„]*)["“”„]')
+QUOTE = re.compile(r'["“”„]')
+
+
+class PromptTemplate:
+    def __init__(self, name: str, text: str, default_caption: str = 'Счастья, здоровья, всех благ!'):
+        self.name = name
+        self.default_caption = default_caption
+        self.parts: List[Tuple[str, str]] = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if field is not None and (field not in FIELDS or spec or conversion):
+                raise ValueError(f'Unknown placeholder {{{field}}} in prompt style {name}')
+            self.parts.append((literal, field or ''))
+
+    def render(self, caption: str) -> str:
+        values = {
+            'caption': caption or self.default_caption,
+            'caption_rule': CAPTION_RULE.format(caption=caption) if caption else ''
+        }
+        return ''.join(literal + values.get(field, '') for literal, field in self.parts)
+
+
+@lru_cache(maxsize=None)
+def styles() -> Dict[str, PromptTemplate]:
+    '''
+    Every style by name: the bundled templates, then PROMPT_TEMPLATES_DIR's.
+    '''
+    loaded: Dict[str, PromptTemplate] = {}
+    for templates_dir in (TEMPLATES_DIR, os.environ.get('PROMPT_TEMPLATES_DIR')):
+        if templates_dir and os.path.isdir(templates_dir):
+            for file_name in sorted(os.listdir(templates_dir)):
+                name, ext = os.path.splitext(file_name)
+                if ext == '.txt':
+                    with open(os.path.join(templates_dir, file_name), 'r', encoding='utf-8') as f:
+                        loaded[name] = PromptTemplate(name, f.read())
+    return loaded
+
+
+def clean_caption(text: str) -> str:
+    '''
+    Single-line caption that can't break out of the quotes around it in the
+    prompt: control characters dropped, whitespace collapsed, paired quotes
+    turned into «guillemets» and stray ones into apostrophes.
+    Raises ValueError when it is longer than CAPTION_MAX_LENGTH.
+    '''
+    text = ''.join(ch for ch in text if not unicodedata.category(ch).startswith('C') or ch.isspace())
+    text = ' '.join(text.split())
+    text = QUOTE.sub("'", QUOTE_PAIR.sub(r'«\1»', text))
+    if len(text) > CAPTION_MAX_LENGTH:
+        raise ValueError(f'customText is longer than {CAPTION_MAX_LENGTH} characters')
+    return text
+
+
+def render(style: str, custom_text: str = '') -> str:
+    '''
+    Prompt for a style and a raw user caption.
+    Raises ValueError for an unknown style or an invalid caption.
+    '''
+    if not isinstance(style, str) or not isinstance(custom_text, str):
+        raise ValueError('style and customText must be strings')
+    return render_cached(style or DEFAULT_STYLE, custom_text)
+
+
+@lru_cache(maxsize=256)
+def render_cached(style: str, custom_text: str) -> str:
+    template = styles().get(style)
+    if template is None:
+        raise ValueError(f'Unknown style: {style}')
+    return template.render(clean_caption(custom_text))
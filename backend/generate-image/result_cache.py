@@ -0,0 +1,202 @@
+'''
+Content-addressed cache of finished generations.
+Key: sha256 over the input photo hash + the final rendered prompt.
+Value: small JSON dict ({'imageUrl': ..., 'taskId': ...}).
+Backends (RESULT_CACHE_BACKEND): memory (default), file, postgres, none.
+All of them expire entries after a TTL and evict least recently used
+(file: least recently written) entries beyond a size bound.
+Each namespace is bounded on its own: the TASKS namespace holds the result
+key of every submitted task until it finishes, so a burst of submits does
+not push finished cards out of RESULTS.
+'''
+
+import fcntl
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+import db
+
+RESULTS = 'result'
+TASKS = 'task'
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+# A task's result key is only needed until the task finishes
+DEFAULT_TASK_TTL = 60 * 60
+
+# Share of Postgres puts that also trim the namespace to its size bound
+TRIM_PROBABILITY = 0.02
+
+TRIM_SQL = '''
+    DELETE FROM result_cache
+    WHERE namespace = %(namespace)s AND (expires_at <= CURRENT_TIMESTAMP OR cache_key IN (
+        SELECT cache_key FROM result_cache WHERE namespace = %(namespace)s
+        ORDER BY last_used_at DESC OFFSET %(max_entries)s
+    ))
+'''
+
+
+def cache_key(image_hash: str, prompt: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(image_hash.encode('ascii'))
+    digest.update(prompt.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES, namespace: str = RESULTS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        pass
+
+
+class MemoryResultCache(ResultCache):
+    '''
+    Per-instance LRU; survives only as long as the warm function instance.
+    '''
+
+    def __init__(self, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES, namespace: str = RESULTS):
+        super().__init__(ttl, max_entries, namespace)
+        self.entries: 'OrderedDict[str, Any]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class FileResultCache(ResultCache):
+    '''
+    JSON file on local disk, shared by invocations that see the same filesystem.
+    Reads leave the file alone; a put rewrites it under an exclusive lock on
+    <path>.lock and swaps it in atomically, so concurrent writers neither
+    lose each other's entries nor leave a torn file for readers.
+    '''
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 namespace: str = RESULTS):
+        super().__init__(ttl, max_entries, namespace)
+        self.path = path
+
+    def _load(self) -> 'OrderedDict[str, Any]':
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            return OrderedDict()
+
+    def _save(self, entries: 'OrderedDict[str, Any]') -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(list(entries.items()), f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._load().get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            entries = OrderedDict(
+                (k, entry) for k, entry in self._load().items() if entry[0] >= now
+            )
+            entries[key] = (now + self.ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._save(entries)
+
+
+class PostgresResultCache(ResultCache):
+    '''
+    result_cache table (see db_migrations); shared by all instances.
+    Expired and least recently used rows beyond max_entries are trimmed on
+    a TRIM_PROBABILITY share of puts, so the bound is approximate.
+    '''
+
+    def _cursor(self):
+        return db.get_connection().cursor()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._cursor() as cur:
+            cur.execute(
+                "UPDATE result_cache SET last_used_at = CURRENT_TIMESTAMP "
+                "WHERE namespace = %s AND cache_key = %s AND expires_at > CURRENT_TIMESTAMP RETURNING value",
+                (self.namespace, key)
+            )
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        with self._cursor() as cur:
+            cur.execute(
+                "INSERT INTO result_cache (namespace, cache_key, value, expires_at) "
+                "VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) "
+                "ON CONFLICT (namespace, cache_key) DO UPDATE SET value = EXCLUDED.value, "
+                "expires_at = EXCLUDED.expires_at, last_used_at = CURRENT_TIMESTAMP",
+                (self.namespace, key, json.dumps(value), self.ttl)
+            )
+            if random.random() < TRIM_PROBABILITY:
+                cur.execute(TRIM_SQL, {'namespace': self.namespace, 'max_entries': self.max_entries})
+
+
+def make_result_cache(namespace: str = RESULTS) -> ResultCache:
+    '''
+    The RESULT_CACHE_BACKEND cache for RESULTS (RESULT_CACHE_TTL,
+    RESULT_CACHE_MAX_ENTRIES) or TASKS (RESULT_CACHE_TASK_TTL,
+    RESULT_CACHE_MAX_TASKS); an unknown backend falls back to 'none'.
+    '''
+    backend = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+    if namespace == TASKS:
+        ttl = int(os.environ.get('RESULT_CACHE_TASK_TTL', DEFAULT_TASK_TTL))
+        max_entries = int(os.environ.get('RESULT_CACHE_MAX_TASKS', DEFAULT_MAX_ENTRIES))
+    else:
+        ttl = int(os.environ.get('RESULT_CACHE_TTL', DEFAULT_TTL))
+        max_entries = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+
+    if backend == 'memory':
+        return MemoryResultCache(ttl, max_entries, namespace)
+    if backend == 'file':
+        path = os.environ.get('RESULT_CACHE_PATH', '/tmp/generate-image-result-cache.json')
+        if namespace != RESULTS:
+            root, ext = os.path.splitext(path)
+            path = f'{root}-{namespace}{ext}'
+        return FileResultCache(path, ttl, max_entries, namespace)
+    if backend == 'postgres':
+        return PostgresResultCache(ttl, max_entries, namespace)
+    if backend != 'none':
+        # the cache is optional: a typo must not take the function down with it
+        print(f"Unknown RESULT_CACHE_BACKEND {backend!r}, caching nothing")
+    return ResultCache(ttl, max_entries, namespace)
@@ -0,0 +1,417 @@
+'''
+Weighted fair queue in front of the NanoBanana submit (generation_queue and
+generation_slots tables), shared by all instances.
+Every generation is queued under its client: a bot user ('tg:<user id>',
+trusted only on requests carrying X-Internal-Token) or a web UI visitor
+('web:<source ip>'). A new entry gets the finish tag
+max(virtual time, the client's last tag) + 1 / weight, where the virtual time
+is the smallest tag still queued and the weight comes from the client's tier
+(tiers.weight, 1 for the web UI), and entries are dispatched in tag order.
+A client that floods the queue only pushes back its own entries; a light
+client lands near the head. At most GENERATION_CONCURRENCY tasks run at once
+(one generation_slots row each) and at most CLIENT_CONCURRENCY per client.
+A slot is held from submit until someone sees the task finish (a status
+request, a callback, or the sweep: tasks running longer than SWEEP_AFTER are
+checked upstream by whichever request finds no free slot), or for
+SLOT_LEASE at most. Entries that waited longer than QUEUE_TTL expire.
+The queue is on when a database and INTERNAL_TOKEN are configured; without
+the token every bot user would look like one web client.
+Queued generations are known to clients by a ticket (TICKET_PREFIX + id)
+that works everywhere a taskId does and reports its queue position.
+'''
+
+import hmac
+import os
+import random
+import time
+from typing import Dict, Any, List, Optional
+
+import db
+from events import header
+
+CONCURRENCY = int(os.environ.get('GENERATION_CONCURRENCY', 8))
+CLIENT_CONCURRENCY = int(os.environ.get('CLIENT_CONCURRENCY', 2))
+SLOT_LEASE = int(os.environ.get('GENERATION_SLOT_LEASE', 600))
+QUEUE_TTL = int(os.environ.get('GENERATION_QUEUE_TTL', 15 * 60))
+INTERNAL_TOKEN = os.environ.get('INTERNAL_TOKEN', '')
+TICKET_PREFIX = 'queue-'
+ENTRY_TTL = 24 * 60 * 60
+PURGE_PROBABILITY = 0.01
+TIER_WEIGHT_TTL = 60
+# How often an instance expires stale entries while claiming
+MAINTENANCE_INTERVAL = 60
+# A running task nobody has seen finish is checked upstream after this long,
+# then again every SWEEP_INTERVAL (by any instance), at most SWEEP_BATCH at a time
+SWEEP_AFTER = int(os.environ.get('GENERATION_SWEEP_AFTER', 30))
+SWEEP_INTERVAL = 15
+SWEEP_BATCH = 4
+# How often one instance looks for tasks to sweep
+SWEEP_POLL_INTERVAL = 5
+
+# Counters of this warm instance
+stats = {'enqueued': 0, 'dispatched': 0, 'requeued': 0, 'released': 0, 'swept': 0}
+
+_slots_ready = 0
+_maintained_at = 0.0
+_swept_at = 0.0
+_tier_weights: Dict[str, Any] = {}
+
+ENQUEUE_SQL = '''
+    INSERT INTO generation_queue (client_id, source, weight, finish_tag, prompt, image_url, image_hash, result_key)
+    SELECT %(client_id)s, %(source)s, %(weight)s,
+        GREATEST(
+            COALESCE(
+                (SELECT MIN(finish_tag) FROM generation_queue WHERE status = 'queued'),
+                (SELECT MAX(finish_tag) FROM generation_queue),
+                0
+            ),
+            COALESCE(
+                (SELECT MAX(finish_tag) FROM generation_queue
+                 WHERE client_id = %(client_id)s AND status IN ('queued', 'running')),
+                0
+            )
+        ) + 1.0 / %(weight)s,
+        %(prompt)s, %(image_url)s, %(image_hash)s, %(result_key)s
+    RETURNING id
+'''
+
+SLOTS_SQL = '''
+    INSERT INTO generation_slots (slot) SELECT generate_series(0, %s - 1) ON CONFLICT (slot) DO NOTHING
+'''
+
+# A free slot (never used, released or its lease ran out) and the first queued
+# entry in tag order whose client is below CLIENT_CONCURRENCY, taken together
+CLAIM_SQL = '''
+    WITH slot AS (
+        SELECT slot FROM generation_slots
+        WHERE slot < %(concurrency)s AND (queue_id IS NULL OR lease_until < CURRENT_TIMESTAMP)
+        ORDER BY slot
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), next AS (
+        SELECT q.id, slot.slot FROM generation_queue q, slot
+        WHERE q.status = 'queued'
+            AND q.created_at > CURRENT_TIMESTAMP - make_interval(secs => %(queue_ttl)s)
+            AND (
+                SELECT COUNT(*) FROM generation_queue r
+                WHERE r.client_id = q.client_id AND r.status = 'running' AND r.lease_until > CURRENT_TIMESTAMP
+            ) < %(client_concurrency)s
+        ORDER BY q.finish_tag, q.id
+        LIMIT 1
+        FOR UPDATE OF q SKIP LOCKED
+    ), taken AS (
+        UPDATE generation_queue q SET
+            status = 'running',
+            started_at = CURRENT_TIMESTAMP,
+            lease_until = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s)
+        FROM next
+        WHERE q.id = next.id
+        RETURNING q.id, next.slot, q.prompt, q.image_url, q.image_hash, q.result_key
+    )
+    UPDATE generation_slots s SET
+        queue_id = taken.id,
+        lease_until = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s)
+    FROM taken
+    WHERE s.slot = taken.slot
+    RETURNING taken.id, taken.prompt, taken.image_url, taken.image_hash, taken.result_key
+'''
+
+STARTED_SQL = '''
+    UPDATE generation_queue SET task_id = %s WHERE id = %s
+'''
+
+# Ends a dispatched entry (by id for requeue/fail, by task_id once the task finished) and frees its slot
+END_SQL = '''
+    WITH ended AS (
+        UPDATE generation_queue SET
+            status = %(status)s,
+            error = %(error)s,
+            started_at = CASE WHEN %(status)s = 'queued' THEN NULL ELSE started_at END,
+            finished_at = CASE WHEN %(status)s = 'queued' THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE status = 'running' AND {match}
+        RETURNING id
+    )
+    UPDATE generation_slots SET queue_id = NULL, lease_until = NULL WHERE queue_id IN (SELECT id FROM ended)
+'''
+END_BY_ID_SQL = END_SQL.format(match='id = %(id)s')
+END_BY_TASK_SQL = END_SQL.format(match='task_id = %(task_id)s')
+
+# Running tasks due for an upstream check; marking them keeps other instances off
+SWEEP_SQL = '''
+    UPDATE generation_queue SET checked_at = CURRENT_TIMESTAMP
+    WHERE id IN (
+        SELECT id FROM generation_queue
+        WHERE status = 'running' AND task_id IS NOT NULL
+            AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %(after)s)
+            AND (checked_at IS NULL OR checked_at < CURRENT_TIMESTAMP - make_interval(secs => %(interval)s))
+        ORDER BY started_at
+        LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING task_id
+'''
+
+EXPIRE_SQL = '''
+    UPDATE generation_queue SET status = 'expired', finished_at = CURRENT_TIMESTAMP
+    WHERE status = 'queued' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+'''
+
+# Entries whose submitter died between claim and submit go back to the queue
+RECLAIM_SQL = '''
+    UPDATE generation_queue SET status = 'queued', started_at = NULL
+    WHERE status = 'running' AND task_id IS NULL AND lease_until < CURRENT_TIMESTAMP
+'''
+
+PURGE_SQL = '''
+    DELETE FROM generation_queue
+    WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s) AND status NOT IN ('queued', 'running')
+'''
+
+# Position counts the queued entries ahead in tag order, this one included
+RESOLVE_SQL = '''
+    SELECT q.id, q.status, q.task_id, q.error,
+        CASE WHEN q.status = 'queued' THEN (
+            SELECT COUNT(*) FROM generation_queue a
+            WHERE a.status = 'queued' AND (a.finish_tag, a.id) <= (q.finish_tag, q.id)
+        ) END
+    FROM generation_queue q WHERE q.id = ANY(%s)
+'''
+
+WEIGHT_SQL = '''
+    SELECT weight FROM tiers WHERE name = %s
+'''
+
+QUEUE_STATS_SQL = '''
+    SELECT source, status, COUNT(*), CURRENT_TIMESTAMP - MIN(created_at)
+    FROM generation_queue WHERE status IN ('queued', 'running')
+    GROUP BY source, status
+'''
+
+
+def enabled() -> bool:
+    return CONCURRENCY > 0 and bool(INTERNAL_TOKEN) and db.is_configured()
+
+
+def ticket(queue_id: int) -> str:
+    return f'{TICKET_PREFIX}{queue_id}'
+
+
+def is_ticket(task_id: str) -> bool:
+    return task_id.startswith(TICKET_PREFIX) and task_id[len(TICKET_PREFIX):].isdigit()
+
+
+def client_of(event: Dict[str, Any], body: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Who a generation request is queued under: the body's client
+    ({"id": ..., "tier": ...}) when X-Internal-Token proves it comes from the
+    bot, the caller's IP address otherwise.
+    '''
+    client = body.get('client')
+    token = header(event, 'X-Internal-Token')
+    if (
+        isinstance(client, dict) and client.get('id') and INTERNAL_TOKEN and token
+        and hmac.compare_digest(token.encode('utf-8'), INTERNAL_TOKEN.encode('utf-8'))
+    ):
+        return {'id': str(client['id'])[:64], 'source': 'bot', 'tier': client.get('tier')}
+
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    address = identity.get('sourceIp') or header(event, 'X-Forwarded-For').split(',')[0].strip() or 'unknown'
+    return {'id': f'web:{address}'[:64], 'source': 'web', 'tier': None}
+
+
+def tier_weight(tier: Optional[str]) -> float:
+    '''
+    tiers.weight of a tier, cached for TIER_WEIGHT_TTL; 1 for no or an unknown tier.
+    '''
+    if not tier:
+        return 1.0
+    cached = _tier_weights.get(tier)
+    if cached and time.monotonic() - cached[1] < TIER_WEIGHT_TTL:
+        return cached[0]
+    weight = 1.0
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(WEIGHT_SQL, (tier,))
+            row = cur.fetchone()
+        if row and row[0] and row[0] > 0:
+            weight = float(row[0])
+    except Exception as e:
+        print(f"Tier weight read error: {e}")
+    _tier_weights[tier] = (weight, time.monotonic())
+    return weight
+
+
+def enqueue(
+    client: Dict[str, Any],
+    prompt: str,
+    image_url: Optional[str],
+    result_key: Optional[str],
+    image_hash: Optional[str] = None
+) -> Optional[int]:
+    '''
+    Queues a generation; returns its queue id, or None if the queue can't be
+    written. image_hash lets the dispatcher hand NanoBanana a fresh URL of
+    the photo instead of image_url, which may have expired in the queue.
+    '''
+    params = {
+        'client_id': client['id'],
+        'source': client['source'],
+        'weight': tier_weight(client.get('tier')),
+        'prompt': prompt,
+        'image_url': image_url,
+        'image_hash': image_hash,
+        'result_key': result_key
+    }
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(ENQUEUE_SQL, params)
+            queue_id = cur.fetchone()[0]
+            if random.random() < PURGE_PROBABILITY:
+                cur.execute(PURGE_SQL, (ENTRY_TTL,))
+    except Exception as e:
+        print(f"Generation queue write error: {e}")
+        return None
+    stats['enqueued'] += 1
+    return queue_id
+
+
+def claim() -> Optional[Dict[str, Any]]:
+    '''
+    Takes a slot for the next entry that may run; None when every slot is
+    busy, nothing is queued or the queue can't be read.
+    '''
+    global _slots_ready, _maintained_at
+    try:
+        with db.get_connection().cursor() as cur:
+            if _slots_ready < CONCURRENCY:
+                cur.execute(SLOTS_SQL, (CONCURRENCY,))
+                _slots_ready = CONCURRENCY
+            if time.monotonic() - _maintained_at > MAINTENANCE_INTERVAL:
+                cur.execute(EXPIRE_SQL, (QUEUE_TTL,))
+                cur.execute(RECLAIM_SQL)
+                _maintained_at = time.monotonic()
+            cur.execute(CLAIM_SQL, {
+                'concurrency': CONCURRENCY,
+                'client_concurrency': CLIENT_CONCURRENCY,
+                'queue_ttl': QUEUE_TTL,
+                'lease': SLOT_LEASE
+            })
+            row = cur.fetchone()
+    except Exception as e:
+        print(f"Generation queue claim error: {e}")
+        return None
+    if row is None:
+        return None
+    stats['dispatched'] += 1
+    queue_id, prompt, image_url, image_hash, result_key = row
+    return {'id': queue_id, 'prompt': prompt, 'imageUrl': image_url, 'imageHash': image_hash, 'resultKey': result_key}
+
+
+def started(queue_id: int, task_id: str) -> None:
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(STARTED_SQL, (task_id, queue_id))
+    except Exception as e:
+        print(f"Generation queue write error: {e}")
+
+
+def requeue(queue_id: int) -> None:
+    '''
+    Puts a claimed entry back (in its old place) after the submit could not be sent.
+    '''
+    stats['requeued'] += 1
+    _end(END_BY_ID_SQL, {'id': queue_id, 'status': 'queued', 'error': None})
+
+
+def fail(queue_id: int, error: str) -> None:
+    _end(END_BY_ID_SQL, {'id': queue_id, 'status': 'failed', 'error': error})
+
+
+def release(task_id: str) -> None:
+    '''
+    Frees the slot of a task that finished (no-op for tasks not in the queue).
+    '''
+    stats['released'] += 1
+    _end(END_BY_TASK_SQL, {'task_id': task_id, 'status': 'done', 'error': None})
+
+
+def sweep_due() -> List[str]:
+    '''
+    taskIds of running queue tasks to check upstream, because nobody has
+    seen them finish; empty when this instance looked less than
+    SWEEP_POLL_INTERVAL ago. The caller release()s the ones that finished.
+    '''
+    global _swept_at
+    if time.monotonic() - _swept_at < SWEEP_POLL_INTERVAL:
+        return []
+    _swept_at = time.monotonic()
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(SWEEP_SQL, {'after': SWEEP_AFTER, 'interval': SWEEP_INTERVAL, 'batch': SWEEP_BATCH})
+            rows = cur.fetchall()
+    except Exception as e:
+        print(f"Generation queue read error: {e}")
+        return []
+    stats['swept'] += len(rows)
+    return [row[0] for row in rows]
+
+
+def _end(sql: str, params: Dict[str, Any]) -> None:
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(sql, params)
+    except Exception as e:
+        print(f"Generation queue write error: {e}")
+
+
+def resolve(tickets: List[str]) -> Dict[str, Dict[str, Any]]:
+    '''
+    State of every ticket: {'status': 'queued', 'position': n},
+    {'status': 'submitted', 'taskId': ...} or {'status': 'failed', 'message': ...}.
+    Unknown tickets are reported as failed.
+    '''
+    found: Dict[str, Dict[str, Any]] = {}
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(RESOLVE_SQL, ([int(item[len(TICKET_PREFIX):]) for item in tickets],))
+            rows = cur.fetchall()
+    except Exception as e:
+        print(f"Generation queue read error: {e}")
+        # keep the tickets waiting rather than failing them on a database hiccup
+        return {item: {'status': 'queued', 'position': None} for item in tickets}
+
+    for queue_id, status, task_id, error, position in rows:
+        if task_id:
+            found[ticket(queue_id)] = {'status': 'submitted', 'taskId': task_id}
+        elif status in ('queued', 'running'):
+            # a running entry without a task is being submitted right now
+            found[ticket(queue_id)] = {'status': 'queued', 'position': position or 0}
+        elif status == 'expired':
+            found[ticket(queue_id)] = {'status': 'failed', 'message': 'Waited too long in the queue'}
+        else:
+            found[ticket(queue_id)] = {'status': 'failed', 'message': error or 'Generation failed'}
+    return {item: found.get(item, {'status': 'failed', 'message': 'Unknown queue ticket'}) for item in tickets}
+
+
+def queue_stats() -> Dict[str, Any]:
+    '''
+    Queued and running entries per source (with the oldest one's age in
+    seconds), plus this instance's counters.
+    '''
+    sources: Dict[str, Any] = {}
+    try:
+        with db.get_connection().cursor() as cur:
+            cur.execute(QUEUE_STATS_SQL)
+            rows = cur.fetchall()
+    except Exception as e:
+        print(f"Generation queue read error: {e}")
+        rows = []
+    for source, status, count, oldest in rows:
+        sources.setdefault(source, {})[status] = {'count': count, 'oldestSeconds': round(oldest.total_seconds(), 1)}
+    return {
+        'enabled': enabled(),
+        'concurrency': CONCURRENCY,
+        'clientConcurrency': CLIENT_CONCURRENCY,
+        'sources': sources,
+        'instance': stats
+    }
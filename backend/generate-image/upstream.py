@@ -0,0 +1,305 @@
+'''
+Rate-limit-aware client for the upstream APIs (NanoBanana, ImgBB).
+Every call goes through a token bucket, a per-instance concurrency bound and
+a circuit breaker. The bucket and the "circuit open" mark live in the
+upstream_limits table when UPSTREAM_LIMITER=postgres (the default with
+DATABASE_URL), so all instances share one budget and one outage signal;
+otherwise they are per instance. Calls that would have to wait longer than
+max_wait (or past the invocation's deadline), or that hit an open circuit,
+raise UpstreamUnavailable (a 503 for the client) instead of piling on. Base
+URLs come from <PREFIX>_BASE_URL, so the client can be pointed at a local
+fake server.
+'''
+
+import os
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Dict, Any, Optional
+
+import db
+import deadline
+from http_client import get_session
+from tracing import span
+
+if TYPE_CHECKING:
+    import requests
+
+TAKE_TOKEN_SQL = '''
+    INSERT INTO upstream_limits AS l (name, tokens) VALUES (%(name)s, %(burst)s - 1)
+    ON CONFLICT (name) DO UPDATE SET
+        tokens = LEAST(%(burst)s, l.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - l.updated_at) * %(rate)s) - 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE (l.open_until IS NULL OR l.open_until <= CURRENT_TIMESTAMP)
+        AND LEAST(%(burst)s, l.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - l.updated_at) * %(rate)s) - 1
+            >= -%(rate)s * %(max_wait)s
+    RETURNING tokens
+'''
+
+# Why TAKE_TOKEN_SQL refused: seconds until the circuit closes, or until a token frees up
+REFUSAL_SQL = '''
+    SELECT
+        EXTRACT(EPOCH FROM open_until - CURRENT_TIMESTAMP),
+        (-(LEAST(%(burst)s, tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at) * %(rate)s) - 1)) / %(rate)s
+            - %(max_wait)s
+    FROM upstream_limits WHERE name = %(name)s
+'''
+
+TRIP_SQL = '''
+    UPDATE upstream_limits SET open_until = CURRENT_TIMESTAMP + make_interval(secs => %(seconds)s)
+    WHERE name = %(name)s
+'''
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, name: str, retry_after: float, reason: str):
+        super().__init__(f'{name} is unavailable: {reason}')
+        self.name = name
+        self.retry_after = max(1, int(retry_after + 0.999))
+        self.reason = reason
+
+
+class MemoryLimiter:
+    '''
+    Token buckets and open-circuit marks of this function instance.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Dict[str, float]] = {}
+
+    def take(self, name: str, rate: float, burst: float, max_wait: float) -> float:
+        '''
+        Reserves one token and returns how long to wait before using it.
+        Raises UpstreamUnavailable when the circuit is open or the wait
+        would exceed max_wait.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(name, {'tokens': burst, 'updated_at': now, 'open_until': 0.0})
+            if bucket['open_until'] > now:
+                raise UpstreamUnavailable(name, bucket['open_until'] - now, 'circuit open')
+            tokens = min(burst, bucket['tokens'] + (now - bucket['updated_at']) * rate) - 1
+            wait = -tokens / rate if tokens < 0 else 0.0
+            if wait > max_wait:
+                raise UpstreamUnavailable(name, wait - max_wait, 'rate limited')
+            bucket['tokens'] = tokens
+            bucket['updated_at'] = now
+            return wait
+
+    def trip(self, name: str, seconds: float) -> None:
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is not None:
+                bucket['open_until'] = time.monotonic() + seconds
+
+
+class PostgresLimiter(MemoryLimiter):
+    '''
+    upstream_limits table (see db_migrations); one bucket per upstream shared
+    by all instances. Falls back to the in-memory bucket if the database
+    can't be reached.
+    '''
+
+    def take(self, name: str, rate: float, burst: float, max_wait: float) -> float:
+        params = {'name': name, 'rate': rate, 'burst': burst, 'max_wait': max_wait}
+        try:
+            with db.get_connection().cursor() as cur:
+                cur.execute(TAKE_TOKEN_SQL, params)
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute(REFUSAL_SQL, params)
+                    refusal = cur.fetchone()
+        except Exception as e:
+            print(f"Upstream limiter error, using the local bucket: {e}")
+            return super().take(name, rate, burst, max_wait)
+
+        if row is not None:
+            return -row[0] / rate if row[0] < 0 else 0.0
+        open_for, over_limit = refusal if refusal else (None, 0)
+        if open_for is not None and open_for > 0:
+            raise UpstreamUnavailable(name, float(open_for), 'circuit open')
+        raise UpstreamUnavailable(name, float(over_limit or 0), 'rate limited')
+
+    def trip(self, name: str, seconds: float) -> None:
+        super().trip(name, seconds)
+        try:
+            with db.get_connection().cursor() as cur:
+                cur.execute(TRIP_SQL, {'name': name, 'seconds': seconds})
+        except Exception as e:
+            print(f"Upstream limiter error: {e}")
+
+
+class CircuitBreaker:
+    '''
+    Opens when at least failure_ratio of the last `window` calls failed
+    (after min_calls), stays open for `cooldown` seconds, then lets one probe
+    call through: a success closes it, a failure opens it again.
+    '''
+
+    def __init__(self, window: int = 10, min_calls: int = 5, failure_ratio: float = 0.5, cooldown: float = 30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.outcomes: deque = deque(maxlen=window)
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half_open'
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record(self, success: bool) -> bool:
+        '''
+        Returns True when this outcome opened the circuit.
+        '''
+        with self.lock:
+            if self.opened_at is not None:
+                self.probing = False
+                if success:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                    return False
+                self.opened_at = time.monotonic()
+                return True
+
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'calls': len(self.outcomes),
+            'failures': self.outcomes.count(False),
+            'retryAfter': round(self.retry_after(), 1)
+        }
+
+
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        rate: float,
+        burst: float,
+        max_concurrency: int,
+        max_wait: float,
+        breaker: CircuitBreaker,
+        limiter: MemoryLimiter
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.breaker = breaker
+        self.limiter = limiter
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, base_url: str, rate: float, burst: float, max_concurrency: int) -> 'Upstream':
+        return cls(
+            name,
+            os.environ.get(f'{prefix}_BASE_URL', base_url),
+            rate=float(os.environ.get(f'{prefix}_RATE', rate)),
+            burst=float(os.environ.get(f'{prefix}_BURST', burst)),
+            max_concurrency=int(os.environ.get(f'{prefix}_CONCURRENCY', max_concurrency)),
+            max_wait=float(os.environ.get('UPSTREAM_MAX_WAIT', 5)),
+            breaker=CircuitBreaker(
+                window=int(os.environ.get('BREAKER_WINDOW', 10)),
+                min_calls=int(os.environ.get('BREAKER_MIN_CALLS', 5)),
+                failure_ratio=float(os.environ.get('BREAKER_FAILURE_RATIO', 0.5)),
+                cooldown=float(os.environ.get('BREAKER_COOLDOWN', 30))
+            ),
+            limiter=LIMITER
+        )
+
+    def request(self, method: str, path: str, **kwargs) -> 'requests.Response':
+        '''
+        session.request() against base_url + path once a token, a concurrency
+        slot and the breaker allow it. Transport errors, 429 and 5xx count as
+        failures for the breaker; the response is returned either way.
+        '''
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(self.name, self.breaker.retry_after(), 'circuit open')
+
+        import requests
+
+        max_wait = deadline.budget(self.max_wait)
+        try:
+            with span(f'upstream.{self.name}.limit'):
+                wait = self.limiter.take(self.name, self.rate, self.burst, max_wait)
+                if wait > 0:
+                    time.sleep(wait)
+                if not self.slots.acquire(timeout=max_wait):
+                    raise UpstreamUnavailable(self.name, 1, 'too many concurrent calls')
+        except UpstreamUnavailable:
+            self.release_probe()
+            raise
+
+        try:
+            response = get_session().request(method, f'{self.base_url}{path}', **kwargs)
+        except requests.RequestException:
+            self.record(False)
+            raise
+        finally:
+            self.slots.release()
+
+        self.record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    def record(self, success: bool) -> None:
+        if self.breaker.record(success):
+            print(f"Circuit for {self.name} opened for {self.breaker.cooldown}s")
+            self.limiter.trip(self.name, self.breaker.cooldown)
+
+    def release_probe(self) -> None:
+        with self.breaker.lock:
+            self.breaker.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'baseUrl': self.base_url,
+            'rate': self.rate,
+            'burst': self.burst,
+            'maxConcurrency': self.max_concurrency,
+            'breaker': self.breaker.stats()
+        }
+
+
+def make_limiter() -> MemoryLimiter:
+    backend = os.environ.get('UPSTREAM_LIMITER', 'postgres' if db.is_configured() else 'memory')
+    if backend == 'postgres':
+        return PostgresLimiter()
+    if backend == 'memory':
+        return MemoryLimiter()
+    raise ValueError(f'Unknown UPSTREAM_LIMITER: {backend}')
+
+
+LIMITER = make_limiter()
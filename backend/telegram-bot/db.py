@@ -0,0 +1,85 @@
+'''
+Postgres connections for the bot, pooled across warm invocations.
+Connections run in autocommit mode; a connection that broke while checked
+out is dropped from the pool instead of being handed to the next webhook.
+A connection that sat idle longer than VALIDATE_AFTER_IDLE is pinged on
+checkout, so one the server or a load balancer dropped during a warm gap is
+replaced instead of failing the first query of the next update.
+Every statement is timed as a tracing span (db.<verb>.<table>).
+psycopg2 is imported when the first connection is acquired.
+'''
+
+import os
+import threading
+import time
+
+from tracing import span, sql_stage
+
+POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX_CONNECTIONS', 4))
+
+# Seconds a pooled connection may sit idle before it is pinged on checkout
+VALIDATE_AFTER_IDLE = float(os.environ.get('DB_VALIDATE_AFTER_IDLE', 10))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# time.monotonic() at which each idle connection went back to the pool
+_released_at = {}
+
+
+def acquire(db_url: str):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                _pool = ThreadedConnectionPool(1, POOL_MAX_CONNECTIONS, db_url, cursor_factory=_tracing_cursor())
+
+    # Stale connections are closed one by one; once the idle ones run out the
+    # pool opens a fresh connection, which needs no ping
+    while True:
+        conn = _pool.getconn()
+        if _usable(conn, _released_at.pop(conn, None)):
+            break
+        _pool.putconn(conn, close=True)
+    conn.autocommit = True
+    return conn
+
+
+def release(conn) -> None:
+    if _pool is None:
+        return
+    from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+
+    broken = conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+    if not broken:
+        _released_at[conn] = time.monotonic()
+    _pool.putconn(conn, close=broken)
+
+
+def _usable(conn, released_at) -> bool:
+    if conn.closed:
+        return False
+    if released_at is None or time.monotonic() - released_at < VALIDATE_AFTER_IDLE:
+        return True
+    import psycopg2
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        print(f"Dropping stale DB connection: {e}")
+        return False
+
+
+def _tracing_cursor():
+    from psycopg2.extensions import cursor
+
+    class TracingCursor(cursor):
+        def execute(self, query, vars=None):
+            with span(sql_stage(query)):
+                return super().execute(query, vars)
+
+    return TracingCursor
@@ -0,0 +1,110 @@
+'''
+Deadline of the current invocation, carried through every stage.
+start() takes the earlier of the caller's X-Deadline header (unix time in
+seconds) and the end of the platform's context.get_remaining_time_in_millis(),
+minus RESPONSE_RESERVE seconds kept for answering. Stages ask for what is left:
+budget() for waits, timeout() for HTTP calls (which raises DeadlineExceeded
+once too little is left to be worth starting), header() to pass the
+deadline on to a downstream function. limit() narrows the deadline for a
+block, e.g. one job attempt. The deadline is a context variable, so
+tracing.bind carries it into executor threads.
+'''
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Iterator, Optional
+
+import events
+
+DEADLINE_HEADER = 'X-Deadline'
+
+# Seconds kept back from the platform's limit to build and send the answer
+RESPONSE_RESERVE = float(os.environ.get('DEADLINE_RESERVE', 3))
+
+# A call that would get less time than this is not started
+MIN_CALL_TIME = 1.0
+
+# time.monotonic() by which the current invocation has to be done
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    '''
+    Too little of the invocation's time is left to start the next stage.
+    '''
+
+
+def start(event: Dict[str, Any], context: Any) -> Optional[float]:
+    '''
+    Sets the deadline for this invocation; returns the seconds it allows
+    (None when neither the caller nor the platform sets one).
+    '''
+    now = time.monotonic()
+    candidates = []
+    value = events.header(event, DEADLINE_HEADER)
+    if value:
+        try:
+            candidates.append(now + float(value) - time.time() - RESPONSE_RESERVE)
+        except ValueError:
+            print(f"Ignoring malformed {DEADLINE_HEADER}: {value}")
+    remaining_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    if callable(remaining_ms):
+        candidates.append(now + remaining_ms() / 1000 - RESPONSE_RESERVE)
+    deadline = min(candidates) if candidates else None
+    _deadline.set(deadline)
+    return deadline - now if deadline is not None else None
+
+
+def remaining() -> Optional[float]:
+    '''
+    Seconds until the deadline (never negative); None without a deadline.
+    '''
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def budget(seconds: float) -> float:
+    '''
+    `seconds`, cut down to what is left before the deadline.
+    '''
+    left = remaining()
+    return seconds if left is None else min(seconds, left)
+
+
+def timeout(seconds: float) -> float:
+    '''
+    HTTP timeout for a call that may take up to `seconds`. Raises
+    DeadlineExceeded when less than MIN_CALL_TIME is left.
+    '''
+    left = remaining()
+    if left is None:
+        return seconds
+    if left < MIN_CALL_TIME:
+        raise DeadlineExceeded(f'{left:.1f}s left, a call needs at least {MIN_CALL_TIME:.0f}s')
+    return min(seconds, left)
+
+
+def header() -> Dict[str, str]:
+    '''
+    {X-Deadline: unix time} for a downstream request; empty without a deadline.
+    '''
+    left = remaining()
+    if left is None:
+        return {}
+    return {DEADLINE_HEADER: f'{time.time() + left:.3f}'}
+
+
+@contextmanager
+def limit(seconds: float) -> Iterator[None]:
+    '''
+    Narrows the deadline to at most `seconds` from now inside the block.
+    '''
+    token = _deadline.set(time.monotonic() + budget(seconds))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
@@ -0,0 +1,140 @@
+'''
+Generation history (generations table): one row per generation job with its
+input, result and how long each stage took (queue, generate, deliver, total).
+/history pages through a user's rows newest first by id (keyset paging), so
+every page is a single range scan of (user_id, id) however far back it goes.
+'''
+
+from typing import Dict, Any, List, Optional, Tuple
+
+# The style the bot renders its cards in: generate-image's prompts.DEFAULT_STYLE
+DEFAULT_STYLE = 'default'
+
+HISTORY_PAGE_SIZE = 5
+
+# Upper bound for ids, the cursor of the first page
+NO_CURSOR = 2 ** 63 - 1
+
+QUEUED_SQL = '''
+    INSERT INTO generations (user_id, job_id, style, caption)
+    VALUES (%(user_id)s, %(job_id)s, %(style)s, %(caption)s)
+'''
+
+# queue_ms is the wait before the first attempt; a claimed job that resumes a task is in flight again
+STARTED_SQL = '''
+    UPDATE generations g SET
+        started_at = COALESCE(g.started_at, CURRENT_TIMESTAMP),
+        queue_ms = COALESCE(g.queue_ms, (EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - g.created_at) * 1000)::INTEGER),
+        status = CASE WHEN g.task_id IS NOT NULL THEN 'pending' ELSE g.status END
+    WHERE job_id = %s
+'''
+
+TASK_SQL = '''
+    UPDATE generations SET task_id = %(task_id)s, input_hash = COALESCE(%(input_hash)s, input_hash), status = 'pending'
+    WHERE job_id = %(job_id)s
+'''
+
+# Stage times add up over attempts; total_ms and finished_at are set once the job is done or failed
+UPDATE_SQL = '''
+    UPDATE generations g SET
+        status = %(status)s,
+        input_hash = COALESCE(%(input_hash)s, g.input_hash),
+        result_url = COALESCE(%(result_url)s, g.result_url),
+        file_id = COALESCE(%(file_id)s, g.file_id),
+        generate_ms = COALESCE(g.generate_ms, 0) + %(generate_ms)s,
+        deliver_ms = COALESCE(g.deliver_ms, 0) + %(deliver_ms)s,
+        total_ms = CASE WHEN %(status)s IN ('done', 'failed')
+            THEN (EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - g.created_at) * 1000)::INTEGER END,
+        finished_at = CASE WHEN %(status)s IN ('done', 'failed') THEN CURRENT_TIMESTAMP END
+    WHERE job_id = %(job_id)s
+'''
+
+PAGE_SQL = '''
+    SELECT id, status, caption, style, total_ms, created_at FROM generations
+    WHERE user_id = %(user_id)s AND id < %(before)s
+    ORDER BY id DESC
+    LIMIT %(limit)s
+'''
+
+LATENCY_SQL = '''
+    SELECT
+        COUNT(*),
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY queue_ms),
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY generate_ms),
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY deliver_ms),
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY total_ms)
+    FROM generations
+    WHERE status = 'done' AND finished_at > CURRENT_TIMESTAMP - make_interval(hours => %s)
+'''
+
+
+def queued(cur, user_id: int, job_id: int, style: str, caption: str) -> None:
+    cur.execute(QUEUED_SQL, {
+        'user_id': user_id,
+        'job_id': job_id,
+        'style': style,
+        'caption': caption or None
+    })
+
+
+def started(cur, job_id: int) -> None:
+    cur.execute(STARTED_SQL, (job_id,))
+
+
+def task_submitted(cur, job_id: int, task_id: str, input_hash: Optional[str]) -> None:
+    cur.execute(TASK_SQL, {'job_id': job_id, 'task_id': task_id, 'input_hash': input_hash})
+
+
+def update(
+    cur,
+    job_id: int,
+    status: str,
+    generate_seconds: float = 0.0,
+    deliver_seconds: float = 0.0,
+    input_hash: Optional[str] = None,
+    result_url: Optional[str] = None,
+    file_id: Optional[str] = None
+) -> None:
+    '''
+    Records the outcome of an attempt: 'done', 'failed', or 'queued' when
+    the job goes back to the queue for a retry.
+    '''
+    cur.execute(UPDATE_SQL, {
+        'job_id': job_id,
+        'status': status,
+        'input_hash': input_hash,
+        'result_url': result_url,
+        'file_id': file_id,
+        'generate_ms': int(generate_seconds * 1000),
+        'deliver_ms': int(deliver_seconds * 1000)
+    })
+
+
+def page(cur, user_id: int, before: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    '''
+    Up to `limit` generations older than id `before`, newest first, and the
+    cursor of the next page (None on the last one).
+    '''
+    cur.execute(PAGE_SQL, {'user_id': user_id, 'before': before or NO_CURSOR, 'limit': limit + 1})
+    keys = ('id', 'status', 'caption', 'style', 'total_ms', 'created_at')
+    rows = [dict(zip(keys, row)) for row in cur.fetchall()]
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]['id']
+    return rows, None
+
+
+def latency_stats(cur, hours: int = 24) -> Dict[str, Any]:
+    '''
+    p50/p95/p99 of every stage, in ms, over the generations finished in the last `hours`.
+    '''
+    cur.execute(LATENCY_SQL, (hours,))
+    count, *stages = cur.fetchone()
+    names = ('queue', 'generate', 'deliver', 'total')
+    return {
+        'hours': hours,
+        'count': count,
+        **{
+            name: dict(zip(('p50', 'p95', 'p99'), [round(value) for value in values])) if values and None not in values else None
+            for name, values in zip(names, stages)
+        }
+    }
@@ -0,0 +1,72 @@
+'''
+Pooled HTTP session reused across warm invocations.
+Keep-alive connections with per-host pool sizes and a retry adapter:
+connection failures are retried for every method, 5xx responses only for
+idempotent ones. connection_stats() reports pooled connections reused vs. opened.
+requests is imported by the first get_session(), not when the module loads.
+'''
+
+from typing import TYPE_CHECKING, Dict, Any
+
+if TYPE_CHECKING:
+    import requests
+
+POOL_SIZES = {
+    'api.telegram.org': 8,
+    'functions.poehali.dev': 4
+}
+DEFAULT_POOL_SIZE = 2
+
+_session = None
+
+
+def _adapter(pool_size: int):
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=1,
+        status=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        raise_on_status=False
+    )
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+
+def get_session() -> 'requests.Session':
+    global _session
+    if _session is None:
+        import requests
+
+        session = requests.Session()
+        session.mount('https://', _adapter(DEFAULT_POOL_SIZE))
+        session.mount('http://', _adapter(DEFAULT_POOL_SIZE))
+        for host, size in POOL_SIZES.items():
+            session.mount(f'https://{host}/', _adapter(size))
+        _session = session
+    return _session
+
+
+def connection_stats() -> Dict[str, Dict[str, Any]]:
+    '''
+    Per-host totals since the instance started: requests sent, connections
+    opened and requests that went over an already open connection.
+    '''
+    stats: Dict[str, Dict[str, Any]] = {}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = stats.setdefault(pool.host, {'requests': 0, 'opened': 0, 'reused': 0})
+            host['requests'] += pool.num_requests
+            host['opened'] += pool.num_connections
+            host['reused'] += max(0, pool.num_requests - pool.num_connections)
+    return stats
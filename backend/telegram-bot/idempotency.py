@@ -0,0 +1,89 @@
+'''
+Webhook deduplication (processed_updates table).
+An update is identified by its update_id and by (chat_id, message_id), so a
+Telegram redelivery is caught by either key. The first delivery takes a short
+in-flight lease; redeliveries that arrive while it holds the lease, or after it
+finished, are acknowledged without doing the work again and counted in the
+row's `duplicates` column. A lease left behind by a crashed invocation expires
+and the next redelivery takes the update over. Rows are kept for UPDATE_TTL.
+'''
+
+import os
+import random
+from typing import Optional
+
+UPDATE_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', 6 * 60 * 60))
+LEASE_SECONDS = int(os.environ.get('UPDATE_LEASE_SECONDS', 60))
+PURGE_PROBABILITY = 0.01
+
+# Duplicates suppressed by this warm instance (the table keeps the global totals)
+stats = {'duplicates': 0}
+
+MATCH_SQL = '(update_id = %(update_id)s OR (chat_id = %(chat_id)s AND message_id = %(message_id)s))'
+
+BEGIN_SQL = '''
+    INSERT INTO processed_updates (update_id, chat_id, message_id, lease_until, expires_at)
+    VALUES (
+        %(update_id)s, %(chat_id)s, %(message_id)s,
+        CURRENT_TIMESTAMP + make_interval(secs => %(lease)s),
+        CURRENT_TIMESTAMP + make_interval(secs => %(ttl)s)
+    )
+    ON CONFLICT DO NOTHING
+    RETURNING id
+'''
+
+TAKE_OVER_SQL = f'''
+    UPDATE processed_updates SET
+        status = 'in_flight',
+        lease_until = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s),
+        expires_at = CURRENT_TIMESTAMP + make_interval(secs => %(ttl)s)
+    WHERE {MATCH_SQL}
+        AND ((status = 'in_flight' AND lease_until < CURRENT_TIMESTAMP) OR expires_at <= CURRENT_TIMESTAMP)
+    RETURNING id
+'''
+
+COUNT_DUPLICATE_SQL = f'''
+    UPDATE processed_updates SET duplicates = duplicates + 1 WHERE {MATCH_SQL}
+'''
+
+
+def begin(cur, update_id: Optional[int], chat_id: int, message_id: int) -> Optional[int]:
+    '''
+    Returns a claim id if this invocation should process the update,
+    or None if it is a duplicate that must only be acknowledged.
+    '''
+    params = {
+        'update_id': update_id,
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'lease': LEASE_SECONDS,
+        'ttl': UPDATE_TTL
+    }
+
+    if random.random() < PURGE_PROBABILITY:
+        cur.execute("DELETE FROM processed_updates WHERE expires_at <= CURRENT_TIMESTAMP")
+
+    cur.execute(BEGIN_SQL, params)
+    row = cur.fetchone()
+    if row:
+        return row[0]
+
+    cur.execute(TAKE_OVER_SQL, params)
+    row = cur.fetchone()
+    if row:
+        return row[0]
+
+    cur.execute(COUNT_DUPLICATE_SQL, params)
+    stats['duplicates'] += 1
+    return None
+
+
+def finish(cur, claim_id: int) -> None:
+    cur.execute("UPDATE processed_updates SET status = 'done' WHERE id = %s", (claim_id,))
+
+
+def release(cur, claim_id: int) -> None:
+    '''
+    Gives the lease back after a failure so a redelivery can retry the update.
+    '''
+    cur.execute("UPDATE processed_updates SET lease_until = CURRENT_TIMESTAMP WHERE id = %s", (claim_id,))
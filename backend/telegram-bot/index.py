@@ -1,19 +1,66 @@
 import json
 import os
-import psycopg2
-from datetime import date, datetime
+from datetime import date
 from typing import Dict, Any
-import requests
-import base64
-import time
-import threading
+
+import db
+import deadline
+import events
+import generations
+import idempotency
+import jobs
+import tracing
+from http_client import get_session, connection_stats
+from outbox import OUTBOX
+from quota import DEFAULT_DAILY_LIMIT, USER_LIMIT_SQL, reserve_generation, refund_generation
+from telegram_api import send_message, send_message_with_response
+from worker import PROGRESS_MESSAGES, drain
+
+# generate-image downscales photos to 800 px anyway; don't download more than that
+PHOTO_MIN_DIMENSION = 800
+
+# Same limit as generate-image's prompts.CAPTION_MAX_LENGTH
+CAPTION_MAX_LENGTH = 200
+
+# The webhook waits this long for its queued replies to go out before answering
+FLUSH_TIMEOUT = 10
+
+# Creates the user on first contact and resets the daily counter on the first
+# update of a new day; returns (id, tier, generation_count, daily_limit) in one round trip
+UPSERT_USER_SQL = '''
+    INSERT INTO users (telegram_id, username, first_name, last_name, generation_count, last_generation_date)
+    VALUES (%(telegram_id)s, %(username)s, %(first_name)s, %(last_name)s, 0, %(today)s)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        generation_count = CASE
+            WHEN users.last_generation_date = EXCLUDED.last_generation_date THEN users.generation_count
+            ELSE 0
+        END,
+        last_generation_date = EXCLUDED.last_generation_date
+    RETURNING id, tier, generation_count, ''' + USER_LIMIT_SQL
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Telegram bot webhook handler for greeting card generation with daily limits
-    Args: event - dict with httpMethod, body; context - object with request_id
+    Business: Telegram bot webhook handler for greeting card generation with daily limits.
+              Photos are queued as generation jobs and acknowledged right away;
+              a POST carrying X-Worker-Secret drains the queue instead;
+              GET ?metrics=1 returns per-stage timing histograms.
+    Args: event - dict with httpMethod, headers, body; context - object with request_id
+          and get_remaining_time_in_millis (a drain stops claiming jobs in time)
     Returns: HTTP response with statusCode, headers, body
     '''
+    trace = tracing.start(context.request_id)
+    deadline.start(event, context)
+    OUTBOX.track()
+    response = handle_update(event, context)
+    OUTBOX.wait_tracked(deadline.budget(FLUSH_TIMEOUT))
+    tracing.finish(trace, method=event.get('httpMethod'), statusCode=response['statusCode'])
+    print(f"HTTP connections: {json.dumps(connection_stats())}")
+    print(f"Telegram outbox: {json.dumps(OUTBOX.stats)}")
+    return response
+
+
+def handle_update(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
@@ -29,6 +76,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('metrics'):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps(tracing.snapshot()),
+            'isBase64Encoded': False
+        }
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -48,6 +103,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    worker_secret = os.environ.get('WORKER_SECRET')
+    if worker_secret and events.header(event, 'X-Worker-Secret') == worker_secret:
+        processed = drain(bot_token, db_url)
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, 'processed': processed}),
+            'isBase64Encoded': False
+        }
+    
     try:
         body_data = json.loads(event.get('body', '{}'))
     except:
@@ -84,35 +149,33 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     conn = None
     cur = None
+    claim_id = None
     
     try:
-        conn = psycopg2.connect(db_url)
+        conn = db.acquire(db_url)
         cur = conn.cursor()
         
-        cur.execute(
-            "SELECT id, generation_count, last_generation_date FROM users WHERE telegram_id = %s",
-            (telegram_id,)
-        )
-        user = cur.fetchone()
-        
-        if not user:
-            cur.execute(
-                "INSERT INTO users (telegram_id, username, first_name, last_name, generation_count, last_generation_date) VALUES (%s, %s, %s, %s, 0, %s) RETURNING id, generation_count, last_generation_date",
-                (telegram_id, username, first_name, last_name, date.today())
-            )
-            user = cur.fetchone()
-            conn.commit()
+        claim_id = idempotency.begin(cur, body_data.get('update_id'), chat_id, message['message_id'])
+        if claim_id is None:
+            print(f"Duplicate update suppressed ({idempotency.stats['duplicates']} on this instance)")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'ok': True, 'duplicate': True}),
+                'isBase64Encoded': False
+            }
         
-        user_id, generation_count, last_gen_date = user
         today = date.today()
-        
-        if last_gen_date != today:
-            generation_count = 0
-            cur.execute(
-                "UPDATE users SET generation_count = 0, last_generation_date = %s WHERE id = %s",
-                (today, user_id)
-            )
-            conn.commit()
+        cur.execute(UPSERT_USER_SQL, {
+            'telegram_id': telegram_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'today': today,
+            'default_limit': DEFAULT_DAILY_LIMIT
+        })
+        user_id, tier, generation_count, daily_limit = cur.fetchone()
+        remaining = max(0, daily_limit - generation_count)
         
         if 'text' in message:
             text = message['text']
@@ -122,141 +185,85 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     f"Привет, {first_name}! 👋\n\n"
                     "Я генерирую открытки с бабушкиным юмором.\n\n"
                     "📸 Отправь мне фото, и я создам открытку.\n"
-                    f"✨ Осталось генераций сегодня: {3 - generation_count}/3"
+                    "🗂 /history — твои прошлые открытки.\n"
+                    f"✨ Осталось генераций сегодня: {remaining}/{daily_limit}"
                 )
+            elif text == '/history' or text.startswith('/history_'):
+                send_message(bot_token, chat_id, history_message(cur, user_id, text))
             elif text == '/limit':
                 send_message(bot_token, chat_id, 
                     f"📊 Твой лимит на сегодня:\n"
-                    f"Использовано: {generation_count}/3\n"
-                    f"Осталось: {3 - generation_count}/3"
+                    f"Использовано: {generation_count}/{daily_limit}\n"
+                    f"Осталось: {remaining}/{daily_limit}"
                 )
             else:
                 send_message(bot_token, chat_id, "Отправь мне фото, чтобы создать открытку! 📸")
         
+        elif 'photo' in message and len(message.get('caption', '').strip()) > CAPTION_MAX_LENGTH:
+            send_message(bot_token, chat_id,
+                f"✏️ Подпись слишком длинная: не больше {CAPTION_MAX_LENGTH} символов. Пришли фото ещё раз с текстом покороче!"
+            )
+        
         elif 'photo' in message:
-            if generation_count >= 3:
+            used = reserve_generation(cur, user_id, today)
+            
+            if used is None:
                 send_message(bot_token, chat_id, 
-                    "❌ Ты исчерпал лимит на сегодня (3/3).\n"
+                    f"❌ Ты исчерпал лимит на сегодня ({daily_limit}/{daily_limit}).\n"
                     "Приходи завтра! 🌅\n\n"
                     "✅ Если очень хочешь больше запросов, заходи в Вайбкод Клуб по ссылке https://t.me/+oYnTM8NN9w9mY2Yy "
                     "и проси в чате «добавить запросы на Вайбкод открытки»."
                 )
             else:
-                funny_messages = [
-                    "⏳ Бабушка подбирает рамочку...",
-                    "🌸 Добавляем цветочки и блёстки...",
-                    "💐 Бабуля выбирает лучшие пожелания...",
-                    "✨ Украшаем открытку с любовью...",
-                    "🎨 Наносим бабушкин шарм...",
-                    "💝 Добавляем теплоты и уюта..."
-                ]
-                
-                custom_text = message.get('caption', '').strip()
-                
-                status_msg = send_message_with_response(bot_token, chat_id, funny_messages[0])
-                message_id = status_msg.get('result', {}).get('message_id') if status_msg else None
-                
-                photo = message['photo'][-1]
-                file_id = photo['file_id']
-                
-                file_response = requests.get(f"https://api.telegram.org/bot{bot_token}/getFile?file_id={file_id}", timeout=10)
-                file_data = file_response.json()
-                
-                if file_data.get('ok'):
-                    file_path = file_data['result']['file_path']
-                    file_url = f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
+                queued = False
+                try:
+                    custom_text = message.get('caption', '').strip()
                     
-                    image_response = requests.get(file_url, timeout=30)
-                    image_base64 = base64.b64encode(image_response.content).decode('utf-8')
-                    
-                    payload = {'imageBase64': f"data:image/jpeg;base64,{image_base64}"}
-                    if custom_text:
-                        payload['customText'] = custom_text
+                    status_msg = send_message_with_response(bot_token, chat_id, PROGRESS_MESSAGES[0])
+                    message_id = status_msg.get('result', {}).get('message_id') if status_msg else None
                     
-                    max_retries = 3
-                    retry_timeout = 45
-                    success = False
-                    result_url = None
+                    photo = pick_photo_size(message['photo'])
                     
-                    for attempt in range(1, max_retries + 1):
-                        try:
-                            msg_index = 0
-                            start_time = time.time()
-                            
-                            generation_done = {'value': False, 'data': None}
-                            
-                            def generate():
-                                try:
-                                    resp = requests.post(
-                                        'https://functions.poehali.dev/937cd074-b42c-4c14-86bc-4a8b85463284',
-                                        json=payload,
-                                        headers={'Content-Type': 'application/json'},
-                                        timeout=retry_timeout
-                                    )
-                                    generation_done['data'] = resp.json()
-                                except:
-                                    generation_done['data'] = None
-                                finally:
-                                    generation_done['value'] = True
-                            
-                            gen_thread = threading.Thread(target=generate)
-                            gen_thread.start()
-                            
-                            while time.time() - start_time < retry_timeout:
-                                if generation_done['value']:
-                                    break
-                                
-                                elapsed = time.time() - start_time
-                                if elapsed > (msg_index + 1) * 5 and msg_index < len(funny_messages) - 1:
-                                    msg_index += 1
-                                    if message_id:
-                                        edit_message(bot_token, chat_id, message_id, funny_messages[msg_index])
-                                
-                                time.sleep(1)
-                            
-                            gen_thread.join(timeout=1)
-                            
-                            if generation_done.get('data'):
-                                gen_data = generation_done['data']
-                                if gen_data.get('success') and gen_data.get('imageUrl'):
-                                    success = True
-                                    result_url = gen_data['imageUrl']
-                                    break
-                        
-                        except:
-                            pass
+                    # generate-image queues the card under this user, weighted by the tier
+                    request = {
+                        'telegramFileId': photo['file_id'],
+                        'style': generations.DEFAULT_STYLE,
+                        'client': {'id': f'tg:{user_id}', 'tier': tier}
+                    }
+                    if custom_text:
+                        request['customText'] = custom_text
                     
-                    if success and result_url:
-                        cur.execute(
-                            "UPDATE users SET generation_count = generation_count + 1, last_generation_date = %s, updated_at = %s WHERE id = %s",
-                            (today, datetime.now(), user_id)
-                        )
-                        conn.commit()
-                        
-                        if message_id:
-                            delete_message(bot_token, chat_id, message_id)
-                        
-                        send_photo(bot_token, chat_id, result_url, 
-                            f"✅ Готово!\n📊 Использовано: {generation_count + 1}/3")
-                    else:
-                        error_msg = "❌ Не удалось создать открытку после нескольких попыток. Попробуйте позже!"
-                        if message_id:
-                            edit_message(bot_token, chat_id, message_id, error_msg)
-                        else:
-                            send_message(bot_token, chat_id, error_msg)
-                else:
-                    send_message(bot_token, chat_id, "❌ Не удалось получить фото. Попробуйте еще раз!")
+                    job_id = jobs.enqueue(cur, user_id, chat_id, message_id, {
+                        'request': request,
+                        'used': used,
+                        'dailyLimit': daily_limit
+                    }, today)
+                    generations.queued(cur, user_id, job_id, request['style'], custom_text)
+                    queued = True
+                    print(f"Queued generation job {job_id}")
+                finally:
+                    if not queued:
+                        refund_generation(cur, user_id, today)
+                
+                kick_worker()
+        
+        idempotency.finish(cur, claim_id)
     
     except Exception as e:
         print(f"Handler error: {e}")
         import traceback
         traceback.print_exc()
+        if claim_id is not None:
+            try:
+                idempotency.release(cur, claim_id)
+            except Exception as release_error:
+                print(f"Update lease release error: {release_error}")
     
     finally:
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            db.release(conn)
     
     return {
         'statusCode': 200,
@@ -266,58 +273,56 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     }
 
 
-def send_message(token: str, chat_id: int, text: str):
-    try:
-        requests.post(
-            f"https://api.telegram.org/bot{token}/sendMessage",
-            json={'chat_id': chat_id, 'text': text},
-            timeout=10
-        )
-    except Exception as e:
-        print(f"Send message error: {e}")
-
-
-def send_message_with_response(token: str, chat_id: int, text: str):
-    try:
-        response = requests.post(
-            f"https://api.telegram.org/bot{token}/sendMessage",
-            json={'chat_id': chat_id, 'text': text},
-            timeout=10
-        )
-        return response.json()
-    except Exception as e:
-        print(f"Send message error: {e}")
-        return None
-
-
-def edit_message(token: str, chat_id: int, message_id: int, text: str):
+def history_message(cur, user_id: int, command: str) -> str:
+    '''
+    One page of /history; /history_<id> continues below generation <id>.
+    '''
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{token}/editMessageText",
-            json={'chat_id': chat_id, 'message_id': message_id, 'text': text},
-            timeout=10
-        )
-    except Exception as e:
-        print(f"Edit message error: {e}")
+        before = int(command[len('/history_'):]) if command.startswith('/history_') else None
+    except ValueError:
+        before = None
+    
+    rows, next_cursor = generations.page(cur, user_id, before)
+    if not rows:
+        return "Пока здесь пусто. Отправь мне фото, чтобы создать открытку! 📸"
+    
+    lines = ["🗂 Твои открытки:\n"]
+    for row in rows:
+        icon = {'done': '✅', 'failed': '❌'}.get(row['status'], '⏳')
+        caption = f"«{row['caption']}»" if row['caption'] else 'без подписи'
+        took = f" ({row['total_ms'] // 1000} с)" if row['status'] == 'done' and row['total_ms'] is not None else ''
+        lines.append(f"{icon} {row['created_at']:%d.%m %H:%M} — {caption}{took}")
+    if next_cursor:
+        lines.append(f"\nДальше: /history_{next_cursor}")
+    return "\n".join(lines)
 
 
-def delete_message(token: str, chat_id: int, message_id: int):
+def kick_worker() -> None:
+    '''
+    Starts a drain invocation of this function without waiting for it:
+    the request is sent and the connection dropped before the worker answers.
+    Without WORKER_URL/WORKER_SECRET jobs wait for an external worker (worker.py).
+    '''
+    worker_url = os.environ.get('WORKER_URL')
+    worker_secret = os.environ.get('WORKER_SECRET')
+    if not worker_url or not worker_secret:
+        return
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{token}/deleteMessage",
-            json={'chat_id': chat_id, 'message_id': message_id},
-            timeout=10
+        get_session().post(
+            worker_url,
+            json={'action': 'drain'},
+            headers={'X-Worker-Secret': worker_secret},
+            timeout=(3, 0.5)
         )
-    except Exception as e:
-        print(f"Delete message error: {e}")
+    except Exception:
+        pass
 
 
-def send_photo(token: str, chat_id: int, photo_url: str, caption: str):
-    try:
-        requests.post(
-            f"https://api.telegram.org/bot{token}/sendPhoto",
-            json={'chat_id': chat_id, 'photo': photo_url, 'caption': caption},
-            timeout=10
-        )
-    except Exception as e:
-        print(f"Send photo error: {e}")
\ No newline at end of file
+def pick_photo_size(sizes: list) -> Dict[str, Any]:
+    '''
+    Smallest Telegram photo size that still covers PHOTO_MIN_DIMENSION, else the largest one.
+    '''
+    large_enough = [p for p in sizes if max(p.get('width', 0), p.get('height', 0)) >= PHOTO_MIN_DIMENSION]
+    if not large_enough:
+        return sizes[-1]
+    return min(large_enough, key=lambda p: p.get('width', 0) * p.get('height', 0))
@@ -0,0 +1,173 @@
+'''
+Durable generation queue on Postgres (generation_jobs table).
+Workers claim jobs with FOR UPDATE SKIP LOCKED. A claimed job stays invisible
+for VISIBILITY_TIMEOUT seconds; if its worker dies, the job becomes visible
+again and another worker picks it up. Failed attempts are retried with
+backoff until max_attempts is reached. A user's jobs run one at a time:
+while a worker holds one, the user's other jobs wait, so a user who sends
+many photos does not occupy many workers. Claims of one user's jobs are
+serialized with a transaction-level advisory lock: the claimer rechecks
+that the user has no running job only after taking the lock, so two
+workers claiming at the same moment cannot both start one of the user's
+jobs.
+'''
+
+import json
+import os
+from datetime import date
+from typing import Dict, Any, List, Optional
+
+VISIBILITY_TIMEOUT = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 420))
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+RETRY_BACKOFF = 10
+
+JOB_COLUMNS = (
+    'id, user_id, chat_id, status_message_id, payload, quota_date, attempts, max_attempts, task_id, '
+    'result_url, result_file_id'
+)
+
+# Advisory lock class of the per-user claim lock (the second key is the user)
+CLAIM_LOCK_CLASS = 4210
+
+# Attempts to claim when a picked job's user is being claimed by another worker
+CLAIM_TRIES = 3
+
+# Jobs of a user who has a job running (and not timed out) wait
+USER_IDLE_SQL = '''
+    NOT EXISTS (
+        SELECT 1 FROM generation_jobs held
+        WHERE held.user_id = generation_jobs.user_id AND held.status = 'running'
+            AND held.visible_at > CURRENT_TIMESTAMP AND held.id <> generation_jobs.id
+    )
+'''
+
+# Picks the next job and takes its user's claim lock; runs inside a transaction
+PICK_JOB_SQL = f'''
+    WITH candidate AS (
+        SELECT id, user_id FROM generation_jobs
+        WHERE status IN ('queued', 'running') AND visible_at <= CURRENT_TIMESTAMP AND attempts < max_attempts
+            AND {USER_IDLE_SQL}
+        ORDER BY visible_at, id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    SELECT id, pg_try_advisory_xact_lock(%(lock_class)s, hashint8(user_id)) FROM candidate
+'''
+
+# Runs after the lock is held, so its snapshot sees any claim committed before
+CLAIM_JOB_SQL = f'''
+    UPDATE generation_jobs SET
+        status = 'running',
+        attempts = attempts + 1,
+        visible_at = CURRENT_TIMESTAMP + make_interval(secs => %(visibility_timeout)s),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(id)s AND {USER_IDLE_SQL}
+    RETURNING {JOB_COLUMNS}
+'''
+
+# Jobs whose last allowed attempt timed out without the worker reporting back
+REAP_JOBS_SQL = f'''
+    UPDATE generation_jobs SET status = 'failed', last_error = 'visibility timeout', updated_at = CURRENT_TIMESTAMP
+    WHERE id IN (
+        SELECT id FROM generation_jobs
+        WHERE status = 'running' AND visible_at <= CURRENT_TIMESTAMP AND attempts >= max_attempts
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING {JOB_COLUMNS}
+'''
+
+
+def _job(row) -> Dict[str, Any]:
+    keys = [column.strip() for column in JOB_COLUMNS.split(',')]
+    return dict(zip(keys, row))
+
+
+def enqueue(cur, user_id: int, chat_id: int, status_message_id: Optional[int],
+            payload: Dict[str, Any], quota_date: date) -> int:
+    cur.execute(
+        "INSERT INTO generation_jobs (user_id, chat_id, status_message_id, payload, quota_date, max_attempts) "
+        "VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+        (user_id, chat_id, status_message_id, json.dumps(payload), quota_date, MAX_ATTEMPTS)
+    )
+    return cur.fetchone()[0]
+
+
+def claim(cur) -> Optional[Dict[str, Any]]:
+    '''
+    Claims the next job in its own transaction (the connection is in
+    autocommit mode otherwise). None when there is nothing to run.
+    '''
+    for _ in range(CLAIM_TRIES):
+        cur.execute('BEGIN')
+        try:
+            cur.execute(PICK_JOB_SQL, {'lock_class': CLAIM_LOCK_CLASS})
+            picked = cur.fetchone()
+            if picked is None:
+                cur.execute('COMMIT')
+                return None
+            row = None
+            if picked[1]:
+                cur.execute(CLAIM_JOB_SQL, {'id': picked[0], 'visibility_timeout': VISIBILITY_TIMEOUT})
+                row = cur.fetchone()
+            cur.execute('COMMIT')
+        except Exception:
+            if not cur.connection.closed:
+                cur.execute('ROLLBACK')
+            raise
+        if row:
+            return _job(row)
+    return None
+
+
+def reap_expired(cur) -> List[Dict[str, Any]]:
+    cur.execute(REAP_JOBS_SQL)
+    return [_job(row) for row in cur.fetchall()]
+
+
+def complete(cur, job_id: int) -> None:
+    cur.execute(
+        "UPDATE generation_jobs SET status = 'done', last_error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (job_id,)
+    )
+
+
+def set_task(cur, job_id: int, task_id: Optional[str]) -> None:
+    '''
+    Remembers the NanoBanana task of a job so a retry resumes it instead of
+    paying for a new one; None makes the next attempt submit again.
+    '''
+    cur.execute(
+        "UPDATE generation_jobs SET task_id = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (task_id, job_id)
+    )
+
+
+def set_result(cur, job_id: int, result_url: str, file_id: Optional[str]) -> None:
+    '''
+    Remembers the finished card of a job (and, once sent, its Telegram
+    file_id), so a retry after a failed delivery only sends it again.
+    '''
+    cur.execute(
+        "UPDATE generation_jobs SET result_url = %s, result_file_id = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (result_url, file_id, job_id)
+    )
+
+
+def retry_or_fail(cur, job: Dict[str, Any], error: str) -> bool:
+    '''
+    Puts the job back with backoff, or marks it failed after its last attempt.
+    Returns True if the job will be retried.
+    '''
+    if job['attempts'] >= job['max_attempts']:
+        cur.execute(
+            "UPDATE generation_jobs SET status = 'failed', last_error = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+            (error, job['id'])
+        )
+        return False
+
+    cur.execute(
+        "UPDATE generation_jobs SET status = 'queued', last_error = %s, "
+        "visible_at = CURRENT_TIMESTAMP + make_interval(secs => %s), updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (error, RETRY_BACKOFF * job['attempts'], job['id'])
+    )
+    return True
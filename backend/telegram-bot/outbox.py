@@ -0,0 +1,277 @@
+'''
+Outbound scheduler for Bot API calls of this warm instance.
+Calls wait in one priority queue (card deliveries first, cosmetic progress
+edits last) and are sent by a few sender threads, each call taking a token
+from the global bucket and from its chat's bucket. A chat has at most one
+call in flight, so its calls keep their order within a priority.
+A queued editMessageText is replaced by a newer edit of the same message,
+and dropped when that message gets deleted. A 429 answer pauses the chat
+for its retry_after and puts the call back in the queue. A caller that
+stops waiting withdraws its call, so a call nobody waits for is never sent.
+flush() waits for everything queued; an invocation that only needs its own
+calls out calls track() first and wait_tracked() at the end.
+'''
+
+import bisect
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, wait
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+import tracing
+
+PRIORITY_DELIVERY = 0
+PRIORITY_REPLY = 1
+PRIORITY_PROGRESS = 2
+
+# Bot API limits: about 30 messages per second overall and 1 per second in a chat
+GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', 30))
+CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+SENDERS = int(os.environ.get('TELEGRAM_SENDERS', 4))
+
+# A 429 asking to wait longer than this fails the call instead
+MAX_RETRY_AFTER = 30
+MAX_TRACKED_CHATS = 1000
+
+# Futures of the calls queued since track() in this context
+_tracked: ContextVar[Optional[List[Future]]] = ContextVar('outbox_tracked', default=None)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        '''
+        Seconds until a token is available (and any retry_after pause is over).
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        return self.wait_time(now) == 0 and self.tokens >= self.burst
+
+
+class Call:
+    def __init__(self, priority: int, seq: int, chat_id: Any, method: str, payload: Dict[str, Any],
+                 send: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]], key: Optional[Tuple]):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.send = send
+        self.key = key
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+
+    def order(self) -> Tuple[int, int]:
+        return (self.priority, self.seq)
+
+
+class Outbox:
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: float = GLOBAL_BURST,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        senders: int = SENDERS
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.senders = senders
+        self.chats: Dict[Any, TokenBucket] = {}
+        self.busy: set = set()
+        self.queue: List[Tuple[Tuple[int, int], Call]] = []
+        self.keyed: Dict[Tuple, Call] = {}
+        self.in_flight = 0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.threads: List[threading.Thread] = []
+        self.stats = {'sent': 0, 'coalesced': 0, 'superseded': 0, 'rateLimited': 0, 'failed': 0, 'withdrawn': 0}
+
+    def submit(
+        self,
+        chat_id: Any,
+        method: str,
+        payload: Dict[str, Any],
+        send: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+        priority: int,
+        key: Optional[Tuple] = None,
+        supersedes: Optional[Tuple] = None
+    ) -> Future:
+        '''
+        Queues a call; the future resolves to the Bot API answer (None if the
+        request failed). A queued call with the same `key` takes the new
+        payload instead; a queued call keyed `supersedes` is dropped.
+        '''
+        send = tracing.bind(send)
+        with self.cond:
+            if supersedes is not None:
+                stale = self.keyed.pop(supersedes, None)
+                if stale is not None:
+                    self.queue.remove((stale.order(), stale))
+                    stale.future.set_result(None)
+                    self.stats['superseded'] += 1
+
+            queued = self.keyed.get(key) if key is not None else None
+            if queued is not None:
+                queued.payload = payload
+                self.stats['coalesced'] += 1
+                if priority < queued.priority:
+                    self.queue.remove((queued.order(), queued))
+                    queued.priority = priority
+                    bisect.insort(self.queue, (queued.order(), queued))
+                call = queued
+            else:
+                call = Call(priority, next(self.seq), chat_id, method, payload, send, key)
+                if key is not None:
+                    self.keyed[key] = call
+                bisect.insort(self.queue, (call.order(), call))
+                self.start()
+                self.cond.notify()
+        tracked = _tracked.get()
+        if tracked is not None:
+            tracked.append(call.future)
+        return call.future
+
+    def withdraw(self, future: Future) -> bool:
+        '''
+        Takes the call of `future` off the queue and cancels it. False if the
+        call is not queued: it was already answered or is being sent.
+        '''
+        with self.cond:
+            for index, (_, call) in enumerate(self.queue):
+                if call.future is future:
+                    del self.queue[index]
+                    if call.key is not None and self.keyed.get(call.key) is call:
+                        del self.keyed[call.key]
+                    future.cancel()
+                    self.stats['withdrawn'] += 1
+                    self.cond.notify_all()
+                    return True
+        return False
+
+    def flush(self, timeout: float) -> bool:
+        '''
+        Waits until every queued call was sent; False if `timeout` ran out first.
+        '''
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.queue or self.in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def track(self) -> None:
+        _tracked.set([])
+
+    def wait_tracked(self, timeout: float) -> bool:
+        '''
+        Waits for the calls queued since track(); False if `timeout` ran out first.
+        '''
+        futures = _tracked.get() or []
+        _tracked.set(None)
+        return not wait(futures, timeout).not_done
+
+    def start(self) -> None:
+        while len(self.threads) < self.senders:
+            thread = threading.Thread(target=self.run, name=f'telegram-sender-{len(self.threads)}', daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= MAX_TRACKED_CHATS:
+                for idle_chat in [chat for chat, chat_bucket in self.chats.items()
+                                  if chat not in self.busy and chat_bucket.idle(now)]:
+                    del self.chats[idle_chat]
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def next_call(self) -> Call:
+        '''
+        Blocks until some queued call may be sent and takes it off the queue.
+        '''
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                delay = None
+                global_wait = self.global_bucket.wait_time(now)
+                for index, (_, call) in enumerate(self.queue):
+                    if call.chat_id in self.busy:
+                        continue
+                    call_wait = max(global_wait, self.chat_bucket(call.chat_id, now).wait_time(now))
+                    if call_wait <= 0:
+                        del self.queue[index]
+                        if call.key is not None and self.keyed.get(call.key) is call:
+                            del self.keyed[call.key]
+                        self.global_bucket.take()
+                        self.chats[call.chat_id].take()
+                        self.busy.add(call.chat_id)
+                        self.in_flight += 1
+                        return call
+                    delay = call_wait if delay is None else min(delay, call_wait)
+                self.cond.wait(delay)
+
+    def run(self) -> None:
+        while True:
+            call = self.next_call()
+            tracing.observe(f'telegram.queue.{call.method}', time.monotonic() - call.enqueued_at)
+            result = None
+            try:
+                result = call.send(call.payload)
+            except Exception as e:
+                print(f"Telegram {call.method} error: {e}")
+
+            retry_after = retry_after_of(result)
+            with self.cond:
+                self.busy.discard(call.chat_id)
+                self.in_flight -= 1
+                if retry_after is not None and retry_after <= MAX_RETRY_AFTER:
+                    self.stats['rateLimited'] += 1
+                    print(f"Telegram {call.method} rate limited in chat {call.chat_id}, retrying in {retry_after} s")
+                    self.chat_bucket(call.chat_id, time.monotonic()).blocked_until = time.monotonic() + retry_after
+                    self.requeue(call)
+                else:
+                    self.stats['sent' if result and result.get('ok') else 'failed'] += 1
+                    call.future.set_result(result)
+                self.cond.notify_all()
+
+    def requeue(self, call: Call) -> None:
+        if call.key is not None:
+            newer = self.keyed.get(call.key)
+            if newer is not None:
+                # a newer edit of the same message is already queued
+                call.future.set_result(None)
+                return
+            self.keyed[call.key] = call
+        bisect.insort(self.queue, (call.order(), call))
+
+
+def retry_after_of(result: Optional[Dict[str, Any]]) -> Optional[float]:
+    if not result or result.get('ok') or result.get('error_code') != 429:
+        return None
+    return float((result.get('parameters') or {}).get('retry_after') or 1)
+
+
+OUTBOX = Outbox()
@@ -0,0 +1,49 @@
+'''
+Daily generation quota stored on the users row.
+A generation is reserved before any paid work starts and refunded if it fails.
+'''
+
+import os
+from datetime import date
+from typing import Optional
+
+# Used when neither users.daily_limit nor the user's tier sets a limit
+DEFAULT_DAILY_LIMIT = int(os.environ.get('DEFAULT_DAILY_LIMIT', 3))
+
+# Per-user override first, then the tier's limit, then DEFAULT_DAILY_LIMIT
+USER_LIMIT_SQL = '''COALESCE(
+        users.daily_limit,
+        (SELECT tiers.daily_limit FROM tiers WHERE tiers.name = users.tier),
+        %(default_limit)s
+    )'''
+
+# Takes one generation from today's quota; no row comes back when it is used up
+RESERVE_GENERATION_SQL = '''
+    UPDATE users SET generation_count = generation_count + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(user_id)s AND last_generation_date = %(today)s
+        AND generation_count < ''' + USER_LIMIT_SQL + '''
+    RETURNING generation_count
+'''
+
+# Gives a reserved generation back after a failure (no-op once the day has rolled over)
+REFUND_GENERATION_SQL = '''
+    UPDATE users SET generation_count = generation_count - 1, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(user_id)s AND last_generation_date = %(today)s AND generation_count > 0
+'''
+
+
+def reserve_generation(cur, user_id: int, today: date) -> Optional[int]:
+    '''
+    Atomically counts one generation against today's quota.
+    Returns the new generation_count, or None if the limit is reached.
+    '''
+    cur.execute(RESERVE_GENERATION_SQL, {'user_id': user_id, 'today': today, 'default_limit': DEFAULT_DAILY_LIMIT})
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def refund_generation(cur, user_id: int, today: date) -> None:
+    try:
+        cur.execute(REFUND_GENERATION_SQL, {'user_id': user_id, 'today': today})
+    except Exception as e:
+        print(f"Quota refund error: {e}")
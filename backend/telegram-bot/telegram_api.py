@@ -0,0 +1,102 @@
+'''
+Thin wrappers over the Telegram Bot API methods the bot uses.
+Every call goes through the outbox scheduler (outbox.py), which rate-limits
+per chat and globally, coalesces progress edits and retries 429 answers.
+sendMessage, editMessageText and deleteMessage are queued without waiting
+(OUTBOX.flush() waits for them); the calls whose answer is needed block.
+Errors are logged and swallowed so a failed status update never breaks a generation.
+TELEGRAM_API_BASE points them at another Bot API server (e.g. bench/fake_upstream.py).
+'''
+
+import os
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Optional, Tuple
+
+from http_client import get_session
+from outbox import OUTBOX, PRIORITY_DELIVERY, PRIORITY_REPLY
+from tracing import span
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+
+# How long a blocking call may wait in the outbox queue plus the request itself
+CALL_TIMEOUT = 40
+SEND_TIMEOUT = 10
+
+
+def send_message(token: str, chat_id: int, text: str):
+    _submit(token, 'sendMessage', {'chat_id': chat_id, 'text': text}, PRIORITY_REPLY)
+
+
+def send_message_with_response(token: str, chat_id: int, text: str):
+    return _wait('sendMessage', _submit(token, 'sendMessage', {'chat_id': chat_id, 'text': text}, PRIORITY_REPLY))
+
+
+def edit_message(token: str, chat_id: int, message_id: int, text: str, priority: int = PRIORITY_REPLY):
+    '''
+    priority=PRIORITY_PROGRESS marks a cosmetic edit that yields to everything else.
+    '''
+    _submit(
+        token, 'editMessageText', {'chat_id': chat_id, 'message_id': message_id, 'text': text}, priority,
+        key=_edit_key(chat_id, message_id)
+    )
+
+
+def delete_message(token: str, chat_id: int, message_id: int):
+    _submit(
+        token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}, PRIORITY_REPLY,
+        supersedes=_edit_key(chat_id, message_id)
+    )
+
+
+def send_photo(token: str, chat_id: int, photo: str, caption: str) -> Optional[Dict[str, Any]]:
+    '''
+    `photo` is a URL or the file_id of a photo Telegram already has.
+    Returns the sent Message, or None if Telegram did not take the photo.
+    '''
+    future = _submit(token, 'sendPhoto', {'chat_id': chat_id, 'photo': photo, 'caption': caption}, PRIORITY_DELIVERY)
+    result = _wait('sendPhoto', future)
+    if not result:
+        return None
+    if not result.get('ok'):
+        print(f"Send photo error: {result.get('error_code')} {result.get('description')}")
+        return None
+    return result['result']
+
+
+def largest_photo_file_id(message: Dict[str, Any]) -> Optional[str]:
+    sizes = message.get('photo') or []
+    return sizes[-1]['file_id'] if sizes else None
+
+
+def _edit_key(chat_id: int, message_id: int) -> Tuple:
+    return ('editMessageText', chat_id, message_id)
+
+
+def _submit(token: str, method: str, payload: Dict[str, Any], priority: int, **kwargs):
+    return OUTBOX.submit(payload['chat_id'], method, payload, lambda body: _post(token, method, body), priority, **kwargs)
+
+
+def _post(token: str, method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    with span(f'telegram.{method}'):
+        response = get_session().post(f"{TELEGRAM_API_BASE}/bot{token}/{method}", json=payload, timeout=SEND_TIMEOUT)
+    return response.json()
+
+
+def _wait(method: str, future) -> Optional[Dict[str, Any]]:
+    '''
+    Waits for the answer of a queued call. A call still queued after
+    CALL_TIMEOUT is withdrawn so it never goes out behind the caller's back;
+    one already being sent is waited for, its answer says whether it went out.
+    '''
+    timeout = CALL_TIMEOUT
+    while True:
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if OUTBOX.withdraw(future):
+                print(f"Telegram {method} still queued after {CALL_TIMEOUT} s, withdrawn")
+                return None
+            timeout = SEND_TIMEOUT + 5
+        except Exception as e:
+            print(f"Telegram {method} error: {e}")
+            return None
@@ -0,0 +1,22 @@
+'''
+file_ids of result images the bot already sent (telegram_files table).
+Telegram fetches a photo sent by URL from the upstream host itself; the
+file_id it returns sends the same image again without that fetch, and keeps
+working after the upstream URL has expired.
+'''
+
+from typing import Optional
+
+
+def find(cur, image_url: str) -> Optional[str]:
+    cur.execute("SELECT file_id FROM telegram_files WHERE image_url = %s", (image_url,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def remember(cur, image_url: str, file_id: str) -> None:
+    cur.execute(
+        "INSERT INTO telegram_files (image_url, file_id) VALUES (%s, %s) "
+        "ON CONFLICT (image_url) DO UPDATE SET file_id = EXCLUDED.file_id, created_at = CURRENT_TIMESTAMP",
+        (image_url, file_id)
+    )
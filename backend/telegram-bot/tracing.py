@@ -0,0 +1,180 @@
+'''
+Per-stage timing for a request.
+span('stage') times a block: the duration always goes into an in-process
+histogram (snapshot() serves them, per warm instance), and for sampled
+requests (TRACE_SAMPLE_RATE, default 1) a JSON record with the request id is
+printed. finish() prints one summary record per sampled request with the
+time spent in every stage.
+'''
+
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, Iterator, Optional
+
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))
+
+# Histogram bucket upper bounds, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+
+SQL_TABLE = re.compile(r'\b(?:INTO|UPDATE|FROM)\s+(\w+)', re.IGNORECASE)
+
+
+class Trace:
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, duration: float) -> None:
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + duration
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, duration: float, ok: bool) -> None:
+        index = 0
+        while index < len(BUCKETS) and duration > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        if not ok:
+            self.errors += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        '''
+        Upper bound of the bucket holding the q-quantile (capped at the max seen).
+        '''
+        if not self.count:
+            return None
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg': round(self.total / self.count, 4) if self.count else None,
+            'max': round(self.max, 4),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS + ('inf',), self.counts) if count}
+        }
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar('trace', default=None)
+_histograms: Dict[str, Histogram] = {}
+_histograms_lock = threading.Lock()
+
+
+def start(request_id: str) -> Trace:
+    trace = Trace(request_id, random.random() < SAMPLE_RATE)
+    _current.set(trace)
+    return trace
+
+
+def finish(trace: Trace, **attrs) -> None:
+    duration = time.perf_counter() - trace.started
+    if trace.sampled:
+        emit({
+            'trace': 'request',
+            'requestId': trace.request_id,
+            'ms': round(duration * 1000, 1),
+            'stages': {stage: round(seconds * 1000, 1) for stage, seconds in sorted(trace.stages.items())},
+            **attrs
+        })
+    _current.set(None)
+
+
+@contextmanager
+def span(stage: str, **attrs) -> Iterator[Dict[str, Any]]:
+    '''
+    Times the block as `stage`. The yielded dict can be filled with extra
+    attributes for the record (e.g. a status); an exception marks it failed.
+    '''
+    started = time.perf_counter()
+    ok = True
+    try:
+        yield attrs
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        observe(stage, duration, ok)
+        trace = _current.get()
+        if trace is not None:
+            trace.add(stage, duration)
+            if trace.sampled:
+                emit({
+                    'trace': 'span',
+                    'requestId': trace.request_id,
+                    'stage': stage,
+                    'ms': round(duration * 1000, 1),
+                    'ok': ok,
+                    **attrs
+                })
+
+
+def bind(fn: Callable) -> Callable:
+    '''
+    Wraps fn so it runs with the caller's context variables (the current
+    trace, the invocation's deadline) when run on another thread.
+    '''
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a copy per call: the same wrapper may run on several threads at once
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+def observe(stage: str, duration: float, ok: bool = True) -> None:
+    with _histograms_lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(duration, ok)
+
+
+def snapshot() -> Dict[str, Any]:
+    with _histograms_lock:
+        return {stage: histogram.snapshot() for stage, histogram in sorted(_histograms.items())}
+
+
+def sql_stage(query: Any) -> str:
+    '''
+    'db.<verb>.<table>' for a SQL statement, e.g. db.update.generation_jobs.
+    '''
+    text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+    words = text.split(None, 1)
+    verb = words[0].lower() if words else 'query'
+    table = SQL_TABLE.search(text)
+    return f'db.{verb}.{table.group(1).lower()}' if table else f'db.{verb}'
+
+
+def emit(record: Dict[str, Any]) -> None:
+    print(json.dumps(record, ensure_ascii=False, default=str))
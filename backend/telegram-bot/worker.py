@@ -0,0 +1,449 @@
+'''
+Generation worker: drains the generation_jobs queue.
+In production the webhook triggers drain() through the bot function itself
+(see kick_worker in index.py); it claims no job it has no time left for
+and gives every attempt only what remains of the invocation, passing the
+deadline on to generate-image. Locally run `python worker.py` with
+DATABASE_URL and TELEGRAM_BOT_TOKEN set; --once exits when the queue is empty,
+--stats prints per-stage latency percentiles of recent generations instead.
+'''
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Any, Optional, Tuple
+
+import db
+import deadline
+import generations
+import jobs
+import telegram_files
+import tracing
+from http_client import get_session
+from quota import refund_generation
+from deadline import DeadlineExceeded
+from outbox import OUTBOX, PRIORITY_PROGRESS
+from telegram_api import send_message, edit_message, delete_message, send_photo, largest_photo_file_id
+
+GENERATE_IMAGE_URL = os.environ.get(
+    'GENERATE_IMAGE_URL',
+    'https://functions.poehali.dev/937cd074-b42c-4c14-86bc-4a8b85463284'
+)
+
+# Proves to generate-image that the request's client (the Telegram user) is genuine
+INTERNAL_TOKEN = os.environ.get('INTERNAL_TOKEN', '')
+
+# A drain invocation stops claiming new jobs after this many seconds
+DRAIN_TIME_BUDGET = int(os.environ.get('DRAIN_TIME_BUDGET', 240))
+
+# How long one attempt may wait for its task; a timed-out attempt keeps the
+# taskId on the job and the retry resumes it instead of submitting again
+ATTEMPT_TIMEOUT = int(os.environ.get('ATTEMPT_TIMEOUT', 180))
+# Kept from an attempt's budget for delivering the card afterwards
+DELIVERY_RESERVE = 15
+# drain() claims no new job when less than this is left of the invocation
+MIN_JOB_TIME = 60
+# How long past its budget an attempt's last call may take to come back
+ATTEMPT_GRACE = 5
+SUBMIT_TIMEOUT = 90
+# How long drain() waits at the end for queued status messages to go out
+FLUSH_TIMEOUT = 15
+STATUS_WAIT = 20
+# Backoff after a status answer without a status (503, 5xx) when it sets no Retry-After
+POLL_BACKOFF_START = 1.0
+POLL_BACKOFF_MAX = 30.0
+# Floor between two polls when the long poll comes back early still pending or queued
+MIN_POLL_INTERVAL = float(os.environ.get('MIN_POLL_INTERVAL', 2))
+
+EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='generation')
+
+PROGRESS_MESSAGES = [
+    "⏳ Бабушка подбирает рамочку...",
+    "🌸 Добавляем цветочки и блёстки...",
+    "💐 Бабуля выбирает лучшие пожелания...",
+    "✨ Украшаем открытку с любовью...",
+    "🎨 Наносим бабушкин шарм...",
+    "💝 Добавляем теплоты и уюта..."
+]
+
+QUEUE_MESSAGE = "🕐 Много желающих! Открытка в очереди, перед тобой: {ahead}"
+
+FAILURE_MESSAGE = "❌ Не удалось создать открытку после нескольких попыток. Попробуйте позже!"
+
+
+def drain(bot_token: str, db_url: str, budget: float = DRAIN_TIME_BUDGET) -> int:
+    '''
+    Processes queued jobs until the queue is empty or the time budget is spent.
+    Returns the number of jobs processed.
+    '''
+    started = time.monotonic()
+    processed = 0
+    conn = db.acquire(db_url)
+    cur = conn.cursor()
+
+    try:
+        for job in jobs.reap_expired(cur):
+            fail_job(cur, bot_token, job)
+
+        while time.monotonic() - started < budget:
+            left = deadline.remaining()
+            if left is not None and left < MIN_JOB_TIME:
+                print(f"{left:.0f}s left in this invocation, leaving the queue to the next one")
+                break
+            job = jobs.claim(cur)
+            if not job:
+                break
+            print(f"Processing job {job['id']}, attempt {job['attempts']}/{job['max_attempts']}")
+            with tracing.span('worker.job', jobId=job['id'], attempt=job['attempts']):
+                process_job(cur, bot_token, job, db_url)
+            processed += 1
+    finally:
+        cur.close()
+        db.release(conn)
+        OUTBOX.flush(deadline.budget(FLUSH_TIMEOUT))
+
+    return processed
+
+
+def process_job(cur, bot_token: str, job: Dict[str, Any], db_url: str) -> None:
+    payload = job['payload']
+    chat_id = job['chat_id']
+    message_id = job['status_message_id']
+    caption = f"✅ Готово!\n📊 Использовано: {payload['used']}/{payload['dailyLimit']}"
+    generations.started(cur, job['id'])
+
+    result_url = job['result_url']
+    input_hash = None
+    error = None
+    started = time.monotonic()
+    if result_url:
+        # the card was generated by an earlier attempt, only its delivery failed
+        print(f"Job {job['id']} sends its card again")
+    else:
+        attempt = GenerationAttempt(
+            payload['request'],
+            attempt_budget(),
+            task_id=job['task_id'],
+            on_status=ProgressReporter(bot_token, chat_id, message_id, job['attempts']).update,
+            on_task=lambda task_id: save_task_id(db_url, job['id'], task_id, attempt.input_hash)
+        )
+        result_url, error = generate_card(cur, job, attempt)
+        input_hash = attempt.input_hash
+        if result_url:
+            jobs.set_result(cur, job['id'], result_url, None)
+    generated = time.monotonic()
+
+    if result_url:
+        sent, file_id = deliver_card(cur, bot_token, job, result_url, caption)
+        if sent:
+            # only now: a failed delivery still needs the message for the retry or failure notice
+            if message_id:
+                delete_message(bot_token, chat_id, message_id)
+            jobs.complete(cur, job['id'])
+            generations.update(cur, job['id'], 'done', generated - started, time.monotonic() - generated,
+                input_hash, result_url, file_id)
+            return
+        error = 'sendPhoto failed'
+
+    print(f"Job {job['id']} attempt {job['attempts']} failed: {error}")
+    generations.update(cur, job['id'], 'queued', generated - started, time.monotonic() - generated, input_hash, result_url)
+    if not jobs.retry_or_fail(cur, job, error):
+        fail_job(cur, bot_token, job)
+
+
+def generate_card(cur, job: Dict[str, Any], attempt: 'GenerationAttempt') -> Tuple[Optional[str], Optional[str]]:
+    '''
+    Runs the job's GenerationAttempt; returns (result URL, None) or (None, error).
+    '''
+    if job['task_id']:
+        print(f"Job {job['id']} resumes task {job['task_id']}")
+
+    future = attempt.start()
+    try:
+        return future.result(timeout=attempt.budget + ATTEMPT_GRACE), None
+    except (FutureTimeoutError, DeadlineExceeded):
+        attempt.cancel()
+        return None, 'attempt timed out'
+    except GenerationFailed as e:
+        # the upstream task is dead; the next attempt has to submit a new one
+        jobs.set_task(cur, job['id'], None)
+        return None, str(e)
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+def attempt_budget() -> float:
+    '''
+    ATTEMPT_TIMEOUT, or what the invocation's deadline leaves after DELIVERY_RESERVE.
+    '''
+    return deadline.budget(ATTEMPT_TIMEOUT + DELIVERY_RESERVE) - DELIVERY_RESERVE
+
+
+def deliver_card(cur, bot_token: str, job: Dict[str, Any], result_url: str, caption: str) -> Tuple[bool, Optional[str]]:
+    '''
+    Sends the card by the file_id Telegram gave for the same image before,
+    if there is one, and by URL otherwise (or when the file_id is refused).
+    The new file_id is stored on the job and in telegram_files.
+    Returns (sent, file_id).
+    '''
+    file_id = job['result_file_id'] or telegram_files.find(cur, result_url)
+    if file_id:
+        if send_photo(bot_token, job['chat_id'], file_id, caption):
+            jobs.set_result(cur, job['id'], result_url, file_id)
+            return True, file_id
+        print(f"Sending file_id {file_id} failed, sending the URL")
+
+    message = send_photo(bot_token, job['chat_id'], result_url, caption)
+    if not message:
+        return False, None
+    file_id = largest_photo_file_id(message)
+    if file_id:
+        jobs.set_result(cur, job['id'], result_url, file_id)
+        telegram_files.remember(cur, result_url, file_id)
+    return True, file_id
+
+
+def fail_job(cur, bot_token: str, job: Dict[str, Any]) -> None:
+    refund_generation(cur, job['user_id'], job['quota_date'])
+    generations.update(cur, job['id'], 'failed')
+
+    if job['status_message_id']:
+        edit_message(bot_token, job['chat_id'], job['status_message_id'], FAILURE_MESSAGE)
+    else:
+        send_message(bot_token, job['chat_id'], FAILURE_MESSAGE)
+
+
+def save_task_id(db_url: str, job_id: int, task_id: str, input_hash: Optional[str]) -> None:
+    # runs on the attempt's thread, so it uses its own pooled connection
+    conn = db.acquire(db_url)
+    try:
+        with conn.cursor() as cur:
+            jobs.set_task(cur, job_id, task_id)
+            generations.task_submitted(cur, job_id, task_id, input_hash)
+    finally:
+        db.release(conn)
+
+
+class GenerationFailed(Exception):
+    '''
+    generate-image reported the task itself as failed (not a transport error).
+    '''
+
+
+class ProgressReporter:
+    '''
+    Edits the status message when the generation moves to a new state:
+    a generation waiting in generate-image's queue shows how many are
+    ahead (again whenever that changes), a submitted one the next funny
+    message for this attempt. 'pending' answers that change nothing leave
+    the message alone; the finished card replaces it.
+    '''
+
+    def __init__(self, bot_token: str, chat_id: int, message_id: Optional[int], attempt: int = 1):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.progress_message = PROGRESS_MESSAGES[min(attempt, len(PROGRESS_MESSAGES) - 1)]
+        self.state: Optional[str] = None
+        self.queue_position: Optional[int] = None
+
+    def update(self, status: str, queue_position: Optional[int] = None) -> None:
+        if not self.message_id:
+            return
+        if status == 'queued':
+            if queue_position and queue_position != self.queue_position:
+                self.state = 'queued'
+                self.queue_position = queue_position
+                text = QUEUE_MESSAGE.format(ahead=queue_position - 1)
+                edit_message(self.bot_token, self.chat_id, self.message_id, text, PRIORITY_PROGRESS)
+            return
+        if status in ('submitted', 'pending') and self.state != 'submitted':
+            # a resumed task reports 'pending' first; that is its submit as far as the user sees
+            self.state = 'submitted'
+            edit_message(self.bot_token, self.chat_id, self.message_id, self.progress_message, PRIORITY_PROGRESS)
+
+
+class GenerationAttempt:
+    '''
+    One attempt at getting a card for a job, run on EXECUTOR within `budget`
+    seconds, which every call to generate-image gets as its X-Deadline.
+    Submits the request to generate-image unless a taskId from an earlier
+    attempt is given, then long-polls that task's status. on_task receives a
+    new taskId as soon as it exists (input_hash, the photo's sha256 reported
+    by generate-image, is set by then); a queue ticket counts as a taskId and
+    is replaced by the real one once the queue submits it. on_status receives
+    'submitted', every 'pending' answer and 'queued' with the queue position.
+    A status answer without a status (503 while generate-image's upstream is
+    unavailable, any other error) is retried after its Retry-After or an
+    exponential backoff. cancel() stops the attempt at the next poll
+    boundary, leaving task_id set so a later attempt can resume the same
+    task; running out of budget raises DeadlineExceeded, with task_id left
+    set the same way.
+    '''
+
+    def __init__(
+        self,
+        request: Dict[str, Any],
+        budget: float,
+        task_id: Optional[str] = None,
+        on_status: Optional[Callable[..., None]] = None,
+        on_task: Optional[Callable[[str], None]] = None
+    ):
+        self.request = request
+        self.budget = budget
+        self.task_id = task_id
+        self.input_hash: Optional[str] = None
+        self.on_status = on_status or (lambda status, queue_position=None: None)
+        self.on_task = on_task or (lambda task_id: None)
+        self.cancelled = threading.Event()
+
+    def start(self) -> Future:
+        return EXECUTOR.submit(tracing.bind(self.run))
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def run(self) -> Optional[str]:
+        with deadline.limit(self.budget):
+            return self.generate()
+
+    def generate(self) -> Optional[str]:
+        if not self.task_id:
+            result = self.submit()
+            self.input_hash = result.get('inputHash')
+            if result.get('status') == 'success':
+                return result['imageUrl']
+            self.task_id = result['taskId']
+            self.on_task(self.task_id)
+            if result.get('queuePosition'):
+                self.on_status('queued', result['queuePosition'])
+            else:
+                self.on_status('submitted')
+
+        failures = 0
+        while not self.cancelled.is_set():
+            started = time.monotonic()
+            result, retry_after = self.poll()
+            if result is None:
+                failures += 1
+                self.back_off(retry_after or min(POLL_BACKOFF_MAX, POLL_BACKOFF_START * 2 ** (failures - 1)))
+                continue
+            failures = 0
+            status = result.get('status')
+            if status == 'success':
+                return result['imageUrl']
+            if status == 'failed':
+                raise GenerationFailed(result.get('message') or 'generation failed')
+            if result.get('queuePosition'):
+                self.on_status('queued', result['queuePosition'])
+                self.back_off(max(0, MIN_POLL_INTERVAL - (time.monotonic() - started)))
+                continue
+            if result.get('taskId') and result['taskId'] != self.task_id:
+                # the queue ticket got its task; later attempts resume that task
+                self.task_id = result['taskId']
+                self.on_task(self.task_id)
+                self.on_status('submitted')
+                continue
+            self.on_status('pending')
+            self.back_off(max(0, MIN_POLL_INTERVAL - (time.monotonic() - started)))
+
+        return None
+
+    def back_off(self, delay: float) -> None:
+        '''
+        Waits `delay` seconds before the next poll (cancel() cuts it short);
+        raises DeadlineExceeded when the budget does not cover the wait.
+        '''
+        left = deadline.remaining()
+        if left is not None and left < delay + deadline.MIN_CALL_TIME:
+            raise DeadlineExceeded(f'{left:.1f}s left, status retry needs {delay:.0f}s')
+        self.cancelled.wait(delay)
+
+    def submit(self) -> Dict[str, Any]:
+        with tracing.span('generate.submit') as attrs:
+            response = get_session().post(
+                GENERATE_IMAGE_URL,
+                json={**self.request, 'mode': 'submit'},
+                headers={'Content-Type': 'application/json', 'X-Internal-Token': INTERNAL_TOKEN, **deadline.header()},
+                timeout=deadline.timeout(SUBMIT_TIMEOUT)
+            )
+            attrs['httpStatus'] = response.status_code
+            result = response.json()
+        if result.get('status') not in ('success', 'pending') or not (result.get('imageUrl') or result.get('taskId')):
+            raise RuntimeError(f"submit failed: {result.get('error') or response.status_code}")
+        return result
+
+    def poll(self) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        '''
+        One long-poll of the task's status. Returns (status body, None), or
+        (None, Retry-After seconds if the answer had one) when the answer
+        carries no status of the task.
+        '''
+        with tracing.span('generate.poll', taskId=self.task_id) as attrs:
+            response = get_session().get(
+                GENERATE_IMAGE_URL,
+                params={'taskId': self.task_id, 'wait': STATUS_WAIT},
+                headers=deadline.header(),
+                timeout=deadline.timeout(STATUS_WAIT + 20)
+            )
+            attrs['httpStatus'] = response.status_code
+            try:
+                result = response.json()
+            except ValueError:
+                result = {}
+            attrs['status'] = result.get('status')
+        # a failed task answers 500 with status 'failed'; any other error is the status check's own
+        if response.status_code in (200, 202) or result.get('status') == 'failed':
+            return result, None
+        print(f"Status check of {self.task_id} answered {response.status_code}: {result.get('error')}")
+        return None, retry_after(response, result)
+
+
+def retry_after(response: Any, body: Dict[str, Any]) -> Optional[float]:
+    '''
+    Seconds from the Retry-After header or the body's retryAfter; None if neither is a number.
+    '''
+    for value in (response.headers.get('Retry-After'), body.get('retryAfter')):
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Drain the generation_jobs queue')
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    parser.add_argument('--idle-sleep', type=float, default=2.0, help='seconds to wait when the queue is empty')
+    parser.add_argument('--stats', type=int, metavar='HOURS', help='print latency percentiles of the last HOURS and exit')
+    args = parser.parse_args()
+
+    db_url = os.environ['DATABASE_URL']
+    if args.stats:
+        conn = db.acquire(db_url)
+        try:
+            with conn.cursor() as cur:
+                print(json.dumps(generations.latency_stats(cur, args.stats), indent=2))
+        finally:
+            db.release(conn)
+        return
+
+    bot_token = os.environ['TELEGRAM_BOT_TOKEN']
+
+    while True:
+        trace = tracing.start(f'worker-{os.getpid()}-{int(time.time())}')
+        processed = drain(bot_token, db_url)
+        tracing.finish(trace, processed=processed)
+        if processed:
+            print(f"Processed {processed} job(s)")
+        elif args.once:
+            break
+        else:
+            time.sleep(args.idle_sleep)
+
+
+if __name__ == '__main__':
+    main()
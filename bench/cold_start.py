@@ -0,0 +1,243 @@
+'''
+Cold-start benchmark of both functions.
+Every entry point runs in a fresh interpreter (--runs times, after one
+discarded run that writes the bytecode cache): the child imports
+backend/<function>/index.py, calls the handler once with the entry point's
+event and reports import time, handler time, peak RSS (next to the peak RSS
+of a bare interpreter, for reference) and which LAZY_MODULES got loaded.
+
+Entry points are the requests that must stay cheap on a new instance:
+CORS preflights, the bot's non-message updates and the style list. None of
+them may load LAZY_MODULES; those come in with the first real upstream call,
+database query or image decode.
+
+Medians are compared against a baseline (bench/cold_start_baseline.json
+unless --baseline names another file): the script exits 1 when an entry point
+loads a lazy module or is slower / bigger than its baseline beyond the
+tolerances. --update-baseline rewrites the baseline file from this run.
+Timings only compare on the same machine, so CI measures the base commit's
+tree (--backend) into a fresh baseline first and then the change against it.
+--python FUNCTION=PATH runs a function's children in its own interpreter
+(e.g. a venv with that function's requirements).
+
+Usage: python bench/cold_start.py [--runs 5] [--json] [--update-baseline]
+                                  [--baseline PATH] [--backend DIR]
+                                  [--python FUNCTION=PATH ...]
+                                  [--time-tolerance 0.5] [--rss-tolerance 0.25]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_baseline.json')
+
+# Modules that only the first real use of a function may import
+LAZY_MODULES = ('requests', 'urllib3', 'psycopg2', 'PIL')
+
+# Environment that changes what the functions do at import or in the handler
+CLEARED_ENV = ('DATABASE_URL', 'TELEGRAM_BOT_TOKEN', 'WORKER_SECRET', 'WORKER_URL', 'CALLBACK_URL', 'CALLBACK_SECRET',
+               'PROMPT_TEMPLATES_DIR', 'UPSTREAM_LIMITER', 'RESULT_CACHE_BACKEND', 'TRACE_SAMPLE_RATE',
+               'IMAGE_STORE_BACKEND')
+
+ENTRY_POINTS: List[Dict[str, Any]] = [
+    {'name': 'generate-image import', 'function': 'generate-image', 'event': None},
+    {'name': 'generate-image OPTIONS', 'function': 'generate-image', 'event': {'httpMethod': 'OPTIONS'}},
+    {
+        'name': 'generate-image GET styles',
+        'function': 'generate-image',
+        'event': {'httpMethod': 'GET', 'queryStringParameters': {'styles': '1'}}
+    },
+    {'name': 'telegram-bot import', 'function': 'telegram-bot', 'event': None},
+    {'name': 'telegram-bot OPTIONS', 'function': 'telegram-bot', 'event': {'httpMethod': 'OPTIONS'}},
+    {
+        'name': 'telegram-bot non-message update',
+        'function': 'telegram-bot',
+        'event': {'httpMethod': 'POST', 'headers': {}, 'body': json.dumps({'update_id': 1, 'edited_message': {}})},
+        'env': {'TELEGRAM_BOT_TOKEN': 'cold-start-token', 'DATABASE_URL': 'postgresql://cold-start.invalid/db'}
+    }
+]
+
+# Runs in the child: sys.argv[1] is the entry point as JSON; prints one JSON line
+CHILD = '''
+import io, json, resource, sys, time, types
+entry = json.loads(sys.argv[1])
+sys.path.insert(0, entry['path'])
+stdout, sys.stdout = sys.stdout, io.StringIO()
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+if entry['event'] is not None:
+    response = index.handler(entry['event'], types.SimpleNamespace(request_id='cold-start'))
+    assert response['statusCode'] == 200, response
+handled = time.perf_counter()
+sys.stdout = stdout
+print(json.dumps({
+    'importMs': (imported - started) * 1000,
+    'handlerMs': (handled - imported) * 1000,
+    'rssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'lazyLoaded': sorted(name for name in entry['lazy'] if name in sys.modules)
+}))
+'''
+
+
+def run_child(entry: Dict[str, Any], backend: str, python: str) -> Dict[str, Any]:
+    env = {key: value for key, value in os.environ.items() if key not in CLEARED_ENV}
+    env.update(entry.get('env') or {})
+    path = os.path.join(backend, entry['function'])
+    argument = json.dumps({'path': path, 'event': entry['event'], 'lazy': LAZY_MODULES})
+    result = subprocess.run(
+        [python, '-c', CHILD, argument],
+        cwd=path,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{entry['name']} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(entry: Dict[str, Any], runs: int, backend: str, python: str) -> Dict[str, Any]:
+    run_child(entry, backend, python)
+    samples = [run_child(entry, backend, python) for _ in range(runs)]
+    import_ms = statistics.median(sample['importMs'] for sample in samples)
+    handler_ms = statistics.median(sample['handlerMs'] for sample in samples)
+    return {
+        'importMs': round(import_ms, 1),
+        'handlerMs': round(handler_ms, 1),
+        'totalMs': round(import_ms + handler_ms, 1),
+        'rssMb': round(statistics.median(sample['rssKb'] for sample in samples) / 1024, 1),
+        'lazyLoaded': sorted(set().union(*(sample['lazyLoaded'] for sample in samples)))
+    }
+
+
+def interpreter_rss_mb() -> float:
+    result = subprocess.run(
+        [sys.executable, '-c', 'import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'],
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return round(int(result.stdout) / 1024, 1)
+
+
+def regressions(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    time_tolerance: float,
+    time_slack_ms: float,
+    rss_tolerance: float,
+    rss_slack_mb: float
+) -> List[str]:
+    '''
+    What got worse: lazy modules loaded eagerly, or total time / RSS above
+    baseline * (1 + tolerance) + slack. The slack keeps tiny entry points
+    from failing on scheduler noise.
+    '''
+    found = []
+    for name, result in results.items():
+        if result['lazyLoaded']:
+            found.append(f"{name}: loads {', '.join(result['lazyLoaded'])} at cold start")
+        before = baseline.get(name)
+        if before is None:
+            continue
+        time_limit = before['totalMs'] * (1 + time_tolerance) + time_slack_ms
+        if result['totalMs'] > time_limit:
+            found.append(f"{name}: {result['totalMs']} ms, baseline {before['totalMs']} ms (limit {time_limit:.1f} ms)")
+        rss_limit = before['rssMb'] * (1 + rss_tolerance) + rss_slack_mb
+        if result['rssMb'] > rss_limit:
+            found.append(f"{name}: {result['rssMb']} MB RSS, baseline {before['rssMb']} MB (limit {rss_limit:.1f} MB)")
+    return found
+
+
+def load_baseline(path: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)['entryPoints']
+
+
+def interpreters(options: List[str]) -> Dict[str, str]:
+    '''
+    Parses the --python FUNCTION=PATH options.
+    '''
+    found = {}
+    for option in options:
+        function, separator, path = option.partition('=')
+        if not separator or not path:
+            raise SystemExit(f"--python expects FUNCTION=PATH, got {option!r}")
+        found[function] = path
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Cold-start import time and memory of both functions')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='allowed relative slowdown')
+    parser.add_argument('--time-slack-ms', type=float, default=15.0)
+    parser.add_argument('--rss-tolerance', type=float, default=0.25, help='allowed relative RSS growth')
+    parser.add_argument('--rss-slack-mb', type=float, default=2.0)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline file to compare with (and to update)')
+    parser.add_argument('--update-baseline', action='store_true', help='write this run to the baseline file')
+    parser.add_argument('--backend', default=BACKEND_DIR, help='backend tree to measure, e.g. a worktree of another commit')
+    parser.add_argument('--python', action='append', default=[], metavar='FUNCTION=PATH',
+                        help="interpreter for one function's entry points")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    pythons = interpreters(args.python)
+    results = {
+        entry['name']: measure(entry, args.runs, args.backend, pythons.get(entry['function'], sys.executable))
+        for entry in ENTRY_POINTS
+    }
+    interpreter_mb = interpreter_rss_mb()
+    baseline = load_baseline(args.baseline)
+    found = regressions(results, baseline or {}, args.time_tolerance, args.time_slack_ms,
+                        args.rss_tolerance, args.rss_slack_mb)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'runs': args.runs,
+                'interpreterRssMb': interpreter_mb,
+                'entryPoints': results
+            }, f, indent=2)
+            f.write('\n')
+
+    if args.json:
+        print(json.dumps({
+            'interpreterRssMb': interpreter_mb,
+            'entryPoints': results,
+            'baseline': baseline,
+            'regressions': found
+        }, indent=2))
+    else:
+        print(f"  {'entry point':<34} {'import':>9} {'handler':>9} {'total':>9} {'baseline':>9} {'RSS':>8}")
+        for name, result in results.items():
+            before = (baseline or {}).get(name)
+            print(f"  {name:<34} {result['importMs']:>7.1f}ms {result['handlerMs']:>7.1f}ms {result['totalMs']:>7.1f}ms "
+                  f"{fmt_ms(before['totalMs'] if before else None):>9} {result['rssMb']:>6.1f}MB")
+        print(f"  (a bare interpreter peaks at {interpreter_mb:.1f}MB RSS)")
+        if baseline is None:
+            print(f"no baseline at {args.baseline}, run with --update-baseline")
+        for line in found:
+            print(f"REGRESSION {line}")
+
+    if found and not args.update_baseline:
+        sys.exit(1)
+
+
+def fmt_ms(value: Optional[float]) -> str:
+    return f'{value:.1f}ms' if value is not None else '-'
+
+
+if __name__ == '__main__':
+    main()
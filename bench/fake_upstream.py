@@ -0,0 +1,342 @@
+'''
+Local stand-in for every service the functions talk to: NanoBanana
+(generate, record-info), ImgBB (upload + hosted images) and the Telegram
+Bot API (getFile, file download, sendMessage, editMessageText,
+deleteMessage, sendPhoto). Every request gets configurable latency and
+injected failures; NanoBanana tasks fetch their input photo by URL (a task
+whose photo can't be fetched fails), finish after a log-normal delay, and a
+task submitted with a callBackUrl is POSTed there when it finishes (unless
+the callback is dropped, see --callback-drop-rate). With --telegram-chat-limit
+a chat that gets more Bot API calls than that within a second is answered
+429 with retry_after, like Telegram's flood control.
+GET /stats returns per-endpoint call counts, POST /stats/reset clears them.
+
+Point the functions at it with
+    NANOBANANA_BASE_URL=http://127.0.0.1:8900 IMGBB_BASE_URL=http://127.0.0.1:8900
+    TELEGRAM_API_BASE=http://127.0.0.1:8900
+
+Usage: python bench/fake_upstream.py [--port 8900] [--latency 0.05] [--failure-rate 0]
+                                     [--task-median 2] [--task-sigma 0.4] [--task-failure-rate 0]
+                                     [--callback-drop-rate 0] [--telegram-chat-limit 0]
+'''
+
+import argparse
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+TELEGRAM_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+TELEGRAM_FILE_PATH = re.compile(r'^/file/bot[^/]+/(?P<path>.+)$')
+
+
+def make_photo(size: Tuple[int, int] = (1280, 960)) -> bytes:
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', size, (120, 160, 200))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size[0], 40):
+        draw.line([(i, 0), (size[0] - i, size[1])], fill=(i % 255, 80, 200 - i % 200), width=6)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class FakeUpstream:
+    def __init__(
+        self,
+        latency: float = 0.05,
+        failure_rate: float = 0.0,
+        task_median: float = 2.0,
+        task_sigma: float = 0.4,
+        task_failure_rate: float = 0.0,
+        callback_drop_rate: float = 0.0,
+        telegram_chat_limit: int = 0,
+        seed: Optional[int] = None
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.task_mu = math.log(task_median)
+        self.task_sigma = task_sigma
+        self.task_failure_rate = task_failure_rate
+        self.callback_drop_rate = callback_drop_rate
+        self.telegram_chat_limit = telegram_chat_limit
+        self.chat_calls: Dict[Any, deque] = {}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.tasks: Dict[str, Tuple[float, bool]] = {}
+        self.images: Dict[str, bytes] = {}
+        self.photos: Dict[int, List[float]] = {}
+        self.photo = make_photo()
+        self.next_id = 0
+        # task ids stay unique across runs sharing one database
+        self.run_id = uuid.uuid4().hex[:8]
+        self.base_url = ''
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+    def count(self, endpoint: str) -> bool:
+        '''
+        Counts the call; returns True when a failure should be injected.
+        '''
+        with self.lock:
+            self.calls[endpoint] += 1
+            failed = self.rng.random() < self.failure_rate
+            if failed:
+                self.failures[endpoint] += 1
+        return failed
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'calls': dict(self.calls), 'failures': dict(self.failures), 'tasks': len(self.tasks)}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.failures.clear()
+            self.photos.clear()
+
+    def generate(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        task_id = f'fake-task-{self.run_id}-{self.new_id()}'
+        with self.lock:
+            duration = self.rng.lognormvariate(self.task_mu, self.task_sigma)
+            failed = self.rng.random() < self.task_failure_rate
+            self.tasks[task_id] = (time.monotonic() + duration, failed)
+        if body.get('imageUrls'):
+            fetcher = threading.Thread(target=self.fetch_input, args=(task_id, body['imageUrls'][0]), daemon=True)
+            fetcher.start()
+        if body.get('callBackUrl'):
+            timer = threading.Timer(duration, self.send_callback, (task_id, body['callBackUrl']))
+            timer.daemon = True
+            timer.start()
+        return {'code': 200, 'msg': 'success', 'data': {'taskId': task_id}}
+
+    def fetch_input(self, task_id: str, url: str) -> None:
+        try:
+            with urlopen(url, timeout=10) as response:
+                fetched = len(response.read()) > 0
+        except Exception as e:
+            print(f"Input photo of {task_id} could not be fetched: {e}")
+            fetched = False
+        self.count_event('nanobanana.input' if fetched else 'nanobanana.input.error')
+        if not fetched:
+            with self.lock:
+                done_at, _ = self.tasks[task_id]
+                self.tasks[task_id] = (done_at, True)
+
+    def record_info(self, task_id: str) -> Dict[str, Any]:
+        task = self.tasks.get(task_id)
+        if task is None:
+            return {'code': 404, 'msg': 'task not found'}
+        done_at, failed = task
+        data: Dict[str, Any] = {'taskId': task_id, 'successFlag': 0, 'errorCode': 0}
+        if time.monotonic() >= done_at:
+            if failed:
+                data.update(successFlag=2, errorCode=500, errorMessage='injected task failure')
+            else:
+                data.update(successFlag=1, response={'resultImageUrl': f'{self.base_url}/i/{task_id}.jpg'})
+        return {'code': 200, 'msg': 'success', 'data': data}
+
+    def send_callback(self, task_id: str, url: str) -> None:
+        with self.lock:
+            dropped = self.rng.random() < self.callback_drop_rate
+        self.count_event('callback.dropped' if dropped else 'callback.sent')
+        if dropped:
+            return
+
+        _, failed = self.tasks[task_id]
+        if failed:
+            body = {'code': 500, 'msg': 'injected task failure', 'data': {'taskId': task_id, 'info': None}}
+        else:
+            body = {'code': 200, 'msg': 'Image generated successfully.', 'data': {
+                'taskId': task_id,
+                'info': {'resultImageUrl': f'{self.base_url}/i/{task_id}.jpg'}
+            }}
+        request = Request(url, data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=10) as response:
+                response.read()
+        except Exception as e:
+            self.count_event('callback.error')
+            print(f"Callback for {task_id} failed: {e}")
+
+    def count_event(self, name: str) -> None:
+        with self.lock:
+            self.calls[name] += 1
+
+    def upload(self) -> Dict[str, Any]:
+        name = f'upload-{self.new_id()}'
+        return {'success': True, 'status': 200, 'data': {'url': f'{self.base_url}/i/{name}.jpg', 'expiration': 0}}
+
+    def flooded(self, chat_id: Any) -> bool:
+        '''
+        Counts a Bot API call in the chat; True when it goes over telegram_chat_limit per second.
+        '''
+        if not self.telegram_chat_limit or chat_id is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            calls = self.chat_calls.setdefault(chat_id, deque())
+            while calls and calls[0] <= now - 1:
+                calls.popleft()
+            if len(calls) >= self.telegram_chat_limit:
+                self.calls['telegram.429'] += 1
+                return True
+            calls.append(now)
+        return False
+
+    def telegram(self, method: str, body: Dict[str, Any], query: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = body.get('chat_id')
+        if self.flooded(chat_id):
+            return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1}}
+        if method == 'getFile':
+            file_id = query.get('file_id') or body.get('file_id')
+            return {'ok': True, 'result': {'file_id': file_id, 'file_path': f'photos/{file_id}.jpg'}}
+        if method == 'sendPhoto':
+            # a URL is fetched by Telegram from the upstream host, a file_id is not
+            photo = str(body.get('photo') or '')
+            by_url = photo.startswith('http')
+            self.count_event('telegram.sendPhoto.url' if by_url else 'telegram.sendPhoto.fileId')
+            with self.lock:
+                self.photos.setdefault(chat_id, []).append(time.monotonic())
+            message_id = self.new_id()
+            return {'ok': True, 'result': {
+                'message_id': message_id,
+                'chat': {'id': chat_id},
+                'photo': [{'file_id': f'fake-photo-{message_id}' if by_url else photo, 'width': 1024, 'height': 1024}]
+            }}
+        if method in ('sendMessage', 'editMessageText'):
+            return {'ok': True, 'result': {'message_id': body.get('message_id') or self.new_id(), 'chat': {'id': chat_id}}}
+        if method == 'deleteMessage':
+            return {'ok': True, 'result': True}
+        return {'ok': False, 'error_code': 404, 'description': f'Not Found: method {method}'}
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(self, status: int, body: Any, content_type: str = 'application/json') -> None:
+                data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_body(self) -> Dict[str, Any]:
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if 'json' in (self.headers.get('Content-Type') or ''):
+                    return json.loads(raw or b'{}')
+                return {key: values[0] for key, values in parse_qs(raw.decode('utf-8', 'replace')).items()}
+
+            def do_GET(self) -> None:
+                self.route('GET', {})
+
+            def do_POST(self) -> None:
+                self.route('POST', self.read_body())
+
+            def route(self, method: str, body: Dict[str, Any]) -> None:
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                path = url.path
+
+                if path == '/stats':
+                    if method == 'POST':
+                        fake.reset()
+                    return self.reply(200, fake.stats())
+
+                endpoint, respond = self.resolve(method, path, body, query)
+                if endpoint is None:
+                    return self.reply(404, {'error': f'no fake for {method} {path}'})
+
+                fake.delay()
+                if fake.count(endpoint):
+                    return self.reply(502, {'error': 'injected failure'})
+                respond()
+
+            def resolve(self, method: str, path: str, body: Dict[str, Any], query: Dict[str, Any]):
+                if path == '/api/v1/nanobanana/generate' and method == 'POST':
+                    return 'nanobanana.generate', lambda: self.reply(200, fake.generate(body))
+                if path == '/api/v1/nanobanana/record-info':
+                    return 'nanobanana.record-info', lambda: self.reply(200, fake.record_info(query.get('taskId', '')))
+                if path == '/1/upload' and method == 'POST':
+                    return 'imgbb.upload', lambda: self.reply(200, fake.upload())
+                if path.startswith('/i/'):
+                    return 'imgbb.image', lambda: self.reply(200, fake.photo, 'image/jpeg')
+
+                match = TELEGRAM_FILE_PATH.match(path)
+                if match:
+                    return 'telegram.file', lambda: self.reply(200, fake.photo, 'image/jpeg')
+                match = TELEGRAM_PATH.match(path)
+                if match:
+                    telegram_method = match.group('method')
+                    return f'telegram.{telegram_method}', lambda: self.reply(200, fake.telegram(telegram_method, body, query))
+                return None, None
+
+        return Handler
+
+
+def start_server(fake: FakeUpstream, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    '''
+    Serves `fake` on a background thread; port 0 picks a free port.
+    '''
+    server = ThreadingHTTPServer((host, port), fake.make_handler())
+    server.daemon_threads = True
+    fake.base_url = f'http://{host}:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fake NanoBanana / ImgBB / Telegram Bot API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds added to every request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with 502')
+    parser.add_argument('--task-median', type=float, default=2.0, help='median NanoBanana task duration, seconds')
+    parser.add_argument('--task-sigma', type=float, default=0.4)
+    parser.add_argument('--task-failure-rate', type=float, default=0.0, help='share of tasks that finish failed')
+    parser.add_argument('--callback-drop-rate', type=float, default=0.0, help='share of task callbacks never sent')
+    parser.add_argument('--telegram-chat-limit', type=int, default=0, help='Bot API calls per chat per second before 429')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeUpstream(
+        args.latency, args.failure_rate, args.task_median, args.task_sigma, args.task_failure_rate,
+        args.callback_drop_rate, args.telegram_chat_limit, args.seed
+    )
+    server = start_server(fake, args.host, args.port)
+    print(f"Fake upstream listening on {fake.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
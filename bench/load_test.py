@@ -0,0 +1,450 @@
+'''
+End-to-end load test of both functions against bench/fake_upstream.py.
+Loads generate-image and telegram-bot in this process, points them at an
+in-process fake upstream and drives them from concurrent clients:
+
+  generate  web-UI flow: POST a photo (submit mode), then long-poll
+            GET ?taskId=&wait= until the card is ready
+  bot       Telegram flow: photo updates hit the bot webhook, worker threads
+            drain the job queue through generate-image (served over local
+            HTTP like in production) until every chat got its sendPhoto.
+            Needs a migrated Postgres in DATABASE_URL / --database-url.
+            --repeat-rate sends that share of the photos with one shared
+            caption, so their cards come from the result cache and go out
+            by Telegram file_id. --heavy-share sends that share of the
+            photos from HEAVY_USERS users flooding the bot up front and
+            reports the latency of light and heavy users separately.
+
+With a database generate-image queues generations fairly per user
+(--generation-concurrency slots, 0 turns the queue off); every web client
+gets its own address. With --callbacks (also needs the database) the fake
+upstream calls generate-image back when a task finishes, and record-info is
+only polled as a fallback; --callback-drop-rate loses some callbacks to
+exercise it. --function-timeout gives every invocation the platform's
+execution limit (context.get_remaining_time_in_millis), so the stages run
+on what is left of it. --image-store picks where input photos go; the fake
+NanoBanana fetches them from there (postgres and file through
+generate-image's ?image= URLs).
+
+Reports throughput, p50/p95/p99 latency, upstream call counts, per-stage
+timing histograms (tracing.snapshot() of each function) and peak memory.
+
+Usage: python bench/load_test.py [--scenario generate|bot|both] [--cards 40] [--clients 8]
+                                 [--latency 0.05] [--failure-rate 0] [--task-median 2] [--json]
+                                 [--callbacks] [--callback-drop-rate 0] [--repeat-rate 0]
+                                 [--telegram-chat-limit 0] [--heavy-share 0]
+                                 [--generation-concurrency 8] [--function-timeout 0]
+                                 [--image-store imgbb|postgres|file]
+'''
+
+import argparse
+import base64
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_upstream import FakeUpstream, start_server  # noqa: E402
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+BOT_TOKEN = 'load-test-token'
+HEAVY_USERS = 2
+
+# Execution time limit of one invocation in seconds, like the platform's; 0 for none
+FUNCTION_TIMEOUT = 0.0
+
+
+def load_function(name: str) -> types.ModuleType:
+    '''
+    Imports backend/<name>/index.py. Both functions have modules with the
+    same names (index, db, http_client), so the function's modules are
+    dropped from sys.modules again once it is loaded; the loaded index keeps
+    its own references to them.
+    '''
+    path = os.path.join(BACKEND_DIR, name)
+    sys.path.insert(0, path)
+    try:
+        return importlib.import_module('index')
+    finally:
+        sys.path.remove(path)
+        for module_name, module in list(sys.modules.items()):
+            if (getattr(module, '__file__', None) or '').startswith(path):
+                del sys.modules[module_name]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(name: str, latencies: List[float], errors: int, wall: float, **extra) -> Dict[str, Any]:
+    return {
+        'scenario': name,
+        'cards': len(latencies) + errors,
+        'errors': errors,
+        'wallSeconds': round(wall, 2),
+        'throughput': round(len(latencies) / wall, 2) if wall else None,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        **extra
+    }
+
+
+def context() -> Any:
+    invocation = types.SimpleNamespace(request_id=uuid.uuid4().hex)
+    if FUNCTION_TIMEOUT:
+        ends_at = time.monotonic() + FUNCTION_TIMEOUT
+        invocation.get_remaining_time_in_millis = lambda: max(0, int((ends_at - time.monotonic()) * 1000))
+    return invocation
+
+
+def serve_function(handler: Callable) -> ThreadingHTTPServer:
+    '''
+    Exposes a function handler over local HTTP, the way the platform does.
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def invoke(self, method: str) -> None:
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+            event = {
+                'httpMethod': method,
+                'headers': dict(self.headers),
+                'queryStringParameters': {key: values[0] for key, values in parse_qs(url.query).items()},
+                'body': body
+            }
+            response = handler(event, context())
+            body = response.get('body') or ''
+            data = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+            headers = response.get('headers') or {}
+            self.send_response(response['statusCode'])
+            for key, value in headers.items():
+                self.send_header(key, value)
+            if 'Content-Length' not in headers:
+                self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            self.invoke('GET')
+
+        def do_POST(self) -> None:
+            self.invoke('POST')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_generate(generate_image: types.ModuleType, fake: FakeUpstream, cards: int, clients: int) -> Dict[str, Any]:
+    photo = 'data:image/jpeg;base64,' + base64.b64encode(fake.photo).decode('ascii')
+
+    def one_card(index: int) -> Optional[float]:
+        started = time.monotonic()
+        response = generate_image.handler({
+            'httpMethod': 'POST',
+            'requestContext': {'identity': {'sourceIp': f'10.0.{index // 256}.{index % 256}'}},
+            'body': json.dumps({'imageBase64': photo, 'customText': f'Нагрузочный тест {index}', 'noCache': True})
+        }, context())
+        result = json.loads(response['body'])
+        while response['statusCode'] == 202:
+            response = generate_image.handler({
+                'httpMethod': 'GET',
+                'queryStringParameters': {'taskId': result['taskId'], 'wait': '20'}
+            }, context())
+            result = json.loads(response['body'])
+        if result.get('status') != 'success':
+            return None
+        return time.monotonic() - started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(one_card, range(cards)))
+    wall = time.monotonic() - started
+
+    latencies = [latency for latency in results if latency is not None]
+    return summarize('generate', latencies, len(results) - len(latencies), wall)
+
+
+def run_bot(
+    bot: types.ModuleType,
+    fake: FakeUpstream,
+    cards: int,
+    clients: int,
+    db_url: str,
+    timeout: float,
+    repeat_rate: float = 0.0,
+    heavy_share: float = 0.0
+) -> Dict[str, Any]:
+    base = int(time.time() * 1000) % 10 ** 9 * 1000
+    # the heavy users' photos come first, as one flood; every other photo is a user of its own
+    heavy_cards = round(cards * heavy_share)
+    heavy = [base + index % HEAVY_USERS for index in range(heavy_cards)]
+    chats = heavy + [base + HEAVY_USERS + index for index in range(cards - heavy_cards)]
+    if heavy:
+        grant_quota(db_url, sorted(set(heavy)), heavy_cards)
+    rng = random.Random(base)
+    repeats = {index for index in range(cards) if rng.random() < repeat_rate}
+    webhook: List[float] = []
+    sent_at: Dict[int, List[float]] = {}
+
+    def one_update(index: int) -> None:
+        chat_id = chats[index]
+        update = {
+            'update_id': base + index,
+            'message': {
+                'message_id': index + 1,
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+                'chat': {'id': chat_id},
+                'photo': [{'file_id': f'load-{base + index}', 'width': 1280, 'height': 960}],
+                'caption': f'Нагрузочный тест {base if index in repeats else base + index}'
+            }
+        }
+        started = time.monotonic()
+        sent_at.setdefault(chat_id, []).append(started)
+        bot.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, context())
+        webhook.append(time.monotonic() - started)
+
+    done = threading.Event()
+
+    def worker_loop() -> None:
+        while not done.is_set():
+            if not bot.drain(BOT_TOKEN, db_url, budget=5):
+                time.sleep(0.2)
+
+    workers = [threading.Thread(target=worker_loop, daemon=True) for _ in range(clients)]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(one_update, range(cards)))
+
+    # a job can finish without a photo (failed job, or a lost sendPhoto); those count as errors
+    while time.monotonic() - started < timeout and finished_jobs(db_url, chats) < cards:
+        time.sleep(0.2)
+    wall = time.monotonic() - started
+    done.set()
+    for worker in workers:
+        worker.join(timeout=1)
+
+    # a chat's n-th card answers its n-th photo
+    by_chat = {
+        chat_id: [delivered - sent for sent, delivered in zip(sorted(sent_at[chat_id]), sorted(fake.photos.get(chat_id, [])))]
+        for chat_id in sent_at
+    }
+    latencies = [latency for chat_latencies in by_chat.values() for latency in chat_latencies]
+    extra = {}
+    if heavy_cards:
+        light = [latency for chat_id, chat_latencies in by_chat.items() if chat_id not in heavy for latency in chat_latencies]
+        flood = [latency for chat_id, chat_latencies in by_chat.items() if chat_id in heavy for latency in chat_latencies]
+        extra = {
+            'lightP50': percentile(light, 0.5),
+            'lightP95': percentile(light, 0.95),
+            'heavyP50': percentile(flood, 0.5),
+            'heavyP95': percentile(flood, 0.95)
+        }
+    return summarize(
+        'bot', latencies, cards - len(latencies), wall,
+        webhookP50=percentile(webhook, 0.5),
+        webhookP95=percentile(webhook, 0.95),
+        webhookP99=percentile(webhook, 0.99),
+        **extra
+    )
+
+
+def grant_quota(db_url: str, telegram_ids: List[int], daily_limit: int) -> None:
+    '''
+    Creates the users with a daily limit of their own, so the heavy users'
+    photos get past the quota and into the queue.
+    '''
+    import psycopg2
+
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn, conn.cursor() as cur:
+            for telegram_id in telegram_ids:
+                cur.execute(
+                    "INSERT INTO users (telegram_id, first_name, daily_limit) VALUES (%s, 'Load', %s) "
+                    "ON CONFLICT (telegram_id) DO UPDATE SET daily_limit = EXCLUDED.daily_limit",
+                    (telegram_id, daily_limit)
+                )
+    finally:
+        conn.close()
+
+
+def finished_jobs(db_url: str, chats: List[int]) -> int:
+    import psycopg2
+
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT COUNT(*) FROM generation_jobs WHERE status IN ('done', 'failed') AND chat_id = ANY(%s)",
+                (chats,)
+            )
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='End-to-end load test against fake upstreams')
+    parser.add_argument('--scenario', choices=('generate', 'bot', 'both'), default='generate')
+    parser.add_argument('--cards', type=int, default=40)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--task-median', type=float, default=2.0)
+    parser.add_argument('--task-sigma', type=float, default=0.4)
+    parser.add_argument('--task-failure-rate', type=float, default=0.0)
+    parser.add_argument('--callbacks', action='store_true', help='deliver task results through callbacks')
+    parser.add_argument('--callback-drop-rate', type=float, default=0.0, help='share of callbacks the fake never sends')
+    parser.add_argument('--telegram-chat-limit', type=int, default=0, help='fake Bot API flood limit per chat per second')
+    parser.add_argument('--repeat-rate', type=float, default=0.0, help='bot scenario: share of repeated cards')
+    parser.add_argument('--heavy-share', type=float, default=0.0, help=f'bot scenario: share of cards from {HEAVY_USERS} flooding users')
+    parser.add_argument('--generation-concurrency', type=int, default=8, help='generate-image queue slots, 0 = no queue')
+    parser.add_argument('--function-timeout', type=float, default=0.0, help='invocation time limit in seconds, 0 = none')
+    parser.add_argument('--image-store', choices=('imgbb', 'postgres', 'file'), default='imgbb',
+                        help='IMAGE_STORE_BACKEND of generate-image (postgres needs the database)')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--timeout', type=float, default=300.0, help='bot scenario: give up after this many seconds')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep the functions\' own log output')
+    args = parser.parse_args()
+    global FUNCTION_TIMEOUT
+    FUNCTION_TIMEOUT = args.function_timeout
+
+    if args.scenario in ('bot', 'both') and not args.database_url:
+        parser.error('the bot scenario needs --database-url (or DATABASE_URL)')
+    if args.image_store == 'postgres' and not args.database_url:
+        parser.error('--image-store postgres needs --database-url (or DATABASE_URL)')
+    if args.callbacks and not args.database_url:
+        parser.error('--callbacks needs --database-url (or DATABASE_URL)')
+
+    fake = FakeUpstream(
+        args.latency, args.failure_rate, args.task_median, args.task_sigma, args.task_failure_rate,
+        args.callback_drop_rate, args.telegram_chat_limit, seed=1
+    )
+    start_server(fake)
+
+    generate_image = None
+    server = serve_function(lambda event, context: generate_image.handler(event, context))
+    function_url = f'http://127.0.0.1:{server.server_port}'
+
+    os.environ.update({
+        'NANOBANANA_API_KEY': 'load-test',
+        'IMGBB_API_KEY': 'load-test',
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'NANOBANANA_BASE_URL': fake.base_url,
+        'IMGBB_BASE_URL': fake.base_url,
+        'TELEGRAM_API_BASE': fake.base_url,
+        'NANOBANANA_RATE': os.environ.get('NANOBANANA_RATE', '1000'),
+        'NANOBANANA_BURST': os.environ.get('NANOBANANA_BURST', '1000'),
+        'IMGBB_RATE': os.environ.get('IMGBB_RATE', '1000'),
+        'IMGBB_BURST': os.environ.get('IMGBB_BURST', '1000')
+    })
+    # the scheduler's cold-start guess is tuned for real ~25 s tasks
+    os.environ.setdefault('POLL_DEFAULT_FIRST_DELAY', str(args.task_median))
+    # every webhook client and worker thread may hold a connection (plus one per attempt)
+    os.environ.setdefault('DB_POOL_MAX_CONNECTIONS', str(args.clients * 3))
+    os.environ.pop('DATABASE_URL', None)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['GENERATE_IMAGE_URL'] = function_url
+    os.environ['INTERNAL_TOKEN'] = uuid.uuid4().hex
+    os.environ['GENERATION_CONCURRENCY'] = str(args.generation_concurrency)
+    for name in ('CALLBACK_URL', 'CALLBACK_SECRET'):
+        os.environ.pop(name, None)
+    if args.callbacks:
+        os.environ.update({'CALLBACK_URL': function_url, 'CALLBACK_SECRET': uuid.uuid4().hex})
+    os.environ.update({
+        'IMAGE_STORE_BACKEND': args.image_store,
+        'IMAGE_STORE_URL': function_url,
+        'IMAGE_STORE_SECRET': uuid.uuid4().hex,
+        'IMAGE_STORE_PATH': os.path.join('/tmp', f'load-test-images-{os.getpid()}')
+    })
+
+    tracemalloc.start()
+    generate_image = load_function('generate-image')
+    reports = []
+
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        if args.scenario in ('generate', 'both'):
+            fake.reset()
+            report = run_generate(generate_image, fake, args.cards, args.clients)
+            report['upstreamCalls'] = fake.stats()['calls']
+            report['stages'] = generate_image.tracing.snapshot()
+            reports.append(report)
+
+        if args.scenario in ('bot', 'both'):
+            bot = load_function('telegram-bot')
+            fake.reset()
+            report = run_bot(
+                bot, fake, args.cards, args.clients, args.database_url, args.timeout, args.repeat_rate, args.heavy_share
+            )
+            report['upstreamCalls'] = fake.stats()['calls']
+            report['stages'] = bot.tracing.snapshot()
+            reports.append(report)
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    _, peak = tracemalloc.get_traced_memory()
+    memory = {
+        'tracemallocPeakMb': round(peak / 2 ** 20, 1),
+        'maxRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+    if args.json:
+        print(json.dumps({'reports': reports, 'memory': memory}, indent=2))
+        return
+
+    for report in reports:
+        print(f"[{report['scenario']}] {report['cards']} cards, {report['errors']} errors, "
+              f"{report['wallSeconds']} s, {report['throughput']} cards/s")
+        print(f"  latency p50 {fmt(report['p50'])}  p95 {fmt(report['p95'])}  p99 {fmt(report['p99'])}")
+        if 'webhookP50' in report:
+            print(f"  webhook p50 {fmt(report['webhookP50'])}  p95 {fmt(report['webhookP95'])}  p99 {fmt(report['webhookP99'])}")
+        if 'lightP50' in report:
+            print(f"  light users p50 {fmt(report['lightP50'])}  p95 {fmt(report['lightP95'])}   "
+                  f"heavy users p50 {fmt(report['heavyP50'])}  p95 {fmt(report['heavyP95'])}")
+        for endpoint, count in sorted(report['upstreamCalls'].items()):
+            print(f"  {endpoint:<28} {count:>6}  ({count / max(report['cards'], 1):.2f}/card)")
+        print(f"  {'stage':<36} {'count':>6} {'avg':>8} {'p95':>8} {'max':>8}")
+        for stage, histogram in sorted(report['stages'].items(), key=lambda item: -item[1]['count'] * (item[1]['avg'] or 0)):
+            print(f"  {stage:<36} {histogram['count']:>6} {fmt(histogram['avg']):>8} {fmt(histogram['p95']):>8} {fmt(histogram['max']):>8}")
+    print(f"peak memory: {memory['tracemallocPeakMb']} MB traced, {memory['maxRssMb']} MB max RSS")
+
+
+def fmt(seconds: Optional[float]) -> str:
+    return f'{seconds:.3f}s' if seconds is not None else '-'
+
+
+if __name__ == '__main__':
+    main()
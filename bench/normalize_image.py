@@ -0,0 +1,81 @@
+'''
+Benchmark: bytes on the wire and end-to-end upload latency with and without
+generate-image's normalize_image() step.
+Synthetic camera-like photos (noise + gradients, EXIF with orientation) go
+through the two hops of a bot card: generate-image downloads the original
+from Telegram by its file_id (raw bytes; the bot only sends the file_id) and
+uploads it to ImgBB as base64. Normalizing only shrinks the upload hop.
+Wire time is modeled from --mbps, CPU time is measured.
+
+Usage: python bench/normalize_image.py [--mbps 10] [--repeat 5]
+'''
+
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'generate-image'))
+
+from imaging import normalize_image  # noqa: E402
+
+SIZES = [(1280, 960), (2560, 1920), (4032, 3024)]
+
+
+def synthetic_photo(width: int, height: int) -> bytes:
+    noise = Image.effect_noise((width, height), 60).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    image = Image.blend(noise, gradient, 0.5)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif[0x010F] = 'BenchCam'
+    exif[0x0110] = 'Model 1'
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def download_bytes(image: bytes) -> int:
+    # Telegram's file endpoint serves the photo as is
+    return len(image)
+
+
+def upload_bytes(image: bytes) -> int:
+    # base64 inside the urlencoded ImgBB form
+    return len(base64.b64encode(image))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='normalize_image() bytes-on-wire benchmark')
+    parser.add_argument('--mbps', type=float, default=10.0, help='modeled link speed, megabits per second')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    bytes_per_second = args.mbps * 1_000_000 / 8
+
+    print(f"{'photo':>11} {'raw KB':>8} {'norm KB':>8} {'wire before':>12} {'wire after':>11} "
+          f"{'cpu ms':>7} {'e2e before':>11} {'e2e after':>10}")
+    for width, height in SIZES:
+        photo = synthetic_photo(width, height)
+
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            normalized = normalize_image(photo)
+        cpu = (time.perf_counter() - started) / args.repeat
+
+        # the original is downloaded either way; after: the upload hop carries the normalized JPEG
+        before = download_bytes(photo) + upload_bytes(photo)
+        after = download_bytes(photo) + upload_bytes(normalized)
+        e2e_before = before / bytes_per_second
+        e2e_after = after / bytes_per_second + cpu
+
+        print(f"{width}x{height:<6} {len(photo) / 1024:8.0f} {len(normalized) / 1024:8.0f} "
+              f"{before / 1024:10.0f}KB {after / 1024:9.0f}KB {cpu * 1000:7.0f} "
+              f"{e2e_before:10.2f}s {e2e_after:9.2f}s")
+
+
+if __name__ == '__main__':
+    main()
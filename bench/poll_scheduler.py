@@ -0,0 +1,111 @@
+'''
+Benchmark: fixed 4 s polling vs. the adaptive PollScheduler.
+Runs in virtual time against a simulated NanoBanana stand-in whose task
+completion times follow a log-normal distribution, and reports p50/p95
+end-to-end latency, time lost between completion and detection, and
+record-info requests per card.
+
+Usage: python bench/poll_scheduler.py [--cards 2000] [--median 25] [--sigma 0.45] [--seed 1]
+'''
+
+import argparse
+import math
+import os
+import random
+import sys
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'generate-image'))
+
+from polling import PollScheduler  # noqa: E402
+
+BUDGET = 360.0
+
+
+class SimulatedNanoBanana:
+    '''
+    Stand-in for the generate/record-info endpoints: a task is done once
+    the virtual clock passes its completion time.
+    '''
+
+    def __init__(self, median: float, sigma: float, rng: random.Random):
+        self.mu = math.log(median)
+        self.sigma = sigma
+        self.rng = rng
+        self.requests = 0
+
+    def generate(self) -> float:
+        return self.rng.lognormvariate(self.mu, self.sigma)
+
+    def record_info(self, done_at: float, now: float) -> bool:
+        self.requests += 1
+        return now >= done_at
+
+
+def run_card(upstream: SimulatedNanoBanana, next_delay: Callable[[float, int], float]) -> Tuple[float, Optional[float], float]:
+    '''
+    Returns (completion time, detection time or None on timeout, last pending poll time).
+    '''
+    done_at = upstream.generate()
+    elapsed = 0.0
+    last_pending = 0.0
+    attempt = 0
+    while elapsed < BUDGET:
+        elapsed += next_delay(elapsed, attempt)
+        attempt += 1
+        if upstream.record_info(done_at, elapsed):
+            return done_at, elapsed, last_pending
+        last_pending = elapsed
+    return done_at, None, last_pending
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def bench(name: str, args: argparse.Namespace, scheduler: Optional[PollScheduler]) -> None:
+    upstream = SimulatedNanoBanana(args.median, args.sigma, random.Random(args.seed))
+    if scheduler:
+        next_delay = scheduler.next_delay
+    else:
+        next_delay = lambda elapsed, attempt: 4.0  # noqa: E731
+
+    latencies = []
+    lost = []
+    timeouts = 0
+    for _ in range(args.cards):
+        done_at, detected, last_pending = run_card(upstream, next_delay)
+        if detected is None:
+            timeouts += 1
+            continue
+        latencies.append(detected)
+        lost.append(detected - done_at)
+        if scheduler:
+            scheduler.record((last_pending + detected) / 2)
+
+    print(
+        f"{name:<10} p50={percentile(latencies, 0.5):6.1f}s  p95={percentile(latencies, 0.95):6.1f}s  "
+        f"lost p50={percentile(lost, 0.5):4.1f}s p95={percentile(lost, 0.95):4.1f}s  "
+        f"requests/card={upstream.requests / args.cards:5.1f}  timeouts={timeouts}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fixed vs. adaptive record-info polling')
+    parser.add_argument('--cards', type=int, default=2000)
+    parser.add_argument('--median', type=float, default=25.0, help='median completion time, seconds')
+    parser.add_argument('--sigma', type=float, default=0.45, help='log-normal shape of completion times')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.cards} cards, completion median {args.median}s, sigma {args.sigma}")
+    bench('fixed-4s', args, None)
+
+    scheduler = PollScheduler(rng=random.Random(args.seed))
+    bench('adaptive', args, scheduler)
+    print(f"learned parameters: {scheduler.params()}")
+
+
+if __name__ == '__main__':
+    main()
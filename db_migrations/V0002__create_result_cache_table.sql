@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS result_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    value JSONB NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_result_cache_last_used_at ON result_cache(last_used_at);
+CREATE INDEX idx_result_cache_expires_at ON result_cache(expires_at);
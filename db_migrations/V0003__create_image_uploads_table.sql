@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS image_uploads (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    url TEXT NOT NULL,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_image_uploads_expires_at ON image_uploads(expires_at);
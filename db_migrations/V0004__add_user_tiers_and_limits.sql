@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS tiers (
+    name VARCHAR(32) PRIMARY KEY,
+    daily_limit INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO tiers (name, daily_limit) VALUES ('free', 3) ON CONFLICT (name) DO NOTHING;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tier VARCHAR(32) NOT NULL DEFAULT 'free';
+ALTER TABLE users ADD COLUMN IF NOT EXISTS daily_limit INTEGER;
@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    chat_id BIGINT NOT NULL,
+    status_message_id BIGINT,
+    payload JSONB NOT NULL,
+    quota_date DATE NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    visible_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_generation_jobs_ready ON generation_jobs(visible_at) WHERE status IN ('queued', 'running');
@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS processed_updates (
+    id BIGSERIAL PRIMARY KEY,
+    update_id BIGINT UNIQUE,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'in_flight',
+    lease_until TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    duplicates INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (chat_id, message_id)
+);
+
+CREATE INDEX idx_processed_updates_expires_at ON processed_updates(expires_at);
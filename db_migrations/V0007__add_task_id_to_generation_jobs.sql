@@ -0,0 +1 @@
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS task_id VARCHAR(64);
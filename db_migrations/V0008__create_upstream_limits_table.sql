@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS upstream_limits (
+    name VARCHAR(32) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    open_until TIMESTAMP
+);
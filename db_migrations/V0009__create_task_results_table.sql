@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS task_results (
+    task_id VARCHAR(64) PRIMARY KEY,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    image_url TEXT,
+    error_code INTEGER,
+    message TEXT,
+    source VARCHAR(16),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    checked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX idx_task_results_created_at ON task_results(created_at);
@@ -0,0 +1,8 @@
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS result_url TEXT;
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS result_file_id VARCHAR(255);
+
+CREATE TABLE IF NOT EXISTS telegram_files (
+    image_url TEXT PRIMARY KEY,
+    file_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
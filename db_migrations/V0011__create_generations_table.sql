@@ -0,0 +1,24 @@
+CREATE TABLE IF NOT EXISTS generations (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    job_id BIGINT UNIQUE REFERENCES generation_jobs(id),
+    input_hash VARCHAR(64),
+    style VARCHAR(32) NOT NULL DEFAULT 'default',
+    caption TEXT,
+    task_id VARCHAR(64),
+    result_url TEXT,
+    file_id VARCHAR(255),
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',
+    queue_ms INTEGER,
+    generate_ms INTEGER,
+    deliver_ms INTEGER,
+    total_ms INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX idx_generations_user_history ON generations(user_id, id DESC);
+CREATE INDEX idx_generations_in_flight ON generations(created_at) WHERE status IN ('queued', 'pending');
+CREATE INDEX idx_generations_latency ON generations(finished_at)
+    INCLUDE (queue_ms, generate_ms, deliver_ms, total_ms) WHERE status = 'done';
@@ -0,0 +1,31 @@
+ALTER TABLE tiers ADD COLUMN IF NOT EXISTS weight DOUBLE PRECISION NOT NULL DEFAULT 1;
+
+CREATE TABLE IF NOT EXISTS generation_queue (
+    id BIGSERIAL PRIMARY KEY,
+    client_id VARCHAR(64) NOT NULL,
+    source VARCHAR(16) NOT NULL,
+    weight DOUBLE PRECISION NOT NULL,
+    finish_tag DOUBLE PRECISION NOT NULL,
+    prompt TEXT NOT NULL,
+    image_url TEXT,
+    result_key VARCHAR(64),
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',
+    task_id VARCHAR(64),
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    lease_until TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX idx_generation_queue_order ON generation_queue(finish_tag, id) WHERE status = 'queued';
+CREATE INDEX idx_generation_queue_tags ON generation_queue(finish_tag);
+CREATE INDEX idx_generation_queue_client ON generation_queue(client_id, finish_tag) WHERE status IN ('queued', 'running');
+CREATE INDEX idx_generation_queue_task ON generation_queue(task_id) WHERE status = 'running';
+CREATE INDEX idx_generation_queue_created_at ON generation_queue(created_at);
+
+CREATE TABLE IF NOT EXISTS generation_slots (
+    slot INTEGER PRIMARY KEY,
+    queue_id BIGINT,
+    lease_until TIMESTAMP
+);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS input_images (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_input_images_expires_at ON input_images(expires_at);
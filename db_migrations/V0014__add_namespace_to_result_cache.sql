@@ -0,0 +1,7 @@
+ALTER TABLE result_cache ADD COLUMN IF NOT EXISTS namespace VARCHAR(16) NOT NULL DEFAULT 'result';
+
+ALTER TABLE result_cache DROP CONSTRAINT IF EXISTS result_cache_pkey;
+ALTER TABLE result_cache ADD PRIMARY KEY (namespace, cache_key);
+
+DROP INDEX IF EXISTS idx_result_cache_last_used_at;
+CREATE INDEX idx_result_cache_namespace_last_used_at ON result_cache(namespace, last_used_at);
@@ -0,0 +1 @@
+ALTER TABLE generation_queue ADD COLUMN IF NOT EXISTS image_hash VARCHAR(64);
@@ -0,0 +1 @@
+ALTER TABLE generation_queue ADD COLUMN IF NOT EXISTS checked_at TIMESTAMP;
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_user_running ON generation_jobs(user_id) WHERE status = 'running';
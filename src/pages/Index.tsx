@@ -10,11 +10,20 @@ interface GenerationData {
 }
 
 const BACKEND_URL = 'https://functions.poehali.dev/937cd074-b42c-4c14-86bc-4a8b85463284';
+const STATUS_WAIT_SECONDS = 20;
+const RESULT_TIMEOUT_MS = 6 * 60 * 1000;
+const STATUS_RETRY_MAX_MS = 30 * 1000;
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
+// The task may still finish: waiting longer, not submitting a new (paid) one, is the answer
+class ResultTimeoutError extends Error {}
 
 const Index = () => {
   const [selectedImage, setSelectedImage] = useState<string | null>(null);
   const [generatedImage, setGeneratedImage] = useState<string | null>(null);
   const [isGenerating, setIsGenerating] = useState(false);
+  const [queuePosition, setQueuePosition] = useState<number | null>(null);
   const [generationsLeft, setGenerationsLeft] = useState(1);
   const [customText, setCustomText] = useState('');
   const fileInputRef = useRef<HTMLInputElement>(null);
@@ -112,6 +121,35 @@ const Index = () => {
     e.preventDefault();
   };
 
+  const waitForResult = async (taskId: string) => {
+    const deadline = Date.now() + RESULT_TIMEOUT_MS;
+    let failures = 0;
+
+    while (Date.now() < deadline) {
+      const data = await fetch(
+        `${BACKEND_URL}?taskId=${encodeURIComponent(taskId)}&wait=${STATUS_WAIT_SECONDS}`
+      )
+        .then(response => response.json())
+        .catch(() => null);
+
+      if (data?.status === 'success' || data?.status === 'failed') {
+        return data;
+      }
+      if (data?.status === 'pending') {
+        failures = 0;
+        setQueuePosition(data.queuePosition ?? null);
+        continue;
+      }
+
+      // 503 while the generator is unavailable, or no answer at all: the task itself is still running
+      failures += 1;
+      const backoff = Math.min(1000 * 2 ** (failures - 1), STATUS_RETRY_MAX_MS);
+      await sleep(data?.retryAfter ? data.retryAfter * 1000 : backoff);
+    }
+
+    throw new ResultTimeoutError('Generation timeout');
+  };
+
   const handleGenerate = async () => {
     if (!selectedImage) {
       toast({
@@ -144,7 +182,13 @@ const Index = () => {
           }),
         });
 
-        const data = await response.json();
+        let data = await response.json();
+
+        if (data.status === 'pending' && data.taskId) {
+          setQueuePosition(data.queuePosition ?? null);
+          data = await waitForResult(data.taskId);
+          setQueuePosition(null);
+        }
         
         if (data.success && data.imageUrl) {
           setGeneratedImage(data.imageUrl);
@@ -159,9 +203,13 @@ const Index = () => {
           throw new Error(data.error || 'Generation failed');
         }
       } catch (error) {
+        setQueuePosition(null);
         lastError = error as Error;
+        if (error instanceof ResultTimeoutError) {
+          break;
+        }
         if (attempt < maxRetries) {
-          await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+          await sleep(1000 * attempt);
         }
       }
     }
@@ -318,7 +366,7 @@ const Index = () => {
                 {isGenerating ? (
                   <>
                     <Icon name="Loader2" className="mr-2 h-5 w-5 animate-spin" />
-                    Генерируем открытку...
+                    {queuePosition ? `В очереди, перед вами: ${queuePosition - 1}` : 'Генерируем открытку...'}
                   </>
                 ) : (
                   <>